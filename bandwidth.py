@@ -0,0 +1,183 @@
+################################################################################
+#
+# bandwidth.py - Request and response bytes per endpoint, on the wire and decoded
+#
+# Locust only records the decoded length of each response body.  For
+# provisioning the network of a homeserver we also need the bytes that cross
+# the wire: the request and response headers, the request bodies, and the
+# response bodies as they were sent, before we decompress them.  MatrixUser
+# reads its responses through MeteredResponse, which keeps the size of the body
+# on the wire and the time it took to decompress, and this module adds them up
+# per endpoint and per room size bucket.  Workers send their counters to the
+# master along with the regular Locust reports, and the master writes them to
+# <csv prefix>_bandwidth.csv at the end of the test.
+#
+# The encodings that we ask the server for are set with --accept-encoding,
+# e.g. "identity" for no compression, or "gzip" or "br" (Brotli, with the
+# brotli package installed).  Without it, Locust asks for "gzip, deflate".
+# Header sizes of the responses are estimated from the parsed headers.
+#
+################################################################################
+
+import csv
+import logging
+import time
+import zlib
+
+from locust import events
+from locust.contrib.fasthttp import FastResponse
+from locust.runners import WorkerRunner
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CSV_HEADER = ["Room Size", "Type", "Name", "Request Count",
+              "Request Wire Bytes", "Request Body Bytes", "Response Wire Bytes", "Response Body Wire Bytes",
+              "Response Body Bytes", "Compression Ratio", "Decompress Time (ms)", "Response Wire Bytes/s"]
+
+# Counters of each (room size bucket, type, name); the bucket is "" for the totals of an endpoint
+REQUESTS, REQUEST_WIRE, REQUEST_BODY, RESPONSE_WIRE, RESPONSE_BODY_WIRE, RESPONSE_BODY, DECOMPRESS_TIME = range(7)
+counters = {}
+
+# The Accept-Encoding header of our requests, or None for Locust's default
+accept_encoding = None
+
+# When the test started, for the bytes per second
+start_time = None
+
+
+def decompress(body, encoding):
+    """Decodes a response body with the given Content-Encoding"""
+    if encoding == "identity":
+        return body
+    if encoding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        # Servers send either raw deflate data or the zlib format
+        try:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+        except zlib.error:
+            return zlib.decompress(body)
+    if encoding == "br" and brotli is not None:
+        return brotli.decompress(body)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+class MeteredResponse(FastResponse):
+    """A FastResponse that keeps the size of its body on the wire, and the time it took to decompress"""
+
+    wire_length = 0
+    decompress_time = 0.0
+
+    def _content(self):
+        if self.headers is None:
+            return None
+        body = self._response.read()
+        self.release()
+        self.wire_length = len(body)
+        encodings = self.headers.getlist("content-encoding")
+        encoding = encodings[0].lower() if len(encodings) > 0 else "identity"
+        start = time.perf_counter()
+        content = decompress(body, encoding)
+        self.decompress_time = time.perf_counter() - start
+        return content
+
+
+def header_length(response):
+    """Estimates the size of a response's status line and headers"""
+    return len("HTTP/1.1 200 OK\r\n\r\n") + sum(len(key) + len(value) + 4 for (key, value) in response.headers.items())
+
+
+def add(key, values):
+    entry = counters.get(key, None)
+    if entry is None:
+        counters[key] = list(values)
+    else:
+        for i, value in enumerate(values):
+            entry[i] += value
+
+
+def stats_rows(duration):
+    """Returns one row per (bucket, request) plus one aggregated row per bucket, in CSV_HEADER order"""
+    def row(bucket, request_type, name, values):
+        body_wire = values[RESPONSE_BODY_WIRE]
+        return [bucket, request_type, name, values[REQUESTS], values[REQUEST_WIRE], values[REQUEST_BODY],
+                values[RESPONSE_WIRE], body_wire, values[RESPONSE_BODY],
+                round(values[RESPONSE_BODY] / body_wire, 2) if body_wire > 0 else "",
+                round(values[DECOMPRESS_TIME] * 1000, 1),
+                round(values[RESPONSE_WIRE] / duration, 1) if duration > 0 else ""]
+
+    rows = []
+    for bucket in sorted(set(key[0] for key in counters)):
+        keys = sorted(key for key in counters if key[0] == bucket)
+        total = [0] * 7
+        for key in keys:
+            rows.append(row(*key, counters[key]))
+            total = [a + b for (a, b) in zip(total, counters[key])]
+        rows.append(row(bucket, "", "Aggregated", total))
+    return rows
+
+
+# Locust event hooks ###########################################################
+
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+    parser.add_argument("--accept-encoding", type=str, default=None,
+                        help="Accept-Encoding of our requests, e.g. 'identity', 'gzip' or 'br' "
+                             "(defaults to Locust's 'gzip, deflate')")
+
+
+@events.request.add_listener
+def on_request(request_type, name, response=None, context=None, **_kwargs):
+    if not isinstance(response, MeteredResponse) or response.headers is None:
+        return
+    sent_request = getattr(response, "_sent_request", None) or ""
+    payload = getattr(response._request, "payload", None) or b""
+    body_length = len(response.content or b"")
+    values = [1, len(sent_request) + len(payload), len(payload),
+              header_length(response) + response.wire_length, response.wire_length, body_length,
+              response.decompress_time]
+    add(("", request_type, name), values)
+    bucket = (context or {}).get("room_size_bucket", None)
+    if bucket is not None:
+        add((bucket, request_type, name), values)
+
+
+@events.report_to_master.add_listener
+def on_report_to_master(client_id, data):
+    data["bandwidth"] = [[*key, *values] for (key, values) in counters.items()]
+    counters.clear()
+
+
+@events.worker_report.add_listener
+def on_worker_report(client_id, data):
+    for row in data.get("bandwidth", []):
+        add(tuple(row[:3]), row[3:])
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global accept_encoding, start_time
+    counters.clear()
+    start_time = time.time()
+    accept_encoding = getattr(environment.parsed_options, "accept_encoding", None)
+    if accept_encoding is not None and brotli is None and "br" in accept_encoding.replace(" ", "").split(","):
+        logging.warning("Brotli is not installed (pip install brotli): not asking for 'br' responses")
+        accept_encoding = ", ".join(encoding.strip() for encoding in accept_encoding.split(",")
+                                    if encoding.strip() != "br") or "identity"
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **_kwargs):
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    csv_prefix = getattr(environment.parsed_options, "csv_prefix", None)
+    if csv_prefix and start_time is not None:
+        path = f"{csv_prefix}_bandwidth.csv"
+        logging.info("Writing bandwidth statistics to %s", path)
+        with open(path, "w", encoding="utf-8", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(stats_rows(time.time() - start_time))
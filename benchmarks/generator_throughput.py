@@ -0,0 +1,137 @@
+#!/bin/env python3
+
+################################################################################
+#
+# generator_throughput.py - How much load can one Locust worker generate?
+#
+# Runs each of our user classes (register, create_room, join, chat) in turn
+# against the in-memory mock homeserver, with one master and one worker, and
+# measures the worker's CPU time.  Since the mock server answers almost
+# instantly, this tells us the ceiling of the load generator itself:
+#
+#   * max requests/sec per worker core = requests/sec / worker CPU utilisation
+#
+# Example:
+#
+#   python3 benchmarks/generator_throughput.py --accounts 2000 --locust-users 500 --duration 60
+#
+################################################################################
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, locustfile)
+SCENARIOS = [
+    ("register", "matrix-locust/client_server/register.py"),
+    ("create_room", "matrix-locust/client_server/create_room.py"),
+    ("join", "matrix-locust/client_server/join.py"),
+    ("chat", "chat.py"),
+]
+
+HTTP_METHODS = {"GET", "POST", "PUT", "DELETE"}
+
+# Seconds that the master and the worker get to shut down after the run time
+EXIT_GRACE_SECONDS = 60
+
+
+def count_http_requests(stats_csv):
+    """Sums the requests in a Locust _stats.csv file, leaving out our custom (non-HTTP) samples"""
+    with open(stats_csv, "r", encoding="utf-8") as csvfile:
+        return sum(int(row["Request Count"]) for row in csv.DictReader(csvfile) if row["Type"] in HTTP_METHODS)
+
+
+def run_scenario(args, workdir, env, name, locustfile):
+    prefix = os.path.join(workdir, name)
+    locustfile = os.path.join(REPO_DIR, locustfile)
+    worker = subprocess.Popen(["locust", "-f", locustfile, "--worker", "--master-port", str(args.master_port)],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    master = subprocess.Popen(["locust", "-f", locustfile, "--master", "--headless",
+                               "--master-bind-port", str(args.master_port), "--expect-workers", "1",
+                               "--host", f"http://127.0.0.1:{args.port}",
+                               "--users", str(args.locust_users), "--spawn-rate", str(args.spawn_rate),
+                               "--run-time", f"{args.duration}s", "--csv", prefix, "--only-summary"],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        master.wait(timeout=args.duration + EXIT_GRACE_SECONDS)
+    except subprocess.TimeoutExpired:
+        master.kill()
+        master.wait()
+    # wait4() gives us the resource usage of the worker process alone.  If the master failed, the
+    # worker never gets told to quit, so don't wait for it forever.
+    deadline = time.time() + EXIT_GRACE_SECONDS
+    pid, _status, rusage = os.wait4(worker.pid, os.WNOHANG)
+    while pid == 0:
+        if time.time() > deadline:
+            worker.kill()
+            os.wait4(worker.pid, 0)
+            raise RuntimeError(f"The {name} worker didn't exit within {EXIT_GRACE_SECONDS}s of the master "
+                               f"(master exit code {master.returncode})")
+        time.sleep(0.5)
+        pid, _status, rusage = os.wait4(worker.pid, os.WNOHANG)
+    return count_http_requests(f"{prefix}_stats.csv"), rusage.ru_utime + rusage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the load generator against the mock homeserver")
+    parser.add_argument("--accounts", type=int, default=1000,
+                        help="Number of Matrix accounts to generate")
+    parser.add_argument("--locust-users", type=int, default=200,
+                        help="Number of Locust users in each scenario")
+    parser.add_argument("--spawn-rate", type=float, default=100,
+                        help="Locust spawn rate")
+    parser.add_argument("--duration", type=int, default=30,
+                        help="Run time of each scenario in seconds")
+    parser.add_argument("--port", type=int, default=8018,
+                        help="Port for the mock homeserver")
+    parser.add_argument("--master-port", type=int, default=5588,
+                        help="Port for the Locust master")
+    parser.add_argument("--latency", type=str, default="none",
+                        help="Latency model for the mock homeserver (see mock_homeserver.py)")
+    parser.add_argument("--event-padding", type=str, default="none",
+                        help="Payload size model for the mock homeserver (see mock_homeserver.py)")
+    parser.add_argument("--seed", type=str, default="benchmark",
+                        help="Seed for the generated users and rooms")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH", "")]))
+
+    with tempfile.TemporaryDirectory(prefix="matrix-locust-bench-") as workdir:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "generate_users.py"), str(args.accounts),
+                        "--seed", args.seed], cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "generate_rooms.py"), "--seed", args.seed],
+                       cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+
+        homeserver = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "mock_homeserver.py"),
+                                       "--port", str(args.port), "--latency", args.latency,
+                                       "--event-padding", args.event_padding],
+                                      cwd=workdir, stdout=subprocess.DEVNULL)
+        time.sleep(1)
+
+        results = []
+        try:
+            for (name, locustfile) in SCENARIOS:
+                print(f"Running {name} for {args.duration}s with {args.locust_users} users...", flush=True)
+                num_requests, cpu_seconds = run_scenario(args, workdir, env, name, locustfile)
+                cpu_utilisation = cpu_seconds / args.duration
+                rps = num_requests / args.duration
+                results.append((name, rps, cpu_utilisation,
+                                rps / cpu_utilisation if cpu_utilisation > 0 else float("inf")))
+        finally:
+            homeserver.terminate()
+
+    print()
+    print(f"{'Scenario':<12} {'req/s':>10} {'worker CPU':>11} {'max req/s/core':>15}")
+    for (name, rps, cpu_utilisation, rps_per_core) in results:
+        print(f"{name:<12} {rps:>10.1f} {cpu_utilisation * 100:>10.1f}% {rps_per_core:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/bin/env python3
+
+################################################################################
+#
+# hot_paths.py - Microbenchmarks for the client-side hot paths of MatrixUser
+#
+# The load generator spends most of its CPU time in a few MatrixUser methods:
+# decoding and handling /sync responses, load_data_for_room(),
+# get_random_roomid() and building requests in _matrix_api_call().  This
+# script runs those methods
+# offline, with the network stubbed out, over synthetic /sync bodies for a
+# range of room counts (with room sizes drawn from rooms.json), or over /sync
+# bodies that were captured from a real server.
+#
+# For every benchmark it reports operations/sec, the net number of memory
+# blocks that each operation leaves allocated (retained, not allocations), and
+# peak traced memory.  Results can be saved as a baseline, and
+# compared against a stored baseline to fail on regressions, e.g.
+#
+#   python3 benchmarks/hot_paths.py --save-baseline benchmarks/baseline.json
+#   python3 benchmarks/hot_paths.py --baseline benchmarks/baseline.json --max-regression 0.2
+#
+################################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from locust.env import Environment
+
+import matrixuser
+from json_codec import CODEC_NAMES, get_codec
+from matrixuser import MatrixUser
+
+SERVER_NAME = "bench.local"
+PARETO_ALPHA = 1.161
+
+
+AVATAR_URL_RESPONSE = json.dumps({ "avatar_url": "mxc://%s/avatar" % SERVER_NAME }).encode("utf-8")
+DISPLAYNAME_RESPONSE = json.dumps({ "displayname": "Someone" }).encode("utf-8")
+
+
+class FakeResponse:
+    """Just enough of Locust's FastResponse for MatrixUser"""
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+        self.error = None
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def success(self):
+        pass
+
+    def failure(self, _message):
+        pass
+
+
+class FakeClient:
+    """Stubs out the network: every request returns the user's canned response body"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def request(self, method, url, **kwargs):
+        if self.user.next_response is not None:
+            content = self.user.next_response
+        elif "/avatar_url" in url:
+            content = AVATAR_URL_RESPONSE
+        elif "/displayname" in url:
+            content = DISPLAYNAME_RESPONSE
+        else:
+            content = b"{}"
+        return contextlib.nullcontext(FakeResponse(content))
+
+
+class BenchUser(MatrixUser):
+    host = "http://127.0.0.1"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = FakeClient(self)
+        self.next_response = None
+
+
+def load_room_sizes(path, rng):
+    if path is not None and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as jsonfile:
+            return [len(members) for members in json.load(jsonfile).values()]
+    # Same distribution as generate_rooms.py
+    return [max(2, round(rng.paretovariate(PARETO_ALPHA))) for _ in range(1000)]
+
+
+def make_message(rng, room_id, sender, index):
+    return {
+        "type": "m.room.message",
+        "sender": sender,
+        "event_id": "$%d:%s" % (index, SERVER_NAME),
+        "room_id": room_id,
+        "origin_server_ts": 1700000000000 + index,
+        "content": { "msgtype": "m.text", "body": "x" * max(1, round(rng.lognormvariate(3.0, 1.0))) },
+    }
+
+
+def make_sync_body(rng, room_sizes, num_rooms, events_per_room, initial):
+    """Generates an encoded /sync response body for a user in num_rooms rooms"""
+    rooms = {}
+    for i in range(num_rooms):
+        room_id = "!room%d:%s" % (i, SERVER_NAME)
+        size = rng.choice(room_sizes)
+        senders = ["@user.%06d:%s" % (rng.randrange(max(size, 2)), SERVER_NAME) for _ in range(events_per_room)]
+        room = { "timeline": { "events": [make_message(rng, room_id, sender, rng.randrange(1 << 30))
+                                          for sender in senders] } }
+        if initial:
+            room["state"] = { "events": [{ "type": "m.room.name", "state_key": "", "content": { "name": "Room %d" % i } }] }
+            room["summary"] = { "m.joined_member_count": size }
+        rooms[room_id] = room
+    body = { "next_batch": "s%d" % rng.randrange(1 << 30), "rooms": { "join": rooms, "invite": {} } }
+    return json.dumps(body).encode("utf-8")
+
+
+def new_user(environment, initial_body=None):
+    user = BenchUser(environment)
+    user.username = "user.000000"
+    user.user_id = "@user.000000:%s" % SERVER_NAME
+    user.access_token = "token"
+    if initial_body is not None:
+        user.next_response = initial_body
+        user.sync()
+        user.next_response = None
+    return user
+
+
+def measure(function, min_time):
+    """Returns (ops/sec, net retained blocks per op, peak KiB) for a benchmark function"""
+    # Calibrate the number of iterations to run for at least min_time seconds
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        iterations *= 2
+    ops_per_sec = iterations / elapsed
+
+    # Measure memory separately, since tracing slows everything down.  The block count is what the
+    # operations keep rather than what they allocate, and a GC pass in the middle can make it negative.
+    sample = max(1, min(iterations, 100))
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    for _ in range(sample):
+        function()
+    retained_blocks_per_op = (sys.getallocatedblocks() - blocks_before) / sample
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ops_per_sec, retained_blocks_per_op, peak / 1024
+
+
+def build_benchmarks(args, environment, rng):
+    room_sizes = load_room_sizes(args.rooms, rng)
+    recorded_bodies = None
+    if args.sync_bodies is not None:
+        with open(args.sync_bodies, "r", encoding="utf-8") as jsonfile:
+            recorded_bodies = [json.dumps(body).encode("utf-8") for body in json.load(jsonfile)]
+
+    benchmarks = []
+    for num_rooms in args.room_counts:
+        initial_body = make_sync_body(rng, room_sizes, num_rooms, args.events_per_room, initial=True)
+        if recorded_bodies is not None:
+            incremental_bodies = recorded_bodies
+        else:
+            incremental_bodies = [make_sync_body(rng, room_sizes, rng.randint(1, 3), 1, initial=False)
+                                  for _ in range(64)]
+
+        def initial_sync(initial_body=initial_body):
+            new_user(environment, initial_body)
+
+        user = new_user(environment, initial_body)
+        bodies = iter([])
+        def incremental_sync(user=user, incremental_bodies=incremental_bodies):
+            nonlocal bodies
+            body = next(bodies, None)
+            if body is None:
+                bodies = iter(incremental_bodies)
+                body = next(bodies)
+            user.next_response = body
+            user.sync()
+            user.next_response = None
+
+        room_ids = list(user.joined_room_ids)
+        def load_data_for_room(user=user, room_ids=room_ids):
+            user.load_data_for_room(rng.choice(room_ids))
+
+        def get_random_roomid(user=user):
+            user.get_random_roomid()
+
+        typing_url = "/_matrix/client/v3/rooms/%s/typing/%s" % (room_ids[0], user.user_id)
+        def matrix_api_call(user=user, typing_url=typing_url):
+            with user._matrix_api_call("PUT", typing_url, body={ "timeout": 10000, "typing": True },
+                                       name="/_matrix/client/v3/rooms/_/typing/_") as _response:
+                pass
+
+        benchmarks += [
+            ("sync_initial[%d rooms]" % num_rooms, initial_sync),
+            ("sync_incremental[%d rooms]" % num_rooms, incremental_sync),
+            ("load_data_for_room[%d rooms]" % num_rooms, load_data_for_room),
+            ("get_random_roomid[%d rooms]" % num_rooms, get_random_roomid),
+            ("matrix_api_call[%d rooms]" % num_rooms, matrix_api_call),
+        ]
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the MatrixUser hot paths")
+    parser.add_argument("--room-counts", type=lambda s: [int(n) for n in s.split(",")], default=[10, 100, 500],
+                        help="Comma-separated numbers of joined rooms to benchmark")
+    parser.add_argument("--events-per-room", type=int, default=10,
+                        help="Timeline events per room in the initial /sync")
+    parser.add_argument("--rooms", type=str, default="rooms.json",
+                        help="rooms.json to draw the room sizes from")
+    parser.add_argument("--sync-bodies", type=str, default=None,
+                        help="JSON list of captured incremental /sync response bodies to use instead of synthetic ones")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="Minimum run time of each benchmark in seconds")
+    parser.add_argument("--json-codec", type=str, choices=CODEC_NAMES, default="auto",
+                        help="JSON library to benchmark MatrixUser with")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic payloads")
+    parser.add_argument("--filter", type=str, default=None,
+                        help="Only run the benchmarks whose name contains this string")
+    parser.add_argument("--save-baseline", type=str, default=None,
+                        help="Save the results to this baseline file")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Compare the results against this baseline file")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Fail if ops/sec drops, or peak memory grows, by more than this fraction of the baseline")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    matrixuser.codec = get_codec(args.json_codec)
+    print(f"Using the {matrixuser.codec.name} JSON codec")
+    environment = Environment(user_classes=[BenchUser])
+    benchmarks = build_benchmarks(args, environment, rng)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as jsonfile:
+            baseline = json.load(jsonfile)
+
+    results = {}
+    regressions = []
+    print(f"{'Benchmark':<36} {'ops/sec':>12} {'net retained blocks/op':>23} {'peak KiB':>10} {'vs baseline':>12}")
+    for (name, function) in benchmarks:
+        if args.filter is not None and args.filter not in name:
+            continue
+        ops_per_sec, retained_blocks_per_op, peak_kib = measure(function, args.min_time)
+        results[name] = { "ops_per_sec": ops_per_sec, "retained_blocks_per_op": retained_blocks_per_op,
+                          "peak_kib": peak_kib }
+
+        comparison = ""
+        base = baseline.get(name, None)
+        if base is not None:
+            change = ops_per_sec / base["ops_per_sec"] - 1
+            comparison = f"{change * 100:+.1f}%"
+            if change < -args.max_regression:
+                regressions.append(f"{name}: {ops_per_sec:.0f} ops/sec vs {base['ops_per_sec']:.0f} in the baseline")
+            if peak_kib > base["peak_kib"] * (1 + args.max_regression) and peak_kib - base["peak_kib"] > 64:
+                regressions.append(f"{name}: peak memory {peak_kib:.0f} KiB vs {base['peak_kib']:.0f} KiB in the baseline")
+        print(f"{name:<36} {ops_per_sec:>12.1f} {retained_blocks_per_op:>23.1f} {peak_kib:>10.1f} {comparison:>12}",
+              flush=True)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w", encoding="utf-8") as jsonfile:
+            json.dump(results, jsonfile, indent=2, sort_keys=True)
+
+    if len(regressions) > 0:
+        print("\nRegressions:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/bin/env python3
+
+################################################################################
+#
+# bulk_register.py - Fast provisioning of the users in users.csv
+#
+# Registering users through the client-server API with register.py needs two
+# requests per user (the 401 UIAA challenge, then m.login.dummy) and a Locust
+# user per account.  This script instead uses the homeserver's admin
+# registration endpoints with many concurrent requests:
+#
+#   * --shared-secret: the shared-secret registration API
+#     (/_synapse/admin/v1/register, supported by Synapse and Dendrite)
+#   * --admin-token: the admin user API (/_synapse/admin/v2/users/...) as an
+#     existing admin user, followed by an admin login as the new user
+#
+# The credentials are appended to tokens.csv as soon as each user is created,
+# so an interrupted run can simply be restarted: users that are already in
+# tokens.csv are skipped.  Try it against the mock homeserver, which supports
+# both modes (its --admin-token creates an admin user with that token):
+#
+#   python3 mock_homeserver.py --port 8008 --admin-token admin &
+#   python3 bulk_register.py --host http://127.0.0.1:8008 --shared-secret mock
+#   python3 bulk_register.py --host http://127.0.0.1:8008 --admin-token admin
+#
+################################################################################
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import gevent
+import gevent.pool
+from geventhttpclient import HTTPClient, URL
+
+from registration import registration_mac
+
+TOKENS_CSV_HEADER = ["username", "user_id", "access_token", "sync_token"]
+
+
+class BulkRegistration:
+
+    def __init__(self, host, concurrency, shared_secret=None, admin_token=None):
+        url = URL(host)
+        self.client = HTTPClient.from_url(url, concurrency=concurrency,
+                                          connection_timeout=30, network_timeout=120)
+        self.shared_secret = shared_secret
+        self.admin_token = admin_token
+        self.server_name = None
+
+        self.num_done = 0
+        self.num_failed = 0
+
+    def _call(self, method, path, body=None, access_token=None):
+        headers = { "Content-Type": "application/json", "Accept": "application/json" }
+        if access_token is not None:
+            headers["Authorization"] = "Bearer %s" % access_token
+        payload = b"" if body is None else json.dumps(body)
+        response = self.client.request(method, path, body=payload, headers=headers)
+        try:
+            data = response.read()
+        finally:
+            response.release()
+        return response.status_code, json.loads(data) if data else {}
+
+    def discover_server_name(self):
+        status, js = self._call("GET", "/_matrix/client/v3/account/whoami", access_token=self.admin_token)
+        if status != 200:
+            raise RuntimeError(f"Admin token was rejected by /whoami: {status} {js}")
+        self.server_name = js["user_id"].split(":", 1)[1]
+
+    def register_with_shared_secret(self, username, password):
+        status, js = self._call("GET", "/_synapse/admin/v1/register")
+        if status != 200:
+            raise RuntimeError(f"GET /register nonce failed: {status} {js}")
+        nonce = js["nonce"]
+        body = {
+            "nonce": nonce,
+            "username": username,
+            "password": password,
+            "admin": False,
+            "mac": registration_mac(self.shared_secret, nonce, username, password),
+        }
+        status, js = self._call("POST", "/_synapse/admin/v1/register", body)
+        if status != 200:
+            raise RuntimeError(f"POST /register failed: {status} {js}")
+        return js["user_id"], js["access_token"]
+
+    def register_with_admin_token(self, username, password):
+        user_id = f"@{username}:{self.server_name}"
+        quoted_user_id = urllib.parse.quote(user_id)
+        status, js = self._call("PUT", f"/_synapse/admin/v2/users/{quoted_user_id}",
+                                { "password": password, "admin": False }, access_token=self.admin_token)
+        if status not in (200, 201):
+            raise RuntimeError(f"PUT /users failed: {status} {js}")
+        status, js = self._call("POST", f"/_synapse/admin/v1/users/{quoted_user_id}/login", {},
+                                access_token=self.admin_token)
+        if status != 200:
+            raise RuntimeError(f"POST /login as user failed: {status} {js}")
+        return user_id, js["access_token"]
+
+    def register(self, user, writer, tokens_file):
+        username = user["username"]
+        try:
+            if self.shared_secret is not None:
+                user_id, access_token = self.register_with_shared_secret(username, user["password"])
+            else:
+                user_id, access_token = self.register_with_admin_token(username, user["password"])
+        except Exception as e:
+            self.num_failed += 1
+            print(f"Error registering user {username}: {e}", file=sys.stderr)
+            return
+
+        # Stream the credentials into the token store right away
+        writer.writerow({ "username": username, "user_id": user_id,
+                          "access_token": access_token, "sync_token": "" })
+        tokens_file.flush()
+        self.num_done += 1
+
+    def report_progress(self, total, start_time, interval):
+        while True:
+            gevent.sleep(interval)
+            self.print_progress(total, start_time)
+
+    def print_progress(self, total, start_time):
+        elapsed = time.perf_counter() - start_time
+        rate = self.num_done / elapsed if elapsed > 0 else 0.0
+        remaining = total - self.num_done - self.num_failed
+        eta = remaining / rate if rate > 0 else float("inf")
+        print(f"[{elapsed:8.1f}s] {self.num_done}/{total} registered, {self.num_failed} failed, "
+              f"{rate:.1f} users/s, ETA {eta:.0f}s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registers the users in users.csv through the admin APIs")
+    parser.add_argument("--host", type=str, required=True,
+                        help="URL of the homeserver (e.g. 'https://www.example.com')")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--shared-secret", type=str,
+                      help="The homeserver's registration shared secret")
+    mode.add_argument("--admin-token", type=str,
+                      help="Access token of an existing admin user")
+    parser.add_argument("-c", "--concurrency", type=int, default=256,
+                        help="Number of concurrent registrations")
+    parser.add_argument("-u", "--users", type=str, default="users.csv",
+                        help="Input .csv file of usernames and passwords")
+    parser.add_argument("-t", "--tokens", type=str, default="tokens.csv",
+                        help="Token store to append the credentials to")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="Seconds between progress reports")
+    args = parser.parse_args()
+
+    host = args.host if args.host.startswith("http://") or args.host.startswith("https://") \
+                     else f"https://{args.host}"
+
+    # Skip the users that we already registered on a previous run
+    registered = set()
+    if os.path.exists(args.tokens):
+        with open(args.tokens, "r", encoding="utf-8") as csvfile:
+            registered = set(row["username"] for row in csv.DictReader(csvfile) if row["access_token"])
+
+    with open(args.users, "r", encoding="utf-8") as csvfile:
+        users = [user for user in csv.DictReader(csvfile) if user["username"] not in registered]
+    print(f"Registering {len(users)} users ({len(registered)} already in {args.tokens})")
+
+    registration = BulkRegistration(host, args.concurrency, args.shared_secret, args.admin_token)
+    if args.admin_token is not None:
+        registration.discover_server_name()
+
+    write_header = not os.path.exists(args.tokens) or os.path.getsize(args.tokens) == 0
+    with open(args.tokens, "a", encoding="utf-8") as tokens_file:
+        writer = csv.DictWriter(tokens_file, fieldnames=TOKENS_CSV_HEADER)
+        if write_header:
+            writer.writeheader()
+
+        start_time = time.perf_counter()
+        progress = gevent.spawn(registration.report_progress, len(users), start_time, args.progress_interval)
+        pool = gevent.pool.Pool(args.concurrency)
+        for user in users:
+            pool.spawn(registration.register, user, writer, tokens_file)
+        pool.join()
+        progress.kill()
+        registration.print_progress(len(users), start_time)
+
+    return 0 if registration.num_failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
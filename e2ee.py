@@ -0,0 +1,173 @@
+################################################################################
+#
+# e2ee.py - Simulated end-to-end encryption for the Matrix users
+#
+# Most real-world rooms are end-to-end encrypted, and for the server the most
+# expensive part of that is not the encrypted room events themselves but the
+# key management around them: uploading device and one-time keys, querying the
+# devices of every room member, claiming one-time keys, and fanning out the
+# room keys to every device as to-device messages.
+#
+# The load generator does none of the actual cryptography.  Keys, signatures
+# and ciphertexts are opaque slices of one pre-generated pool of base64 text,
+# sized like the output of Olm and Megolm for the same plaintext, so the server
+# sees requests with the right shape and size while our workers spend no CPU on
+# crypto.  Identity keys are derived from the user and device ids, so a device
+# uploads the same keys on every run.
+#
+################################################################################
+
+import base64
+import hashlib
+import random
+import time
+
+MEGOLM_ALGORITHM = "m.megolm.v1.aes-sha2"
+OLM_ALGORITHM = "m.olm.v1.curve25519-aes-sha2"
+ONE_TIME_KEY_ALGORITHM = "signed_curve25519"
+
+# Content of the m.room.encryption state event, with Element's default rotation periods
+ENCRYPTION_STATE_CONTENT = {
+    "algorithm": MEGOLM_ALGORITHM,
+    "rotation_period_ms": 7 * 24 * 3600 * 1000,
+    "rotation_period_msgs": 100,
+}
+
+# Sizes, in characters of unpadded base64
+KEY_LENGTH = 43             # Curve25519 and Ed25519 public keys
+SIGNATURE_LENGTH = 86       # Ed25519 signatures
+
+# Olm and Megolm overheads, in bytes, before base64 encoding
+MEGOLM_OVERHEAD = 1 + 5 + 2 + 8 + 64    # Version, message index, ciphertext tag, MAC, Ed25519 signature
+OLM_OVERHEAD = 1 + 2 + 5 + 2 + 32 + 8   # Version, ratchet key, chain index, ciphertext tag, MAC
+OLM_PRE_KEY_OVERHEAD = 3 * (2 + 32)     # One-time key, base key and identity key of a pre-key message
+EVENT_WRAPPER_LENGTH = 40   # The type, content and room_id keys around an encrypted event's plaintext
+
+# The plaintext of an m.room_key to-device event: a Megolm session key (229 bytes, in base64),
+# the session and room ids, and the sender and recipient keys
+ROOM_KEY_PLAINTEXT_LENGTH = 690
+
+# Element and the Rust SDK upload one-time keys until the server holds half of the 100 that Olm keeps
+ONE_TIME_KEY_TARGET = 50
+
+# Room keys go out in to-device requests of at most this many devices, like the Rust SDK does
+TO_DEVICE_BATCH_SIZE = 250
+
+# Random pool of base64 text that all the keys and ciphertexts are sliced from
+BLOB_POOL_SIZE = 256 * 1024
+blob_rng = random.Random()
+blob_pool = base64.b64encode(random.Random(0).randbytes(BLOB_POOL_SIZE * 3 // 4)).rstrip(b"=")
+
+
+def base64_length(num_bytes):
+    """Returns the length of num_bytes bytes in unpadded base64"""
+    return (num_bytes * 4 + 2) // 3
+
+
+def blob(length):
+    """Returns length bytes of opaque base64 text"""
+    # Ciphertexts longer than the pool (for enormous messages) repeat it
+    if length > len(blob_pool):
+        return (blob_pool * (length // len(blob_pool) + 1))[:length]
+    offset = blob_rng.randrange(len(blob_pool) - length + 1)
+    return blob_pool[offset:offset + length]
+
+
+def megolm_ciphertext_length(plaintext_length):
+    """Returns the base64 length of a Megolm message for an event with the given content length"""
+    padded = (plaintext_length + EVENT_WRAPPER_LENGTH) // 16 * 16 + 16
+    return base64_length(padded + MEGOLM_OVERHEAD)
+
+
+def olm_ciphertext_length(plaintext_length, pre_key):
+    """Returns the base64 length of an Olm message for the given plaintext length"""
+    padded = plaintext_length // 16 * 16 + 16
+    return base64_length(padded + OLM_OVERHEAD + (OLM_PRE_KEY_OVERHEAD if pre_key else 0))
+
+
+def derived_key(*parts):
+    """Returns a fake public key that only depends on the given strings"""
+    digest = hashlib.sha256(":".join(parts).encode("utf-8")).digest()
+    return base64.b64encode(digest).decode("ascii").rstrip("=")
+
+
+class DeviceIdentity:
+    """The identity keys of one of our devices, and the one-time keys that it has uploaded"""
+
+    __slots__ = ("user_id", "device_id", "curve25519", "ed25519", "next_key_number")
+
+    def __init__(self, user_id, device_id):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.curve25519 = derived_key("curve25519", user_id, device_id)
+        self.ed25519 = derived_key("ed25519", user_id, device_id)
+        # One-time key ids must never be reused, even across runs
+        self.next_key_number = int(time.time() * 1000) << 8
+
+    def signatures(self):
+        return { self.user_id: { "ed25519:" + self.device_id: blob(SIGNATURE_LENGTH).decode("ascii") } }
+
+    def device_keys(self):
+        """Returns the device_keys object for /keys/upload"""
+        return {
+            "user_id": self.user_id,
+            "device_id": self.device_id,
+            "algorithms": [OLM_ALGORITHM, MEGOLM_ALGORITHM],
+            "keys": {
+                "curve25519:" + self.device_id: self.curve25519,
+                "ed25519:" + self.device_id: self.ed25519,
+            },
+            "signatures": self.signatures(),
+        }
+
+    def one_time_keys(self, count):
+        """Returns count new signed one-time keys for /keys/upload"""
+        keys = {}
+        for _ in range(count):
+            key_id = base64.b64encode(self.next_key_number.to_bytes(8, "big")).decode("ascii").rstrip("=")
+            self.next_key_number += 1
+            keys[ONE_TIME_KEY_ALGORITHM + ":" + key_id] = {
+                "key": blob(KEY_LENGTH).decode("ascii"),
+                "signatures": self.signatures(),
+            }
+        return keys
+
+
+class OutboundSession:
+    """A Megolm session that we encrypt our messages in one room with"""
+
+    __slots__ = ("session_id", "message_count", "shared_with")
+
+    def __init__(self):
+        self.session_id = blob(KEY_LENGTH).decode("ascii")
+        self.message_count = 0
+        self.shared_with = set()    # (user_id, device_id) of the devices that have the session key
+
+    def needs_rotation(self):
+        return self.message_count >= ENCRYPTION_STATE_CONTENT["rotation_period_msgs"]
+
+
+def megolm_content_prefix(identity, session, plaintext_length):
+    """Returns the pre-encoded content of an m.room.encrypted event, without its closing brace
+
+    Like encode_content_prefix(), so that stamp_encoded_content() can add the delivery latency
+    fields.  Those are in the clear, unlike in a real client, so that receivers can measure the
+    delivery latency without decrypting anything.
+    """
+    return b'{"algorithm":"%s","ciphertext":"%s","device_id":"%s","sender_key":"%s","session_id":"%s"' % (
+        MEGOLM_ALGORITHM.encode("ascii"), blob(megolm_ciphertext_length(plaintext_length)),
+        identity.device_id.encode("utf-8"), identity.curve25519.encode("ascii"), session.session_id.encode("ascii"))
+
+
+def olm_content(identity, recipient_key, pre_key):
+    """Returns the content of an m.room.encrypted to-device event that carries a room key"""
+    return {
+        "algorithm": OLM_ALGORITHM,
+        "sender_key": identity.curve25519,
+        "ciphertext": {
+            recipient_key: {
+                "type": 0 if pre_key else 1,
+                "body": blob(olm_ciphertext_length(ROOM_KEY_PLAINTEXT_LENGTH, pre_key)).decode("ascii"),
+            }
+        },
+    }
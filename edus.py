@@ -0,0 +1,114 @@
+################################################################################
+#
+# edus.py - Rates of the typing, presence and receipt EDUs that the users
+# send and receive
+#
+# Typing notifications, presence updates and read receipts are ephemeral data
+# units (EDUs): the server doesn't store them in the room timeline, but it fans
+# every one of them out to all the users who share a room with the sender, and
+# on to the other servers in the room.  A single typing notification in a room
+# of 1000 users ends up in 1000 /sync responses.
+#
+# MatrixUser counts the EDUs that it sends, and the ones that arrive in its
+# /sync responses, and the time that it spends syncing.  Workers send their
+# counters to the master along with the regular Locust reports, and the master
+# writes the totals and the rates per user to <csv prefix>_edus.csv at the end
+# of the test.  The rates per user are per minute of /sync, so users that are
+# still logging in or that have stopped don't dilute them.
+#
+################################################################################
+
+import csv
+import logging
+import time
+
+from locust import events
+from locust.runners import WorkerRunner
+
+CSV_HEADER = ["Direction", "Type", "Count", "Per Second", "Per User Per Minute"]
+
+SENT = "sent"
+RECEIVED = "received"
+
+# (direction, EDU type) -> count
+counters = {}
+
+# Seconds that the users have spent syncing, added up over all users
+sync_seconds = 0.0
+
+# When the test started, for the rates per second
+start_time = None
+
+
+def count_sent(edu_type, count=1):
+    counters[(SENT, edu_type)] = counters.get((SENT, edu_type), 0) + count
+
+
+def count_received(sync_json):
+    """Counts the EDUs in a /sync response: presence, and the ephemeral events of the joined rooms"""
+    presence = sync_json.get("presence", {}).get("events", [])
+    if len(presence) > 0:
+        counters[(RECEIVED, "m.presence")] = counters.get((RECEIVED, "m.presence"), 0) + len(presence)
+    for room in sync_json.get("rooms", {}).get("join", {}).values():
+        for event in room.get("ephemeral", {}).get("events", []):
+            key = (RECEIVED, event.get("type", "unknown"))
+            counters[key] = counters.get(key, 0) + 1
+
+
+def add_sync_time(seconds):
+    global sync_seconds
+    sync_seconds += seconds
+
+
+def stats_rows(duration):
+    """Returns one row per (direction, EDU type), in CSV_HEADER order"""
+    rows = []
+    for (direction, edu_type), count in sorted(counters.items()):
+        rows.append([direction, edu_type, count,
+                     round(count / duration, 2) if duration > 0 else "",
+                     round(count * 60 / sync_seconds, 3) if sync_seconds > 0 else ""])
+    return rows
+
+
+# Locust event hooks ###########################################################
+
+@events.report_to_master.add_listener
+def on_report_to_master(client_id, data):
+    global sync_seconds
+    data["edus"] = [[*key, count] for (key, count) in counters.items()]
+    data["edu_sync_seconds"] = sync_seconds
+    counters.clear()
+    sync_seconds = 0.0
+
+
+@events.worker_report.add_listener
+def on_worker_report(client_id, data):
+    global sync_seconds
+    for (direction, edu_type, count) in data.get("edus", []):
+        counters[(direction, edu_type)] = counters.get((direction, edu_type), 0) + count
+    sync_seconds += data.get("edu_sync_seconds", 0.0)
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global sync_seconds, start_time
+    counters.clear()
+    sync_seconds = 0.0
+    start_time = time.time()
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **_kwargs):
+    if isinstance(environment.runner, WorkerRunner) or start_time is None:
+        return
+    rows = stats_rows(time.time() - start_time)
+    for row in rows:
+        logging.info("EDUs %s: %s %d (%s per user per minute)", row[0], row[1], row[2], row[4])
+    csv_prefix = getattr(environment.parsed_options, "csv_prefix", None)
+    if csv_prefix:
+        path = f"{csv_prefix}_edus.csv"
+        logging.info("Writing EDU statistics to %s", path)
+        with open(path, "w", encoding="utf-8", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(rows)
@@ -0,0 +1,147 @@
+#!/bin/env python3
+
+################################################################################
+#
+# generate_messages.py - Generates the message corpus for the chat users
+#
+# Writes a corpus of pre-encoded m.room.message contents (see
+# message_corpus.py) with a realistic mix of plain text, HTML formatted
+# bodies, non-ASCII text, replies, edits and mentions.  Message lengths follow
+# a log-normal distribution, so most messages are short but a few are long.
+#
+#   python3 generate_messages.py 20000 --seed corpus --html-ratio 0.2
+#
+# Then run chat.py with --message-corpus messages.corpus
+#
+################################################################################
+
+import argparse
+import html
+import random
+import statistics
+
+from json_codec import encode_static
+from message_corpus import EVENT_ID_PLACEHOLDER, USER_ID_PLACEHOLDER, NEEDS_EVENT_ID, NEEDS_USER_ID, IS_EDIT
+from message_corpus import write_corpus
+
+LOREM_IPSUM_WORDS = """
+Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.
+""".split()
+
+# Words from a few other scripts, and some emoji
+UNICODE_WORDS = [
+  "café", "naïve", "Straße", "façade", "jalapeño", "smörgåsbord", "crème", "brûlée",
+  "привет", "мир", "спасибо", "хорошо", "γεια", "σου", "καλημέρα",
+  "你好", "世界", "谢谢", "こんにちは", "ありがとう", "안녕하세요", "감사합니다",
+  "مرحبا", "شكرا", "שלום", "नमस्ते", "धन्यवाद", "สวัสดี",
+  "😀", "😂", "🎉", "👍", "❤️", "🔥", "🤔", "🙈", "🚀", "👨‍👩‍👧‍👦", "🏳️‍🌈",
+]
+
+HTML_TAGS = ["b", "i", "code", "del", "u"]
+
+parser = argparse.ArgumentParser(description="Generates a corpus of pre-encoded chat messages")
+parser.add_argument("count", type=int, nargs="?", default=10000,
+                    help="Number of messages to generate")
+parser.add_argument("-o", "--output", type=str, default="messages.corpus",
+                    help="Corpus file to write")
+parser.add_argument("--seed", type=str, default=None,
+                    help="Seed for a reproducible corpus")
+parser.add_argument("--words-mu", type=float, default=1.5,
+                    help="Mu of the log-normal distribution of the number of words")
+parser.add_argument("--words-sigma", type=float, default=1.0,
+                    help="Sigma of the log-normal distribution of the number of words")
+parser.add_argument("--max-words", type=int, default=2000,
+                    help="Maximum number of words in a message")
+parser.add_argument("--unicode-ratio", type=float, default=0.2,
+                    help="Fraction of messages that mix in non-ASCII words and emoji")
+parser.add_argument("--html-ratio", type=float, default=0.1,
+                    help="Fraction of messages with an HTML formatted body")
+parser.add_argument("--reply-ratio", type=float, default=0.1,
+                    help="Fraction of messages that are replies")
+parser.add_argument("--edit-ratio", type=float, default=0.03,
+                    help="Fraction of messages that are edits of one of the sender's messages")
+parser.add_argument("--mention-ratio", type=float, default=0.05,
+                    help="Fraction of messages that mention another user")
+args = parser.parse_args()
+rng = random.Random(args.seed)
+
+
+def generate_words():
+  num_words = max(1, min(args.max_words, round(rng.lognormvariate(args.words_mu, args.words_sigma))))
+  unicode_mix = 0.3 if rng.random() < args.unicode_ratio else 0.0
+  return [rng.choice(UNICODE_WORDS) if rng.random() < unicode_mix else rng.choice(LOREM_IPSUM_WORDS)
+          for _ in range(num_words)]
+
+
+def format_words(words):
+  """Returns an HTML version of the words, with some of them marked up"""
+  parts = []
+  for word in words:
+    word = html.escape(word)
+    r = rng.random()
+    if r < 0.1:
+      tag = rng.choice(HTML_TAGS)
+      word = f"<{tag}>{word}</{tag}>"
+    elif r < 0.12:
+      word = f'<a href="https://example.com/{rng.randrange(1 << 20)}">{word}</a>'
+    parts.append(word)
+  return " ".join(parts)
+
+
+def generate_message():
+  """Returns (flags, content) for one message"""
+  words = generate_words()
+  body = " ".join(words)
+  formatted_body = format_words(words) if rng.random() < args.html_ratio else None
+
+  flags = 0
+  r = rng.random()
+  if r < args.mention_ratio:
+    flags = NEEDS_USER_ID
+    body = f"{USER_ID_PLACEHOLDER}: {body}"
+    pill = f'<a href="https://matrix.to/#/{USER_ID_PLACEHOLDER}">{USER_ID_PLACEHOLDER}</a>'
+    formatted_body = f"{pill}: {formatted_body or html.escape(' '.join(words))}"
+  elif r < args.mention_ratio + args.reply_ratio:
+    flags = NEEDS_EVENT_ID
+  elif r < args.mention_ratio + args.reply_ratio + args.edit_ratio:
+    flags = NEEDS_EVENT_ID | IS_EDIT
+
+  content = { "msgtype": "m.text" }
+  new_content = { "msgtype": "m.text", "body": body }
+  if formatted_body is not None:
+    new_content["format"] = "org.matrix.custom.html"
+    new_content["formatted_body"] = formatted_body
+
+  if flags & IS_EDIT:
+    content["body"] = f" * {body}"
+    if formatted_body is not None:
+      content["format"] = "org.matrix.custom.html"
+      content["formatted_body"] = f" * {formatted_body}"
+    content["m.new_content"] = new_content
+    content["m.relates_to"] = { "rel_type": "m.replace", "event_id": EVENT_ID_PLACEHOLDER }
+  else:
+    content.update(new_content)
+    if flags & NEEDS_EVENT_ID:
+      content["m.relates_to"] = { "m.in_reply_to": { "event_id": EVENT_ID_PLACEHOLDER } }
+    if flags & NEEDS_USER_ID:
+      content["m.mentions"] = { "user_ids": [USER_ID_PLACEHOLDER] }
+  return flags, content
+
+
+payloads = []
+for i in range(args.count):
+  flags, content = generate_message()
+  # Drop the closing brace, so that the senders can append their timestamps
+  payloads.append((flags, encode_static(content)[:-1]))
+write_corpus(args.output, payloads)
+
+sizes = [len(payload) + 1 for (_, payload) in payloads]
+print("###################################")
+print("%d messages written to %s" % (len(payloads), args.output))
+print("Replies = %d" % sum(1 for (flags, _) in payloads if flags & NEEDS_EVENT_ID and not flags & IS_EDIT))
+print("Edits = %d" % sum(1 for (flags, _) in payloads if flags & IS_EDIT))
+print("Mentions = %d" % sum(1 for (flags, _) in payloads if flags & NEEDS_USER_ID))
+print("Median size = %d bytes" % statistics.median(sizes))
+print("Mean size = %.1f bytes" % statistics.mean(sizes))
+print("Max size = %d bytes" % max(sizes))
+print("###################################")
@@ -1,5 +1,6 @@
 #!/bin/env python3
 
+import argparse
 import os
 import sys
 import glob
@@ -10,6 +11,13 @@ import random
 
 PARETO_ALPHA = 1.161 # 80/20 rule.  See also: https://en.wikipedia.org/wiki/Pareto_distribution#Relation_to_the_%22Pareto_principle%22
 
+parser = argparse.ArgumentParser(
+    description="Generates the rooms and their members for the users in users.csv")
+parser.add_argument("--seed", type=str, default=None,
+                    help="Seed for reproducible room sizes and memberships")
+args = parser.parse_args()
+rng = random.Random(args.seed)
+
 # First load the roster of users from users.csv
 users = []
 with open("users.csv", "r") as csvfile:
@@ -26,7 +34,7 @@ max_num_rooms = num_users
 room_sizes = []
 room_sizes_sum = 0.0
 for i in range(max_num_rooms):
-  s = round(random.paretovariate(PARETO_ALPHA))
+  s = round(rng.paretovariate(PARETO_ALPHA))
   if s > num_users:
     s = num_users
   if s < 2:
@@ -50,7 +58,7 @@ room_members = {}
 for i in range(num_rooms):
   room_name = "Room %d" % i
   num_members = room_sizes[i]
-  room_members[room_name] = random.sample(users, num_members)
+  room_members[room_name] = rng.sample(users, num_members)
 
 # Save the room assignments to a file
 with open("rooms.json", "w") as jsonfile:
@@ -11,8 +11,11 @@ parser.add_argument("num_users", type=int, default=1000, nargs="?",
                     help="Number of users to generate")
 parser.add_argument("-o", "--output", type=str, default="users.csv", nargs="?",
                     help="Output .csv file path")
+parser.add_argument("--seed", type=str, default=None,
+                    help="Seed for reproducible passwords")
 
 args = parser.parse_args()
+rng = random.Random(args.seed)
 
 with open(args.output, "w", encoding="utf-8") as csvfile:
     fieldnames = ["username", "password"]
@@ -27,7 +30,7 @@ with open(args.output, "w", encoding="utf-8") as csvfile:
         #          passwords without eating up our system's entropy pool,
         #          and anyway these are accounts that we are going to
         #          throw away at the end of the test.
-        password = "".join(random.choices("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ", k=16))
+        password = "".join(rng.choices("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ", k=16))
         print(f"username = [{username}]\tpassword = [{password}]")
 
         # Access token will be populated when the user is registered
@@ -0,0 +1,83 @@
+################################################################################
+#
+# json_codec.py - Pluggable JSON encoding and decoding for Matrix API calls
+#
+# Decoding large /sync and /messages responses is the biggest CPU cost on our
+# workers.  MatrixUser encodes its request bodies and decodes the responses
+# through a JsonCodec, which uses the fastest JSON library available:
+#
+#   * orjson (pip install orjson)
+#   * ujson (pip install ujson)
+#   * the json module from the standard library
+#
+# Select one with --json-codec (the default, "auto", picks the first available
+# one).  Bodies that never change, like typing notifications, can be encoded
+# once with encode_static() and sent as bytes.
+#
+################################################################################
+
+import json
+import logging
+
+CODEC_NAMES = ["auto", "orjson", "ujson", "json"]
+
+
+class JsonCodec:
+    """Encodes objects to UTF-8 JSON bytes and decodes JSON bytes or strings, with one backend
+
+    Decoding errors are always raised as a ValueError (or a subclass of it).
+    """
+
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return f"JsonCodec({self.name})"
+
+
+def encode_static(obj):
+    """Encodes a body that never changes, so that it can be sent as bytes on every request"""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def stdlib_codec():
+    return JsonCodec("json", encode_static, json.loads)
+
+
+def orjson_codec():
+    import orjson
+    return JsonCodec("orjson", orjson.dumps, orjson.loads)
+
+
+def ujson_codec():
+    import ujson
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+    return JsonCodec("ujson", encode, ujson.loads)
+
+
+CODEC_FACTORIES = {
+    "orjson": orjson_codec,
+    "ujson": ujson_codec,
+    "json": stdlib_codec,
+}
+
+
+def get_codec(name="auto"):
+    """Returns the codec for the given backend, falling back to the standard library"""
+    candidates = ["orjson", "ujson"] if name == "auto" else [name]
+    for candidate in candidates:
+        factory = CODEC_FACTORIES.get(candidate, None)
+        if factory is None:
+            logging.warning("Unknown JSON codec '%s', using the standard library", candidate)
+            continue
+        try:
+            return factory()
+        except ImportError:
+            if name != "auto":
+                logging.warning("JSON codec '%s' is not installed, using the standard library", candidate)
+    return stdlib_codec()
@@ -10,7 +10,9 @@ from locust import events
 from locust.runners import MasterRunner
 
 import gevent
-from matrixuser import MatrixUser
+import setup_journal
+from matrixuser import MatrixUser, load_rooms
+from setup_journal import room_alias_name
 
 # Preflight ####################################################################
 
@@ -31,16 +33,17 @@ def on_test_start(environment, **_kwargs):
 
         # Load our list of rooms to be created
         logging.info("Loading rooms list")
-        rooms = {}
-        with open("rooms.json", "r", encoding="utf-8") as rooms_jsonfile:
-            rooms = json.load(rooms_jsonfile)
+        rooms = load_rooms()
         logging.info("Success loading rooms list")
 
         # Now we need to sort of invert the list
         # We need a list of the rooms to be created by each user,
         # with the list of other users who should be invited to each
+        # Rooms that the journal says were created in an earlier run are skipped
         MatrixRoomCreatorUser.worker_rooms_for_users = {}
         for room_name, room_users in rooms.items():
+            if room_name in setup_journal.journal.rooms:
+                continue
             first_user = room_users[0]
             user_rooms = MatrixRoomCreatorUser.worker_rooms_for_users.get(first_user, [])
             room_info = {
@@ -80,6 +83,11 @@ class MatrixRoomCreatorUser(MatrixUser):
             gevent.sleep(999999)
             return
 
+        # Don't even log in if all our rooms exist already
+        my_rooms_info = MatrixRoomCreatorUser.worker_rooms_for_users.get(user["username"], [])
+        if len(my_rooms_info) == 0:
+            return
+
         self.login_from_csv(user)
 
         if self.username is None or self.password is None:
@@ -105,12 +113,11 @@ class MatrixRoomCreatorUser(MatrixUser):
                 uid = "@" + uid
             return uid
 
-        my_rooms_info = MatrixRoomCreatorUser.worker_rooms_for_users.get(self.username, [])
         #logging.info("User [%s] Found %d rooms to be created", self.username, len(my_rooms_info))
 
         for room_info in my_rooms_info:
             room_name = room_info["name"]
-            #room_alias = room_name.lower().replace(" ", "-")
+            room_alias = room_alias_name(room_name)
             usernames = room_info["users"]
             user_ids = list(map(username_to_userid, usernames))
             logging.info("User [%s] Creating room [%s] with %d users",
@@ -119,13 +126,15 @@ class MatrixRoomCreatorUser(MatrixUser):
             # Actually create the room
             retries = 3
             while retries > 0:
-                room_id = self.create_room(alias=None, room_name=room_name, user_ids=user_ids)
+                room_id = self.create_room(alias=room_alias, room_name=room_name, user_ids=user_ids,
+                                           encrypted=self.e2ee)
 
                 if room_id is None:
                     logging.info("[%s] Could not create room %s (attempt %d). Trying again...",
                                  self.username, room_name, 4 - retries)
                     retries -= 1
                 else:
+                    setup_journal.record(self.environment, { "type": "room", "name": room_name, "room_id": room_id })
                     break
 
             if retries == 0:
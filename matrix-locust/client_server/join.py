@@ -8,7 +8,8 @@ from locust import events
 from locust.runners import MasterRunner
 
 import gevent
-from matrixuser import MatrixUser
+import setup_journal
+from matrixuser import MatrixUser, load_rooms
 
 # Preflight ###############################################
 
@@ -49,6 +50,10 @@ class MatrixInviteAcceptorUser(MatrixUser):
             gevent.sleep(999999)
             return
 
+        # Don't even log in if the journal says we've joined all our rooms in an earlier run
+        if user["username"] in setup_journal.journal.joined_all:
+            return
+
         self.login_from_csv(user)
 
         if self.username is None or self.password is None:
@@ -62,8 +67,15 @@ class MatrixInviteAcceptorUser(MatrixUser):
             
             self.login(start_syncing = False, log_request=True)
 
-        # Call /sync to get our list of invited rooms
-        self.sync()
+        # Call /sync to get our list of invited rooms (again, if our access token had to be renewed)
+        for attempt in range(1, 4):
+            response = self.sync()
+            if response is not None and response.status_code == 200:
+                break
+            logging.info("[%s] Could not sync (attempt %d). Trying again...", self.username, attempt)
+        else:
+            logging.error("[%s] Error syncing. Skipping...", self.username)
+            return
 
         # Persist initial sync token for chat simulation
         token_update_request = { "username": self.username, "user_id": self.user_id,
@@ -75,6 +87,7 @@ class MatrixInviteAcceptorUser(MatrixUser):
 
         logging.info("User [%s] has %d pending invites",
                      self.username, len(self.invited_room_ids))
+        num_failed = 0
         for room_id in rooms_to_join:
             retries = 3
             while retries > 0:
@@ -85,8 +98,14 @@ class MatrixInviteAcceptorUser(MatrixUser):
                                  self.username, room_id, 4 - retries)
                     retries -= 1
                 else:
+                    setup_journal.record(self.environment, { "type": "join", "username": self.username,
+                                                             "room_id": room_id })
                     break
 
             if retries == 0:
                 logging.error("[%s] Error joining room %s. Skipping...", self.username, room_id)
+                num_failed += 1
+
+        if num_failed == 0 and setup_journal.joined_all_rooms(self, load_rooms()):
+            setup_journal.record(self.environment, { "type": "joined_all", "username": self.username })
 
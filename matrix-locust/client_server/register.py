@@ -55,10 +55,15 @@ class MatrixRegisterUser(MatrixUser):
             logging.error("Couldn't get username/password. Skipping...")
             return
 
+        shared_secret = self.environment.parsed_options.registration_shared_secret
+
         retries = 3
         while retries > 0:
             # Register with the server to get a user_id and access_token
-            self.register()
+            if shared_secret is None:
+                self.register()
+            else:
+                self.register_with_shared_secret(shared_secret)
 
             # The register() method sets user_id and access_token
             if self.user_id is not None and self.access_token is not None:
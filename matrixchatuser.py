@@ -31,18 +31,23 @@ import csv
 import os
 import sys
 import glob
-import random
 import resource
 
 import json
 import logging
+import time
 
 import gevent
+import gevent.lock
+import gevent.queue
 from locust import task, between, TaskSet
 from locust import events
+from locust.exception import StopUser
 from locust.runners import MasterRunner, WorkerRunner
 
-from matrixuser import MatrixUser
+from matrixuser import MatrixUser, compact_message, encode_content_prefix, stamp_encoded_content
+from message_corpus import MessageCorpus, NEEDS_EVENT_ID, NEEDS_USER_ID, IS_EDIT
+from room_metrics import room_size_bucket
 
 
 # Preflight ###############################################
@@ -61,6 +66,25 @@ def on_locust_init(environment, **_kwargs):
       # Open our list of users
       MatrixChatUser.worker_users = csv.DictReader(open("users.csv"))
 
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+  parser.add_argument("--message-corpus", type=str, default=None,
+                      help="Send the pre-encoded messages from this corpus (see generate_messages.py)")
+  parser.add_argument("--scroll-page-size", type=int, default=20,
+                      help="Number of events per /messages page when scrolling back through a room's history")
+  parser.add_argument("--scroll-max-pages", type=int, default=10,
+                      help="Maximum number of pages that a user scrolls back in one go")
+  parser.add_argument("--scroll-read-ahead", type=int, default=1,
+                      help="Number of pages to prefetch while the user reads the current one (0 to disable)")
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+  global message_corpus
+  corpus_path = getattr(environment.parsed_options, "message_corpus", None)
+  if corpus_path is not None and not isinstance(environment.runner, MasterRunner):
+    message_corpus = MessageCorpus(corpus_path)
+    logging.info("Loaded %d messages from %s", len(message_corpus), corpus_path)
+
 # Load our images and thumbnails
 images_folder = "images"
 image_files = glob.glob(os.path.join(images_folder, "*.jpg"))
@@ -86,6 +110,17 @@ lorem_ipsum_messages = {}
 for i in range(1, len(lorem_ipsum_words)+1):
   lorem_ipsum_messages[i] = " ".join(lorem_ipsum_words[:i])
 
+# The same messages as m.text content, pre-encoded to JSON (see stamp_encoded_content())
+lorem_ipsum_contents = {
+  i: encode_content_prefix({ "msgtype": "m.text", "body": message_text })
+  for (i, message_text) in lorem_ipsum_messages.items()
+}
+
+# Or a bigger and more varied set of messages, from --message-corpus
+message_corpus = None
+# How many times to pick from the corpus before giving up on finding a message that we can send
+CORPUS_PICK_ATTEMPTS = 5
+
 ###########################################################
 
 
@@ -117,6 +152,7 @@ class MatrixChatUser(MatrixUser):
     invalidate_access_tokens = False
 
     self.login_from_csv(user_dict)
+    self.seed_task_selection()
 
     if invalidate_access_tokens:
       self.user_id = None
@@ -132,14 +168,48 @@ class MatrixChatUser(MatrixUser):
     else:
       #logging.info("Logging in user [%s] with password [%s]" % (self.username, self.password))
 
-      while self.user_id is None or self.access_token is None:
+      if self.user_id is None or self.access_token is None:
         # The login() method sets user_id, device_id, and access_token
         # And if we ask it to, it also starts our "backgound" sync task
-        self.login(start_syncing = True, log_request = True)
-
+        # It retries with backoff, so if it fails, the server isn't letting us in
+        if not self.login(start_syncing = True, log_request = True):
+          raise StopUser()
+
+      if self.e2ee:
+        self.setup_encryption()
+
+
+  def pick_message_content(self, room_id):
+    """Returns the encoded and stamped content for our next m.text message in the given room
+
+        Replies and edits refer to one of the recent messages in the room (our own, for edits),
+        and mentions to the sender of one of them.
+    """
+    if message_corpus is not None:
+      messages = self.recent_messages.get(room_id, [])
+      for _ in range(CORPUS_PICK_ATTEMPTS):
+        flags, payload = message_corpus.pick(self.rng)
+        event_id = None
+        user_id = None
+        if flags & (NEEDS_EVENT_ID | NEEDS_USER_ID):
+          candidates = [m for m in messages if m.sender == self.user_id] if flags & IS_EDIT else messages
+          if len(candidates) > 0:
+            message = self.rng.choice(candidates)
+            event_id = message.event_id
+            user_id = message.sender
+        content = MessageCorpus.render(payload, flags, event_id, user_id)
+        if content is not None:
+          return stamp_encoded_content(content)
+
+    message_len = round(self.rng.lognormvariate(1.0, 1.0))
+    message_len = min(message_len, len(lorem_ipsum_words))
+    message_len = max(message_len, 1)
+    return stamp_encoded_content(lorem_ipsum_contents[message_len])
 
   def on_stop(self):
-    pass
+    # Sign off, so that the other users see us go offline
+    if self.presence is not None and self.access_token is not None:
+      self.set_presence("offline")
     # Currently we don't want to invalidate access tokens stored in the csv file
     # self.logout()
 
@@ -160,23 +230,15 @@ class MatrixChatUser(MatrixUser):
       return
     #logging.info("User [%s] sending a message to room [%s]" % (self.username, room_id))
 
-    # Send the typing notification like a real client would
-    self.set_typing(room_id, True)
-    # Sleep while we pretend the user is banging on the keyboard
-    delay = random.expovariate(1.0 / 5.0)
-    gevent.sleep(delay)
-
-    message_len = round(random.lognormvariate(1.0, 1.0))
-    message_len = min(message_len, len(lorem_ipsum_words))
-    message_len = max(message_len, 1)
-    message_text = lorem_ipsum_messages[message_len]
+    # Pretend the user is banging on the keyboard, with typing notifications like a real client would,
+    # and clear them just before we send
+    delay = self.rng.expovariate(1.0 / 5.0)
+    self.type_message(room_id, delay)
+    self.stop_typing()
 
     event = {
       "type": "m.room.message",
-      "content": {
-        "msgtype": "m.text",
-        "body": message_text,
-      }
+      "content": self.pick_message_content(room_id)
     }
     with self.send_matrix_event(room_id, event) as response:
       if "error" in response.js:
@@ -202,31 +264,107 @@ class MatrixChatUser(MatrixUser):
       return
 
     last_msg = messages[-1]
-    event_id = last_msg.get("event_id", None)
+    event_id = last_msg.event_id
     if event_id is not None:
       self.send_read_receipt(room_id, event_id)
 
 
 
-  # FIXME Combine look_at_room() and paginate_room() into a TaskSet,
-  #       so the user can paginate and scroll the room for a longer
-  #       period of time.
-  #       In this model, we should load the displaynames and avatars
-  #       and message thumbnails every time we paginate, just like a
-  #       real client would do as the user scrolls the timeline.
   @task
-  def paginate_room(self):
-    room_id = self.get_random_roomid()
-    token = self.earliest_sync_tokens.get(room_id, self.initial_sync_token)
-    if room_id is None or token is None:
-      return
-    url = "/_matrix/client/%s/rooms/%s/messages?dir=b&from=%s" % (self.matrix_version, room_id, token)
-    label = "/_matrix/client/%s/rooms/_/messages" % self.matrix_version
-    with self._matrix_api_call("GET", url, name=label) as response:
-      if not "chunk" in response.js:
-        logging.warning("User [%s] GET /messages failed for room %s" % (self.username, room_id))
-      if "end" in response.js:
-        self.earliest_sync_tokens[room_id] = response.js["end"]
+  class ScrollRoomHistory(TaskSet):
+    """Scrolls back through the history of a room, a page of /messages at a time
+
+        Like a real client, we prefetch the next pages while the user reads the current one, and
+        load the profiles and thumbnails for each page.  The time that the user waits for each page
+        to be ready is reported as a SCROLL request, for the first page and for the later ones.
+    """
+
+    def wait_time(self):
+      # Time spent reading a page before scrolling further
+      return self.user.rng.expovariate(1.0 / 3.0)
+
+    def on_start(self):
+      options = self.user.environment.parsed_options
+      self.page_size = getattr(options, "scroll_page_size", 20)
+      self.max_pages = getattr(options, "scroll_max_pages", 10)
+      self.read_ahead = getattr(options, "scroll_read_ahead", 1)
+      self.prefetcher = None
+
+      self.room_id = self.user.get_random_roomid()
+      if self.room_id is None:
+        self.interrupt()
+      self.token = self.user.earliest_sync_tokens.get(self.room_id, self.user.initial_sync_token)
+      if self.token is None:
+        self.interrupt()
+      self.bucket = room_size_bucket(self.user.get_room_size(self.room_id))
+
+      self.pages_loaded = 0
+      self.show_next_page("first page")
+      if self.read_ahead > 0 and self.token is not None:
+        # One slot per page that has been fetched, or is being fetched, but not shown yet
+        self.pages = gevent.queue.Queue()
+        self.read_ahead_slots = gevent.lock.BoundedSemaphore(self.read_ahead)
+        self.prefetcher = gevent.spawn(self.prefetch_pages, self.token)
+
+    def on_stop(self):
+      if self.prefetcher is not None:
+        self.prefetcher.kill()
+        self.prefetcher = None
+
+    def fetch_page(self, token):
+      """Returns the chunk, the end token and the body size of the page before the given token, or None on failure"""
+      url = "/_matrix/client/%s/rooms/%s/messages?dir=b&from=%s&limit=%d" % (self.user.matrix_version,
+                                                                           self.room_id, token, self.page_size)
+      label = "/_matrix/client/%s/rooms/_/messages" % self.user.matrix_version
+      with self.user._matrix_api_call("GET", url, name=label) as response:
+        if response.js is None or "chunk" not in response.js:
+          logging.warning("User [%s] GET /messages failed for room %s" % (self.user.username, self.room_id))
+          return None
+        return response.js["chunk"], response.js.get("end", None), len(response.content)
+
+    def prefetch_pages(self, token):
+      """(Greenlet) Stays up to read_ahead pages ahead of the user, counting the one that it is fetching"""
+      for _ in range(self.max_pages - 1):
+        self.read_ahead_slots.acquire()
+        page = self.fetch_page(token)
+        self.pages.put(page)
+        if page is None or page[1] is None:
+          return
+        token = page[1]
+
+    def show_next_page(self, name):
+      """Gets the next page (from the prefetcher, if it's running), loads its data, and reports how long it took"""
+      start = time.perf_counter()
+      if self.prefetcher is not None:
+        page = self.pages.get()
+        self.read_ahead_slots.release()
+      else:
+        page = self.fetch_page(self.token)
+      if page is None:
+        self.token = None
+        return
+      chunk, end, size = page
+      self.user.load_data_for_messages([compact_message(event) for event in chunk
+                                        if event.get("type", None) in ["m.room.message", "m.room.encrypted"]])
+      self.user.environment.events.request.fire(request_type="SCROLL",
+                                                name="%s [%s]" % (name, self.bucket),
+                                                response_time=(time.perf_counter() - start) * 1000,
+                                                response_length=size,
+                                                exception=None,
+                                                context={ "room_size_bucket": self.bucket })
+      self.pages_loaded += 1
+      self.token = end
+      if end is not None:
+        self.user.earliest_sync_tokens[self.room_id] = end
+
+    @task
+    def scroll_back(self):
+      if self.token is None or self.pages_loaded >= self.max_pages:
+        # We reached the beginning of the room, or the user has seen enough
+        self.interrupt()
+      self.show_next_page("next page")
+
+
 
   # Disabling accept_invites now that the join setup script works correctly
 
@@ -254,14 +392,19 @@ class MatrixChatUser(MatrixUser):
   def go_afk(self):
     logging.info("User [%s] going away from keyboard" % self.username)
     # Generate large(ish) random away time
-    away_time = random.expovariate(1.0 / 600.0)  # Expected value = 10 minutes
+    away_time = self.rng.expovariate(1.0 / 600.0)  # Expected value = 10 minutes
+    # Our client notices that we're idle, and tells the server, which tells everyone in our rooms
+    if self.presence is not None:
+      self.set_presence("unavailable")
     gevent.sleep(away_time)
+    if self.presence is not None:
+      self.set_presence("online")
 
 
   @task(1)
   def change_displayname(self):
     user_number = self.username.split(".")[-1]
-    random_number = random.randint(1,1000)
+    random_number = self.rng.randint(1,1000)
     new_name = "User %s (random=%d)" % (user_number, random_number)
     self.set_displayname(displayname=new_name)
 
@@ -270,12 +413,31 @@ class MatrixChatUser(MatrixUser):
   class ChatInARoom(TaskSet):
 
     def wait_time(self):
+      profile = self.user.profile
+      if profile is not None and profile.chat_wait_time is not None:
+        return max(0.0, profile.chat_wait_time(self.user.rng))
       expected_wait = 25.0
       rate = 1.0 / expected_wait
-      return random.expovariate(rate)
+      return self.user.rng.expovariate(rate)
 
     def on_start(self):
       #logging.info("User [%s] chatting in a room" % self.user.username)
+
+      # Each time we enter a room, the user generates a slightly different
+      # expected number of messages
+      rng = self.user.rng
+      profile = self.user.profile
+      if profile is not None and profile.chat_messages is not None:
+        num_texts = max(1, round(profile.chat_messages(rng)))
+      else:
+        num_texts = max(1, round(rng.gauss(15,4)))
+      self.weighted_tasks = (
+        [type(self).send_text] * num_texts +
+        [type(self).send_image] * rng.choice([0,0,0,1,1,2]) +
+        [type(self).send_reaction] * rng.choice([0,0,1,1,1,2,3]) +
+        [type(self).stop]
+      )
+
       if len(self.user.joined_room_ids) == 0:
         self.interrupt()
       else:
@@ -289,23 +451,14 @@ class MatrixChatUser(MatrixUser):
     @task
     def send_text(self):
 
-      # Send the typing notification like a real client would
-      self.user.set_typing(self.room_id, True)
-      # Sleep while we pretend the user is banging on the keyboard
-      delay = random.expovariate(1.0 / 5.0)
-      gevent.sleep(delay)
-
-      message_len = round(random.lognormvariate(1.0, 1.0))
-      message_len = min(message_len, len(lorem_ipsum_words))
-      message_len = max(message_len, 1)
-      message_text = lorem_ipsum_messages[message_len]
+      # Pretend the user is banging on the keyboard, with typing notifications like a real client would
+      delay = self.user.rng.expovariate(1.0 / 5.0)
+      self.user.type_message(self.room_id, delay)
+      self.user.stop_typing()
 
       event = {
         "type": "m.room.message",
-        "content": {
-          "msgtype": "m.text",
-          "body": message_text,
-        }
+        "content": self.user.pick_message_content(self.room_id)
       }
       with self.user.send_matrix_event(self.room_id, event) as response:
         if not "event_id" in response.js:
@@ -329,14 +482,14 @@ class MatrixChatUser(MatrixUser):
       messages = self.user.recent_messages.get(self.room_id, [])
       if messages is None or len(messages) < 1:
         return
-      message = random.choice(messages)
-      reaction = random.choice(["💩","👍","❤️", "👎", "🤯", "😱", "👏"])
+      message = self.user.rng.choice(messages)
+      reaction = self.user.rng.choice(["💩","👍","❤️", "👎", "🤯", "😱", "👏"])
       event = {
         "type": "m.reaction",
         "content": {
           "m.relates_to": {
             "rel_type": "m.annotation",
-            "event_id": message["event_id"],
+            "event_id": message.event_id,
             "key": reaction,
           }
         }
@@ -349,13 +502,7 @@ class MatrixChatUser(MatrixUser):
       #logging.info("User [%s] stopping chat in room [%s]" % (self.user.username, self.room_id))
       self.interrupt()
 
-    # Each time we create a new instance of this task, we want to have the user
-    # generate a slightly different expected number of messages.
-    # FIXME Hmmm this doesn't seem to work...
-    tasks = {
-      send_text: max(1, round(random.gauss(15,4))),
-      send_image: random.choice([0,0,0,1,1,2]),
-      send_reaction: random.choice([0,0,1,1,1,2,3]),
-      stop: 1,
-    }
+    def get_next_task(self):
+      # Use the per-instance weights from on_start(), drawn with the user's own RNG
+      return self.user.rng.choice(self.weighted_tasks)
 
@@ -27,15 +27,35 @@ import random
 import resource
 import json
 import logging
+import time
+import urllib.parse
+import uuid
 from http import HTTPStatus
 import mimetypes
 
 from locust import task, between, TaskSet, FastHttpUser
+from locust.contrib.fasthttp import FastHttpSession
 from locust import events
 from locust.runners import MasterRunner, WorkerRunner
 from collections import namedtuple
+from contextlib import contextmanager
 
 import gevent
+import gevent.event
+import gevent.lock
+from geventhttpclient.useragent import HTTPClientPool
+
+import bandwidth
+from bandwidth import MeteredResponse
+import edus
+import profiles
+from registration import registration_mac
+from e2ee import ENCRYPTION_STATE_CONTENT, ONE_TIME_KEY_ALGORITHM, ONE_TIME_KEY_TARGET, TO_DEVICE_BATCH_SIZE
+from e2ee import DeviceIdentity, OutboundSession, megolm_content_prefix, olm_content
+from json_codec import CODEC_NAMES, encode_static, get_codec
+from room_metrics import room_size_bucket
+import saturation  # Monitors the load generator for saturation, through its event hooks
+from workload_trace import TraceWriter
 
 
 # Locust functions for distributing users to workers ###########################
@@ -50,13 +70,274 @@ if os.path.exists("tokens.csv"):
                   for row in csv.DictReader(csvfile, fieldnames=csv_header) }
     tokens_dict.pop("username") # Dict includes the header values, so remove it
 
+# The rooms.json assignment of users to rooms, loaded on demand (see load_rooms())
+rooms_dict = None
+
+def load_rooms():
+  """Returns the rooms.json assignment of room names to members, loading it only once per process
+
+      prefork.py calls this before forking the workers, so that they all share one copy.
+  """
+  global rooms_dict
+  if rooms_dict is None:
+    with open("rooms.json", "r", encoding="utf-8") as jsonfile:
+      rooms_dict = json.load(jsonfile)
+  return rooms_dict
+
+# Number of rooms of each user in the rooms.json assignment, for the behaviour profiles (see profiles.py)
+room_counts_by_username = None
+
+def count_rooms(username):
+  global room_counts_by_username
+  if room_counts_by_username is None:
+    room_counts_by_username = {}
+    if os.path.exists("rooms.json"):
+      for members in load_rooms().values():
+        for member in members:
+          room_counts_by_username[member] = room_counts_by_username.get(member, 0) + 1
+  return room_counts_by_username.get(username, 0)
+
+# Room sizes from the rooms.json assignment, for breaking down the statistics by room size
+room_sizes_by_name = {}
+if os.path.exists("rooms.json"):
+  with open("rooms.json", "r", encoding="utf-8") as jsonfile:
+    room_sizes_by_name = { room_name: len(members) for (room_name, members) in json.load(jsonfile).items() }
+
 locust_users = []
 
 ################################################################################
 
 
+# Clock synchronization ########################################################
+#
+# End-to-end delivery latency is measured by comparing the send timestamp that
+# the sender embeds in the message content with the time at which a receiver
+# sees the message in /sync.  The sender and the receiver generally live on
+# different workers (possibly on different machines), so every worker estimates
+# the offset between its own clock and the master's clock, NTP-style, and all
+# timestamps are expressed on the master's clock.
+
+CLOCK_SYNC_PINGS = 5
+
+# Namespaced keys for the fields that we add to the content of our messages
+SENT_TS_KEY = "org.matrix.locust.sent_ts"   # Send time, in microseconds on the master's clock
+MSG_ID_KEY = "org.matrix.locust.msg_id"
+
+clock_offset = 0.0      # Seconds to add to our local clock to get the master's clock
+clock_best_rtt = None   # Round-trip time of the ping that produced clock_offset
+
+def master_time():
+  """Returns the current time in seconds since the epoch, on the master's clock"""
+  return time.time() + clock_offset
+
+def stamp_message_content(content):
+  """Embeds a send timestamp and a unique message id into the given event content
+
+  Receivers use these to measure the end-to-end delivery latency of the message.
+  """
+  content[SENT_TS_KEY] = int(master_time() * 1000000)
+  content[MSG_ID_KEY] = uuid.uuid4().hex
+  return content
+
+def stamp_encoded_content(prefix):
+  """Like stamp_message_content(), for content that was pre-encoded with encode_content_prefix()
+
+  Splices the timestamp and message id into the JSON bytes, without encoding the rest again.
+  """
+  return b'%s,"%s":%d,"%s":"%s"}' % (prefix, SENT_TS_KEY.encode("utf-8"), int(master_time() * 1000000),
+                                     MSG_ID_KEY.encode("utf-8"), uuid.uuid4().hex.encode("ascii"))
+
+def on_clock_ping(environment, msg, **_kwargs):
+  """(Master) Replies to a worker's clock ping with the master's current time"""
+  environment.runner.send_message("clock_pong", { "t0": msg.data["t0"], "master_time": time.time() },
+                                  msg.node_id)
+
+def on_clock_pong(environment, msg, **_kwargs):
+  """(Worker) Updates our clock offset, keeping the estimate with the smallest round-trip time"""
+  global clock_offset, clock_best_rtt
+  t1 = time.time()
+  t0 = msg.data["t0"]
+  rtt = t1 - t0
+  if clock_best_rtt is None or rtt < clock_best_rtt:
+    clock_best_rtt = rtt
+    clock_offset = msg.data["master_time"] - (t0 + rtt / 2)
+    logging.info("Worker [%s] clock offset to master is %.3f ms (rtt %.3f ms)",
+                 environment.runner.client_id, clock_offset * 1000, rtt * 1000)
+
+################################################################################
+
+
+# JSON encoding ################################################################
+#
+# See json_codec.py.  The codec is picked with --json-codec when the test starts.
+
+codec = get_codec("auto")
+decode_stats = False    # Whether to report the JSON decode time of every response
+
+def encode_content_prefix(content):
+  """Pre-encodes message content, without its closing brace, for stamp_encoded_content()"""
+  return encode_static(content)[:-1]
+
+# Static request bodies, encoded once
+TYPING_BODIES = {
+  # The timeout is copied from Element iOS's default initial setting -- We don't do the fancy stuff
+  # that they do, trying to figure out how long since we last set this
+  typing: encode_static({ "timeout": 10 * 1000, "typing": typing }) for typing in [True, False]
+}
+READ_RECEIPT_BODY = encode_static({ "thread_id": "main" })
+PRESENCE_BODIES = { presence: encode_static({ "presence": presence }) for presence in ["online", "unavailable", "offline"] }
+
+# While a user keeps typing, clients renew its typing notification before the server times it out,
+# but no more often than this (in seconds), however many keystrokes there are in between
+TYPING_REFRESH = 8.0
+KEYSTROKE_INTERVAL = 1.0
+
+################################################################################
+
+
+# Event sending ################################################################
+#
+# Every event goes out with a transaction id that is unique for the device, so
+# the server only ever deduplicates our retries: a send that timed out, failed
+# with a 5xx error or was rate limited (429) is retried with the same
+# transaction id, and if the first attempt did reach the server, it returns the
+# original event instead of storing it twice.
+
+SEND_RETRIES = 3
+SEND_RETRY_BACKOFF = 0.5    # Seconds before the first retry, doubled for every further retry
+
+send_retries = SEND_RETRIES
+
+################################################################################
+
+
+# Login management #############################################################
+#
+# Tens of thousands of users logging in at once, or all retrying at once after
+# the server starts failing, can take the server down before the test even
+# starts.  The logins on a worker go through a semaphore that caps how many are
+# in flight, failed logins back off exponentially (or for as long as a 429 asks
+# us to), and a user whose access token stops working refreshes it or logs in
+# again, instead of hammering the server with requests that can only fail.
+
+LOGIN_CONCURRENCY = 32      # Logins in flight per worker
+LOGIN_ATTEMPTS = 10
+RETRY_BACKOFF = 1.0         # Seconds before the first retry, doubled for every further retry
+RETRY_BACKOFF_MAX = 60.0
+
+login_semaphore = gevent.lock.BoundedSemaphore(LOGIN_CONCURRENCY)
+login_attempts = LOGIN_ATTEMPTS
+use_refresh_tokens = False
+
+class LoginError(namedtuple("LoginError", ["status", "errcode", "error", "retry_after_ms"])):
+  """Why a login (or a token refresh) failed"""
+  __slots__ = ()
+
+  @property
+  def retryable(self):
+    # Timeouts, rate limits and server errors, but not wrong passwords
+    return self.status == 0 or self.status == HTTPStatus.TOO_MANY_REQUESTS or self.status >= 500
+
+  def __str__(self):
+    return "%d %s: %s" % (self.status, self.errcode, self.error)
+
+def retry_backoff(rng, attempt, retry_after_ms=None):
+  """Returns the seconds to wait before retrying a login or /sync after the given number of failures
+
+  The jitter comes from the user's own RNG, so that seeded runs stay reproducible.
+  """
+  if retry_after_ms is not None:
+    return retry_after_ms / 1000.0
+  # Randomize the delay, so that users who failed together don't all retry together
+  return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1)) * rng.uniform(0.5, 1.5)
+
+class UnloggedRequest(Exception):
+  """Raised inside a request's context manager to keep Locust from reporting the request"""
+
+################################################################################
+
+
+# Connection sharing ###########################################################
+#
+# Every Locust user normally has a connection pool of its own, so a worker with
+# 10k users holds at least 10k sockets.  With --shared-connections N, all the
+# requests of a worker's users except their /sync long-polls go over one pool of
+# N keep-alive connections, waiting for a free connection when they are all
+# busy, like the requests of many clients behind a proxy or a NAT gateway.  The
+# long-polls stay on a connection of each user's own.
+
+shared_client_pool = None
+
+def create_shared_client_pool(num_connections):
+  return HTTPClientPool(concurrency=num_connections,
+                        connection_timeout=MatrixUser.connection_timeout,
+                        network_timeout=MatrixUser.network_timeout,
+                        insecure=MatrixUser.insecure)
+
+################################################################################
+
+
+# Workload trace recording #####################################################
+
+trace_writer = None
+
+# Without a seed, all users share one generator: a Mersenne Twister's state takes 2.5 KB
+shared_rng = random.Random()
+
+
+def user_rng(seed, username):
+  """Returns the random number generator for one user's behaviour
+
+  With a suite seed, the generator depends only on the seed and the username, so every
+  user makes the same sequence of choices regardless of how many workers we run or which
+  worker the user lands on.  Without a seed, the behaviour is random as before.
+  """
+  if seed is None:
+    return shared_rng
+  return random.Random("%s:%s" % (seed, username))
+
+def room_id_from_url(url):
+  """Extracts the room id from a /rooms/{roomId}/... API URL, if there is one"""
+  if "/rooms/" not in url:
+    return None
+  return url.split("/rooms/", 1)[1].split("/", 1)[0].split("?", 1)[0]
+
+################################################################################
+
+
 # Preflight ####################################################################
 
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+  parser.add_argument("--seed", type=str, default=None,
+                      help="Suite seed for reproducible per-user behaviour")
+  parser.add_argument("--weighted-room-selection", action="store_true", default=False,
+                      help="Pick rooms in proportion to their message activity instead of uniformly")
+  parser.add_argument("--registration-shared-secret", type=str, default=None,
+                      help="Register users through the shared-secret admin API instead of UIAA")
+  parser.add_argument("--trace-record", type=str, default=None,
+                      help="Record every Matrix operation to this trace file (workers append their index)")
+  parser.add_argument("--json-codec", type=str, choices=CODEC_NAMES, default="auto",
+                      help="JSON library for request and response bodies (auto picks the fastest one installed)")
+  parser.add_argument("--json-decode-stats", action="store_true", default=False,
+                      help="Report the JSON decode time of each endpoint as DECODE statistics")
+  parser.add_argument("--send-retries", type=int, default=3,
+                      help="Times to retry sending an event, with the same transaction id, on timeouts, 5xx and 429 errors")
+  parser.add_argument("--e2ee", action="store_true", default=False,
+                      help="Simulate end-to-end encryption: create encrypted rooms, upload keys and encrypt every event")
+  parser.add_argument("--login-concurrency", type=int, default=LOGIN_CONCURRENCY,
+                      help="Maximum number of logins in flight on each worker")
+  parser.add_argument("--login-attempts", type=int, default=LOGIN_ATTEMPTS,
+                      help="Times to try logging in a user, with exponential backoff, before giving up on it")
+  parser.add_argument("--refresh-tokens", action="store_true", default=False,
+                      help="Ask for refresh tokens at login, and refresh expired access tokens with them")
+  parser.add_argument("--shared-connections", type=int, default=0,
+                      help="Send every request but /sync over this many keep-alive connections per worker, "
+                           "shared by all its users (0 gives every user connections of its own)")
+  parser.add_argument("--presence", action="store_true", default=False,
+                      help="Send presence: set_presence on /sync, and unavailable/online/offline updates "
+                           "when users go away and come back or stop")
+
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
@@ -66,10 +347,43 @@ def on_locust_init(environment, **_kwargs):
     if isinstance(environment.runner, MasterRunner):
         print("Registered 'update_tokens' handler on master worker")
         environment.runner.register_message("update_tokens", update_tokens)
+        environment.runner.register_message("clock_ping", on_clock_ping)
+        environment.events.spawning_complete.add_listener(
+          lambda **_kwargs: check_user_split(environment))
+    elif isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("clock_pong", on_clock_pong)
+
+@events.test_stopping.add_listener
+def on_test_stopping(environment, **_kwargs):
+  # Log how much memory the simulated users take, while they're still around
+  if isinstance(environment.runner, MasterRunner):
+    return
+  users = [g.args[0] for g in environment.runner.user_greenlets if len(g.args) > 0 and isinstance(g.args[0], MatrixUser)]
+  report = user_memory_report(users)
+  if report is None:
+    return
+  logging.info("Memory per user: %.0f bytes over %d of %d users (%s)", report["bytes_per_user"],
+               report["sampled"], report["users"],
+               ", ".join("%s %.0f" % (field, size) for field, size in report["fields"]))
+
 
 @events.test_stop.add_listener
 def on_test_stop(environment, **_kwargs):
-  global tokens_dict
+  global tokens_dict, trace_writer, shared_client_pool
+
+  if trace_writer is not None:
+    trace_writer.close(clock_offset)
+    trace_writer = None
+
+  if shared_client_pool is not None:
+    shared_client_pool.close()
+    shared_client_pool = None
+    MatrixUser.client_pool = None
+
+  # Only the master has every worker's tokens; the workers would overwrite its file with their own
+  if isinstance(environment.runner, WorkerRunner):
+    return
+
   csv_header = ["username", "user_id", "access_token", "sync_token"]
 
   # Write changes to tokens.csv
@@ -83,26 +397,92 @@ def on_test_stop(environment, **_kwargs):
 
 @events.test_start.add_listener
 def on_test_start(environment, **_kwargs):
-  global locust_users
+  global locust_users, trace_writer, codec, decode_stats, send_retries
+  global login_semaphore, login_attempts, use_refresh_tokens, shared_client_pool
+
+  codec = get_codec(getattr(environment.parsed_options, "json_codec", "auto"))
+  decode_stats = getattr(environment.parsed_options, "json_decode_stats", False)
+  send_retries = getattr(environment.parsed_options, "send_retries", SEND_RETRIES)
+  login_semaphore = gevent.lock.BoundedSemaphore(getattr(environment.parsed_options, "login_concurrency",
+                                                         LOGIN_CONCURRENCY))
+  login_attempts = max(1, getattr(environment.parsed_options, "login_attempts", LOGIN_ATTEMPTS))
+  use_refresh_tokens = getattr(environment.parsed_options, "refresh_tokens", False)
+  if not isinstance(environment.runner, MasterRunner):
+    logging.info("Using the %s JSON codec", codec.name)
+
+  shared_connections = getattr(environment.parsed_options, "shared_connections", 0)
+  if shared_connections > 0 and not isinstance(environment.runner, MasterRunner):
+    logging.info("Sharing %d connections among the users of this worker, except for /sync", shared_connections)
+    shared_client_pool = create_shared_client_pool(shared_connections)
+    MatrixUser.client_pool = shared_client_pool
+
+  trace_path = getattr(environment.parsed_options, "trace_record", None)
+  if trace_path is not None and not isinstance(environment.runner, MasterRunner):
+    if isinstance(environment.runner, WorkerRunner):
+      trace_path = "%s.%d" % (trace_path, environment.runner.worker_index)
+    logging.info("Recording Matrix operations to %s", trace_path)
+    trace_writer = TraceWriter(trace_path)
+
+  if isinstance(environment.runner, WorkerRunner):
+    # Estimate our clock offset to the master for the delivery latency measurements
+    for _ in range(CLOCK_SYNC_PINGS):
+      environment.runner.send_message("clock_ping", { "t0": time.time() })
   if isinstance(environment.runner, MasterRunner):
     print("Loading users and sending to workers")
     with open("users.csv", "r", encoding="utf-8") as csvfile:
       user_reader = csv.DictReader(csvfile)
       locust_users = [ user for user in user_reader ]
 
-      # Divide up users between all workers
-      for (client_id, index) in environment.runner.worker_indexes.items():
-        user_count = int(len(locust_users) / environment.runner.worker_index_max)
-        remainder = 0 if index != environment.runner.worker_index_max - 1 \
-                      else (len(locust_users) % environment.runner.worker_index_max)
-
-        start = index * user_count
-        end = start + user_count + remainder
-        users = locust_users[start:end]
-
+      # Divide up users between all workers, the same way as Locust divides up the Locust users
+      for (client_id, users) in split_users(environment.runner, locust_users).items():
         print(f"Sending {len(users)} users to {client_id}")
         environment.runner.send_message("load_users", users, client_id)
 
+def locust_worker_order(runner):
+  """Returns the client ids of the master's workers, in the order that Locust deals out the users
+
+  Locust sorts the workers by id, numbers them within each host (the part of the id before the
+  first "_"), and deals round-robin by (number within host, id), so that every host gets users.
+  """
+  worker_ids = sorted(worker_node.id for worker_node in runner.clients.values())
+  index_within_host = {}
+  workers_per_host = {}
+  for client_id in worker_ids:
+    host = client_id.split("_")[0]
+    index_within_host[client_id] = workers_per_host.get(host, 0)
+    workers_per_host[host] = index_within_host[client_id] + 1
+  return sorted(worker_ids, key=lambda client_id: (index_within_host[client_id], client_id))
+
+def split_users(runner, users):
+  """Returns { worker client id: its users from users.csv }
+
+  Dealing out the accounts in the same order as Locust deals out the Locust users gives every worker
+  one account for each of its Locust users, which setup_pipeline.py's phase barriers rely on.
+  check_user_split() checks that the workers really got the users that this split expects.
+  """
+  worker_ids = locust_worker_order(runner)
+  split = { client_id: [] for client_id in worker_ids }
+  for i, user in enumerate(users):
+    split[worker_ids[i % len(worker_ids)]].append(user)
+  return split
+
+def check_user_split(environment):
+  """Master: stops the test if Locust dealt out its users differently from our accounts
+
+  A restarted ramp-up (like saturation.py's spawn throttle) can fire spawning_complete for a target that
+  is already gone, so this checks the current target, once the workers' reports add up to it.
+  """
+  runner = environment.runner
+  actual = { worker_node.id: worker_node.user_count for worker_node in runner.clients.values() }
+  if len(locust_users) == 0 or sum(actual.values()) != runner.target_user_count:
+    return
+  expected = { client_id: len(users)
+               for (client_id, users) in split_users(runner, range(runner.target_user_count)).items() }
+  if actual != expected:
+    logging.error("Locust dealt out its users as %s, but the accounts were dealt out for %s. "
+                  "Stopping, since the workers' users don't match their accounts.", actual, expected)
+    runner.quit()
+
 ################################################################################
 
 def update_tokens(environment, msg, **_kwargs):
@@ -115,6 +495,208 @@ def update_tokens(environment, msg, **_kwargs):
 
   tokens_dict[username] = { "user_id": user_id, "access_token": access_token, "sync_token": sync_token }
 
+
+def intern_id(value):
+  """Interns a room id, user id or similar string, so that all users on a worker share one copy"""
+  return sys.intern(value) if isinstance(value, str) else value
+
+
+# The parts of a message event that we use later, kept in recent_messages
+RecentMessage = namedtuple("RecentMessage", ["event_id", "sender", "msgtype", "thumbnail_url"])
+
+
+def compact_message(event):
+  content = event.get("content", {})
+  return RecentMessage(event.get("event_id", None), intern_id(event.get("sender", None)),
+                       intern_id(content.get("msgtype", None)), intern_id(content.get("thumbnail_url", None)))
+
+
+class LazyContainer:
+  """A per-user container that is only allocated the first time it's used
+
+  Most simulated users never touch most of their caches, so rather than giving every
+  user a dozen empty dicts and sets, the container lives in a slot that stays empty
+  until the first access.  Deleting the attribute empties the slot again.
+  """
+
+  def __init__(self, factory):
+    self.factory = factory
+    self.slot = None
+
+  def __set_name__(self, owner, name):
+    self.slot = "_" + name
+
+  def __get__(self, instance, owner=None):
+    if instance is None:
+      return self
+    try:
+      return getattr(instance, self.slot)
+    except AttributeError:
+      value = self.factory()
+      setattr(instance, self.slot, value)
+      return value
+
+  def __set__(self, instance, value):
+    setattr(instance, self.slot, value)
+
+  def __delete__(self, instance):
+    try:
+      delattr(instance, self.slot)
+    except AttributeError:
+      pass
+
+  def is_allocated(self, instance):
+    return hasattr(instance, self.slot)
+
+
+def deep_sizeof(obj, seen):
+  """Approximate memory footprint of obj and everything it refers to, counting shared objects once"""
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    size += sum(deep_sizeof(item, seen) for item in obj)
+  elif isinstance(obj, RoomSet):
+    size += sum(deep_sizeof(getattr(obj, name), seen) for name in RoomSet.__slots__)
+  return size
+
+
+def user_memory_report(users, sample_size=200):
+  """Estimates the memory footprint of a sample of MatrixUsers, per user and per state field
+
+      Objects that the users share, like interned room ids, are only counted once, so this is
+      the amortized cost of each additional user on the worker.
+  """
+  if len(users) == 0:
+    return None
+  sample = users if len(users) <= sample_size else random.sample(users, sample_size)
+  seen = set()
+  field_sizes = {}
+  total = 0
+  for user in sample:
+    # The object itself (with its slots) and whatever else Locust keeps in its __dict__
+    size = sys.getsizeof(user) + deep_sizeof(getattr(user, "__dict__", {}), seen)
+    for slot in MatrixUser.__slots__:
+      if hasattr(user, slot):
+        field_size = deep_sizeof(getattr(user, slot), seen)
+        field_sizes[slot.lstrip("_")] = field_sizes.get(slot.lstrip("_"), 0) + field_size
+        size += field_size
+    total += size
+  fields = sorted(((field, size / len(sample)) for field, size in field_sizes.items()), key=lambda f: -f[1])
+  return {
+    "users": len(users),
+    "sampled": len(sample),
+    "bytes_per_user": total / len(sample),
+    "fields": fields[:8],
+  }
+
+
+class RoomSet:
+  """A set of room ids with O(1) add, remove and random choice
+
+  The room ids are kept in an array, with a map from each room id to its position in
+  the array, so picking a random room doesn't need to copy the whole set.  Removing
+  a room moves the last room into its place.
+
+  Each room also has an activity weight (1 + the number of messages that we've seen
+  in it), kept in a Fenwick tree, so that we can also pick rooms in proportion to
+  their activity in O(log n), like a real user's attention goes to the busy rooms.
+  """
+
+  __slots__ = ("room_ids", "positions", "weights", "tree")
+
+  def __init__(self, room_ids=()):
+    self.room_ids = []
+    self.positions = {}
+    self.weights = [0.0]  # Per position, 1-based
+    self.tree = [0.0]     # Fenwick tree over the weights, 1-based
+    for room_id in room_ids:
+      self.add(room_id)
+
+  def __len__(self):
+    return len(self.room_ids)
+
+  def __contains__(self, room_id):
+    return room_id in self.positions
+
+  def __iter__(self):
+    return iter(self.room_ids)
+
+  def _prefix_sum(self, position):
+    total = 0.0
+    while position > 0:
+      total += self.tree[position]
+      position -= position & -position
+    return total
+
+  def _update(self, position, delta):
+    while position < len(self.tree):
+      self.tree[position] += delta
+      position += position & -position
+
+  def add(self, room_id):
+    if room_id in self.positions:
+      return
+    self.room_ids.append(room_id)
+    position = len(self.room_ids)
+    self.positions[room_id] = position
+    # The new tree node covers the weights in (position - lowbit, position]
+    self.weights.append(1.0)
+    lowbit = position & -position
+    self.tree.append(1.0 + self._prefix_sum(position - 1) - self._prefix_sum(position - lowbit))
+
+  def discard(self, room_id):
+    position = self.positions.pop(room_id, None)
+    if position is None:
+      return
+    last = len(self.room_ids)
+    if position != last:
+      # Move the last room into the hole
+      last_room_id = self.room_ids[last - 1]
+      self.room_ids[position - 1] = last_room_id
+      self.positions[last_room_id] = position
+      self._update(position, self.weights[last] - self.weights[position])
+      self.weights[position] = self.weights[last]
+    # No other tree node covers the last position, so we can simply drop it
+    self.room_ids.pop()
+    self.weights.pop()
+    self.tree.pop()
+
+  def remove(self, room_id):
+    if room_id not in self.positions:
+      raise KeyError(room_id)
+    self.discard(room_id)
+
+  def bump(self, room_id, amount=1.0):
+    """Increases the activity weight of a room"""
+    position = self.positions.get(room_id, None)
+    if position is not None and amount != 0:
+      self.weights[position] += amount
+      self._update(position, amount)
+
+  def choice(self, rng, weighted=False):
+    """Returns a random room id (None if the set is empty), optionally weighted by activity"""
+    if len(self.room_ids) == 0:
+      return None
+    if not weighted:
+      return self.room_ids[int(rng.random() * len(self.room_ids))]
+
+    # Walk down the Fenwick tree to find the position where the running total passes the target
+    target = rng.random() * self._prefix_sum(len(self.room_ids))
+    position = 0
+    step = 1 << (len(self.tree) - 1).bit_length()
+    while step > 0:
+      next_position = position + step
+      if next_position < len(self.tree) and self.tree[next_position] <= target:
+        position = next_position
+        target -= self.tree[next_position]
+      step >>= 1
+    return self.room_ids[min(position, len(self.room_ids) - 1)]
+
+
 class MatrixUser(FastHttpUser):
 
   # Don't ever directly instantiate this class
@@ -128,25 +710,85 @@ class MatrixUser(FastHttpUser):
   #   * Room avatar URLs
   #   * User avatar URLs
   #   * A pretend cache of images (by MXC URL) that we have already downloaded
+  #
+  # A worker may hold tens of thousands of these users, so the state lives in slots
+  # rather than in the instance __dict__, and the caches are only allocated when used.
+  __slots__ = ("matrix_version", "username", "password", "rng", "weighted_room_selection",
+               "total_num_users", "user_id", "access_token", "device_id", "matrix_domain",
+               "sync_timeout", "joined_room_ids", "largest_room_size", "current_room",
+               "sync_token", "initial_sync_token", "matrix_sync_task",
+               "_invited_room_ids", "_room_avatar_urls", "_user_avatar_urls", "_earliest_sync_tokens",
+               "_room_display_names", "_user_display_names", "_media_cache", "_recent_messages",
+               "_room_sizes", "e2ee", "identity", "one_time_key_count",
+               "_room_members", "_device_lists", "_olm_sessions", "_outbound_sessions",
+               "txn_prefix", "txn_counter", "_pending_txns", "refresh_token",
+               "recovering_session", "_sync_session", "profile", "presence",
+               "typing_room_id", "typing_sent_at")
+
+  invited_room_ids = LazyContainer(set)
+  room_avatar_urls = LazyContainer(dict)
+  user_avatar_urls = LazyContainer(dict)
+  earliest_sync_tokens = LazyContainer(dict)
+  room_display_names = LazyContainer(dict)
+  user_display_names = LazyContainer(dict)
+  media_cache = LazyContainer(dict)
+  recent_messages = LazyContainer(dict)
+  room_sizes = LazyContainer(dict)
+  pending_txns = LazyContainer(dict)        # txn_id of a retried send -> event_id seen in /sync, or None
+
+  # End-to-end encryption state, only used with --e2ee
+  room_members = LazyContainer(dict)        # room_id -> tuple of member user ids
+  device_lists = LazyContainer(dict)        # user_id -> tuple of (device_id, curve25519 key)
+  olm_sessions = LazyContainer(set)         # (user_id, device_id) that we have an Olm session with
+  outbound_sessions = LazyContainer(dict)   # room_id -> OutboundSession
+
+  @property
+  def sync_client(self):
+    """The session for our /sync requests: our own one with a shared connection pool, or else self.client"""
+    return self._sync_session if self._sync_session is not None else self.client
 
   def wait_time(self):
-    return random.expovariate(0.1)
+    if self.profile is not None and self.profile.wait_time is not None:
+      return max(0.0, self.profile.wait_time(self.rng))
+    return self.rng.expovariate(0.1)
 
 
   def __init__(self, *args, **kwargs):
     #global user_reader
     global locust_users
     super().__init__(*args, **kwargs)
+    # With a shared connection pool, the /sync long-polls still get a connection of our own
+    self._sync_session = None
+    if self.client_pool is not None:
+      self._sync_session = FastHttpSession(self.environment, base_url=self.host, user=self,
+                                         network_timeout=self.network_timeout,
+                                         connection_timeout=self.connection_timeout,
+                                         max_redirects=self.max_redirects, max_retries=self.max_retries,
+                                         insecure=self.insecure, concurrency=1,
+                                         ssl_context_factory=self.ssl_context_factory, headers=self.default_headers)
+    # Keep the size of every response body on the wire, before it is decompressed
+    self.client.client.response_type = MeteredResponse
+    if self._sync_session is not None:
+      self._sync_session.client.response_type = MeteredResponse
 
     self.matrix_version = "v3"
     self.username = None
     self.password = None
+    self.rng = shared_rng
+    self.weighted_room_selection = False
+    self.profile = None
+    self.presence = None
+    self.typing_room_id = None
+    self.typing_sent_at = 0.0
+    self.e2ee = False
     self.total_num_users = len(locust_users)
 
     # The login() method sets the Matrix credentials
     self.user_id = None
     self.access_token = None
+    self.refresh_token = None
     self.device_id = None
+    self.recovering_session = None     # (greenlet, event) while recover_session() gets a new access token
     # We also keep track of our local homeserver's domain.
     # This is useful for inviting other local users
     self.matrix_domain = None
@@ -160,23 +802,37 @@ class MatrixUser(FastHttpUser):
         A reset of the internal state is required when a single Locust user login into multiple
         matrix users (this base class is only initialized when a Locust user is spawned)
     """
-    self.invited_room_ids = set([])
-    self.joined_room_ids = set([])
-
-    self.room_avatar_urls = {}
-    self.user_avatar_urls = {}
-    self.earliest_sync_tokens = {}
-    self.room_display_names = {}
-    self.user_display_names = {}
-    self.media_cache = {}
-
-    self.recent_messages = {}
+    self.joined_room_ids = RoomSet()
+
+    # Drop the lazy containers; they're allocated again the next time they're used
+    del self.invited_room_ids
+    del self.room_avatar_urls
+    del self.user_avatar_urls
+    del self.earliest_sync_tokens
+    del self.room_display_names
+    del self.user_display_names
+    del self.media_cache
+    del self.recent_messages
+    del self.room_sizes
+    del self.room_members
+    del self.device_lists
+    del self.olm_sessions
+    del self.outbound_sessions
+    self.identity = None
+    self.one_time_key_count = None
+
+    self.largest_room_size = None
     self.current_room = None
 
     self.sync_token = None
     self.initial_sync_token = None
     self.matrix_sync_task = None
 
+    # Transaction ids like Element's, unique to this login: "m<login time in ms>.<counter>"
+    self.txn_prefix = "m%d" % int(time.time() * 1000)
+    self.txn_counter = 0
+    del self.pending_txns
+
 
   def register(self):
     """https://spec.matrix.org/v1.4/client-server-api/#post_matrixclientv3register
@@ -236,6 +892,36 @@ class MatrixUser(FastHttpUser):
         logging.error("User[%s] /register failed with status code %d\nResponse: %s", self.username,
                       response1.status_code, response1.js)
 
+  def register_with_shared_secret(self, shared_secret):
+    """Registers through the shared-secret registration API (Synapse and Dendrite)
+
+    This skips the UIAA round-trips of register(), and the server does not apply
+    its registration rate limits to it, which makes provisioning much faster.
+    """
+    url = "/_synapse/admin/v1/register"
+    with self.rest("GET", url, name=url + " (nonce)") as response1:
+      nonce = None if response1.js is None else response1.js.get("nonce", None)
+      if nonce is None:
+        logging.error("User [%s] Failed to get a registration nonce\nResponse: %s", self.username, response1.js)
+        return
+
+    request_body = {
+      "nonce": nonce,
+      "username": self.username,
+      "password": self.password,
+      "admin": False,
+      "mac": registration_mac(shared_secret, nonce, self.username, self.password)
+    }
+    with self.rest("POST", url, json=request_body) as response2:
+      if response2.status_code == HTTPStatus.OK:
+        self.user_id = response2.js.get("user_id", None)
+        self.access_token = response2.js.get("access_token", None)
+        if self.user_id is None or self.access_token is None:
+          logging.error("User [%s] Failed to parse /register response!\nResponse: %s", self.username, response2.js)
+      else:
+        logging.error("User[%s] shared-secret /register failed with status code %d\nResponse: %s", self.username,
+                      response2.status_code, response2.js)
+
   def start_syncing(self):
     if self.access_token is not None:
       # Spawn a Greenlet to act as this user's client, constantly /sync'ing with the server
@@ -255,6 +941,18 @@ class MatrixUser(FastHttpUser):
 
     self.username = user_dict["username"]
     self.password = user_dict["password"]
+    self.rng = user_rng(getattr(self.environment.parsed_options, "seed", None), self.username)
+    self.weighted_room_selection = getattr(self.environment.parsed_options, "weighted_room_selection", False)
+    if profiles.population is not None:
+      self.profile = profiles.population.assign(self.username, count_rooms(self.username),
+                                                getattr(self.environment.parsed_options, "seed", None))
+      if self.profile is not None and self.profile.room_selection is not None:
+        self.weighted_room_selection = self.profile.room_selection == "weighted"
+    self.e2ee = getattr(self.environment.parsed_options, "e2ee", False)
+    self.presence = "online" if getattr(self.environment.parsed_options, "presence", False) else None
+    # The tokens in tokens.csv are reused as they are; if the server rejects them, recover_session() logs in again
+    self.refresh_token = None
+    self.device_id = None
 
     if tokens_dict.get(self.username) is None:
       self.user_id = None
@@ -279,13 +977,53 @@ class MatrixUser(FastHttpUser):
     self._reset_user_state()
 
   def login(self, start_syncing=False, log_request=False):
+    """Logs in with our password, and returns whether it worked
+
+        Logins are retried with backoff (see _log_in_with_backoff()), so this only fails when the
+        server keeps failing, or rejects our password.
+    """
     if self.username is None or self.password is None:
       logging.error("No username or password")
       self.environment.runner.quit()
-      return
+      return False
 
     self._reset_user_state()
 
+    if not self._log_in_with_backoff(log_request):
+      return False
+
+    if start_syncing:
+      # Spawn a Greenlet to act as this user's client, constantly /sync'ing with the server
+      self.sync_timeout = 30
+      self.matrix_sync_task = gevent.spawn(self.sync_forever)
+
+      # Wait a bit before we take our first action
+      self.wait()
+    return True
+
+  def _log_in_with_backoff(self, log_request=True):
+    """Sends /login requests until one works, returning whether one did
+
+        At most --login-concurrency logins are in flight on a worker, and after a failure we wait
+        exponentially longer (or as long as a 429 asks) before trying again, up to --login-attempts
+        times.  Errors that retrying can't fix, like a wrong password, fail straight away.
+    """
+    for attempt in range(1, login_attempts + 1):
+      with login_semaphore:
+        error = self._login_request(log_request)
+      if error is None:
+        return True
+
+      if not error.retryable or attempt == login_attempts:
+        logging.error("User [%s] Giving up logging in after %d attempts: %s", self.username, attempt, error)
+        return False
+      delay = retry_backoff(self.rng, attempt, error.retry_after_ms)
+      logging.warning("User [%s] Login failed (%s), retrying in %.1fs", self.username, error, delay)
+      gevent.sleep(delay)
+    return False
+
+  def _login_request(self, log_request):
+    """Sends one /login request, returning None if it worked or a LoginError if it didn't"""
     url = "/_matrix/client/%s/login" % self.matrix_version
     body = {
       "type": "m.login.password",
@@ -295,47 +1033,104 @@ class MatrixUser(FastHttpUser):
       },
       "password": self.password
     }
+    # Log in to our existing device after a soft logout, so that it keeps its keys
+    if self.device_id is not None:
+      body["device_id"] = self.device_id
+    if use_refresh_tokens:
+      body["refresh_token"] = True
 
+    error = None
     try:
-      request_args = { "method": "POST", "url": url, "json": body }
-
-      # Due to the internernals of how requests are handled, different methods neeed to be
-      # invoked to prevent logging
-      if log_request:
-        request = self.rest
-      else:
-        request = self.client.request
-        request_args["catch_response"] = True
-
       # logging.info("User [%s]: sending /login request" % username)
-      with request(**request_args) as response:
+      with self.client.request("POST", url, catch_response=True, json=body, name=url) as response:
         #logging.info("User [%s]: Got login response" % username)
-        response_json = response.json()
-        self.access_token = response_json["access_token"]
-        self.user_id = response_json["user_id"]
-        self.device_id = response_json["device_id"]
-        self.matrix_domain = self.user_id.split(":")[-1]
-
-        # Refresh tokens stored in the csv file (Have to emulate locust message
-        # object)
-        msg = namedtuple("msg", ["data"])
-        msg.data = { "username": self.username, "user_id": self.user_id,
-                     "access_token": self.access_token, "sync_token": "" }
-        update_tokens(None, msg)
-
-        if start_syncing and self.access_token is not None:
-          # Spawn a Greenlet to act as this user's client, constantly /sync'ing with the server
-          self.sync_timeout = 30
-          self.matrix_sync_task = gevent.spawn(self.sync_forever)
-
-          # Wait a bit before we take our first action
-          self.wait()
+        try:
+          response_json = codec.decode(response.content) if response.content else {}
+        except ValueError:
+          response_json = {}
+
+        if response.status_code == HTTPStatus.OK and "access_token" in response_json:
+          self.access_token = response_json["access_token"]
+          self.refresh_token = response_json.get("refresh_token", None)
+          self.user_id = response_json["user_id"]
+          self.device_id = response_json["device_id"]
+          self.matrix_domain = self.user_id.split(":")[-1]
+
+          # Refresh tokens stored in the csv file
+          self.save_tokens()
+          response.success()
+        else:
+          error = LoginError(response.status_code, response_json.get("errcode", "???"),
+                             response_json.get("error", None) or str(response.error),
+                             response_json.get("retry_after_ms", None))
+          response.failure(str(error))
 
         # Raising an exception is the process to prevent logging a request according to the docs
-        if not(log_request):
-          raise Exception()
-    except:
+        if not log_request:
+          raise UnloggedRequest()
+    except UnloggedRequest:
       pass
+    return error
+
+  def save_tokens(self):
+    """Stores our tokens in tokens.csv for later runs
+
+    Only the master writes tokens.csv, so workers send their tokens to it.
+    """
+    token_update_request = { "username": self.username, "user_id": self.user_id,
+                             "access_token": self.access_token, "sync_token": self.sync_token or "" }
+    if isinstance(self.environment.runner, WorkerRunner):
+      self.environment.runner.send_message("update_tokens", token_update_request)
+    # Keep our own copy up to date as well (have to emulate locust message object)
+    msg = namedtuple("msg", ["data"])
+    msg.data = token_update_request
+    update_tokens(self.environment, msg)
+
+  def refresh_access_token(self):
+    """Swaps our refresh token for a new access token, returning whether it worked"""
+    url = "/_matrix/client/%s/refresh" % self.matrix_version
+    headers = { "Content-Type": "application/json", "Accept": "application/json" }
+    payload = codec.encode({ "refresh_token": self.refresh_token })
+    with login_semaphore:
+      with self._json_request("POST", url, headers, payload, url, {}) as response:
+        if response.status_code == HTTPStatus.OK and response.js is not None and "access_token" in response.js:
+          self.access_token = response.js["access_token"]
+          self.refresh_token = response.js.get("refresh_token", self.refresh_token)
+          self.save_tokens()
+          return True
+
+        js = response.js or {}
+        error = LoginError(response.status_code, js.get("errcode", "???"), js.get("error", None) or str(response.error),
+                           js.get("retry_after_ms", None))
+        logging.warning("User [%s] Could not refresh the access token: %s", self.username, error)
+        response.failure(str(error))
+        self.refresh_token = None
+        return False
+
+  def recover_session(self, error_json):
+    """Gets a new access token after the server rejected ours, and returns whether it worked
+
+        After a soft logout (an expired access token), we refresh the token if we have a refresh
+        token, or log in to the same device again.  After a hard logout, the device is gone, so we
+        log in to a new one (and upload its keys, with --e2ee).
+    """
+    error_json = error_json or {}
+    soft_logout = error_json.get("soft_logout", False)
+    if soft_logout and self.refresh_token is not None and self.refresh_access_token():
+      return True
+
+    logging.warning("User [%s] Access token rejected (%s, soft_logout=%s), logging in again",
+                    self.username, error_json.get("errcode", "???"), soft_logout)
+    self.refresh_token = None
+    if not soft_logout:
+      self.device_id = None
+      self.identity = None
+    if not self._log_in_with_backoff():
+      return False
+
+    if self.e2ee and self.identity is None:
+      self.setup_encryption()
+    return True
 
 
   def sync(self, initial_sync=False, timeout=30000):
@@ -345,6 +1140,8 @@ class MatrixUser(FastHttpUser):
       sync_url = f"/_matrix/client/{self.matrix_version}/sync?timeout={timeout}"
     else:
       sync_url = f"/_matrix/client/{self.matrix_version}/sync?timeout={timeout}&since={self.sync_token}"
+    if self.presence is not None:
+      sync_url += f"&set_presence={self.presence}"
 
     label = f"/_matrix/client/{self.matrix_version}/sync"
 
@@ -353,13 +1150,16 @@ class MatrixUser(FastHttpUser):
     #   "timeout": 30000,  # Convert from seconds to milliseconds
     # }
 
+    # Messages in the initial sync may be arbitrarily old, so they don't count towards delivery latency
+    measure_delivery = self.sync_token is not None and initial_sync is False
+
     #logging.info("User [%s] calling /sync" % self.username)
     #with self._matrix_api_call("GET", sync_url, body=request_body, name=label) as response:
     with self._matrix_api_call("GET", sync_url, body=None, name=label) as response:
       if response.status_code != 200:
         return response
 
-      response_json = response.json()
+      response_json = response.js
       if response_json is None:
         return None
 
@@ -373,29 +1173,73 @@ class MatrixUser(FastHttpUser):
       if self.initial_sync_token is None:
         self.initial_sync_token = self.sync_token
 
+      edus.count_received(response_json)
+
       # Get any new invitations and add them to the local instance
-      new_invited_room_ids = set(response_json.get("rooms", {}).get("invite", {}).keys())
+      invited_rooms = response_json.get("rooms", {}).get("invite", {})
+      new_invited_room_ids = set(invited_rooms.keys())
+      for room_id, room in invited_rooms.items():
+        room_id = intern_id(room_id)
+        for event in room.get("invite_state", {}).get("events", []):
+          if event.get("type", None) == "m.room.name":
+            self.room_display_names[room_id] = intern_id(event.get("content", {}).get("name", None))
       #logging.info("User [%s] /sync found %d new invited rooms", self.username, len(new_invited_room_ids))
 
       new_invited_room_ids.discard(None) # Remove null room id retrieved from the sync response
-      self.invited_room_ids.update( new_invited_room_ids )
+      if len(new_invited_room_ids) > 0:
+        self.invited_room_ids.update( intern_id(room_id) for room_id in new_invited_room_ids )
 
       # Get any new messages and add them to the local instance
       rooms = response_json.get("rooms",{}).get("join", {}) # dict: str -> JoinedRoom
       #logging.info("User [%s] /sync found %d joined rooms" % (self.username, len(rooms.keys())))
       for room_id, room in rooms.items():
+        # Every user in a room gets its own copy of the room id from the JSON decoder
+        room_id = intern_id(room_id)
         self.joined_room_ids.add(room_id)
+
+        # Keep track of the room names, so that we can map the rooms from rooms.json to their room ids
+        for event in room.get("state", {}).get("events", []) + room.get("timeline", {}).get("events", []):
+          if event.get("type", None) == "m.room.name":
+            self.room_display_names[room_id] = intern_id(event.get("content", {}).get("name", None))
+
+        # The room summary is only included when it changes, so remember the last one we saw
+        joined_member_count = room.get("summary", {}).get("m.joined_member_count", None)
+        if joined_member_count is not None:
+          self.room_sizes[room_id] = joined_member_count
+
+        # Our /sync requests are labelled with the size of the largest room that we're in
+        room_size = self.get_room_size(room_id)
+        if room_size is not None and (self.largest_room_size is None or room_size > self.largest_room_size):
+          self.largest_room_size = room_size
+
         #timeline = room["timeline"]
         events = room.get("timeline", {}).get("events", [])
         #logging.info("User [%s] /sync found %d events in room %s" % (self.username, len(events), room_id))
 
+        # Membership changes mean that the next room key has to go to a different set of devices
+        if self.e2ee and room_id in self.room_members \
+            and any(e.get("type", None) == "m.room.member" for e in events):
+          del self.room_members[room_id]
+
+        # Our own events that we're retrying tell us that the first attempt reached the server
+        if MatrixUser.pending_txns.is_allocated(self):
+          for e in events:
+            txn_id = e.get("unsigned", {}).get("transaction_id", None)
+            if txn_id in self.pending_txns and e.get("sender", None) == self.user_id:
+              self.pending_txns[txn_id] = e.get("event_id", None)
+
         # Take only the Matrix events that are "normal" room chat messages, not state updates or whatever else
         new_messages = [e for e in events if e.get("type", None) in ["m.room.message", "m.room.encrypted"]]
+        self.joined_room_ids.bump(room_id, len(new_messages))
+
+        if measure_delivery:
+          self.record_delivery_latency(room_id, new_messages)
 
         # Add the new messages to whatever we had before (if anything)
-        room_messages = self.recent_messages.get(room_id, []) + new_messages
-        # Store only the most recent 10 messages, regardless of how many we had before or how many we just received
-        self.recent_messages[room_id] = room_messages[-10:]
+        if len(new_messages) > 0:
+          room_messages = self.recent_messages.get(room_id, []) + [compact_message(e) for e in new_messages[-10:]]
+          # Store only the most recent 10 messages, regardless of how many we had before or how many we just received
+          self.recent_messages[room_id] = room_messages[-10:]
 
         # If this is the room that the user is currently looking at,
         # then we should also load all the relevant data for display,
@@ -403,34 +1247,67 @@ class MatrixUser(FastHttpUser):
         if room_id == self.current_room:
           self.load_data_for_room(room_id)
 
+      if self.identity is not None:
+        self.handle_e2ee_sync(response_json)
+
       # Finally, return the response to the caller
       return response
 
 
 
+  def record_delivery_latency(self, room_id, messages):
+    """Reports the end-to-end delivery latency of any stamped messages that other users sent us"""
+    now_us = master_time() * 1000000
+    bucket = None
+    for message in messages:
+      sent_ts = message.get("content", {}).get(SENT_TS_KEY, None)
+      if sent_ts is None or message.get("sender", None) == self.user_id:
+        continue
+      if bucket is None:
+        bucket = room_size_bucket(self.get_room_size(room_id))
+      self.environment.events.request.fire(request_type="DELIVER",
+                                           name="m.room.message [%s]" % bucket,
+                                           response_time=max(0.0, (now_us - sent_ts) / 1000),
+                                           response_length=0,
+                                           exception=None,
+                                           context={ "room_size_bucket": bucket })
+
+
+
   def sync_forever(self):
     # Continually call the /sync endpoint
     # Put anything that the user might care about into our instance variables where the user @task's can find it
 
+    failures = 0
+    last_sync_time = time.time()
     while True:
       response = self.sync()
+      now = time.time()
+      edus.add_sync_time(now - last_sync_time)
+      last_sync_time = now
+
+      if not (response is None) and response.status_code == 200:
+        failures = 0
+        continue
+      failures += 1
 
+      # Back off while the server is failing, rather than hammering it with /sync requests
       if response is None or response.status_code == 0:
         logging.error("User [%s] /sync returned a NULL response" % self.username)
+        gevent.sleep(retry_backoff(self.rng, failures))
 
       elif response.status_code == 429:
         logging.warning("User [%s] /sync says to slow down" % self.username)
-        # FIXME Handle 429 "slow down" response
-        # FIXME Kludge: For now we just insert another sleep, in addition to the one at the end of the loop below :-P
-        gevent.sleep(self.sync_timeout)
+        gevent.sleep(retry_backoff(self.rng, failures, None if response.js is None else response.js.get("retry_after_ms", None)))
 
-      elif response.status_code != 200:
+      else:
         logging.error("User [%s] /sync failed with status %d: %s" % (self.username, response.status_code, response.text))
-        response_json = response.json()
+        response_json = response.js
         if response_json is not None:
           matrix_error = response_json.get("error", "Unknown")
           matrix_errcode = response_json.get("errcode", "???")
           logging.error("User [%s] /sync error was %s: %s" % (self.username, matrix_errcode, matrix_error))
+        gevent.sleep(retry_backoff(self.rng, failures))
 
 
 
@@ -476,7 +1353,7 @@ class MatrixUser(FastHttpUser):
     return response
 
 
-  def create_room(self, alias, room_name, user_ids=[]):
+  def create_room(self, alias, room_name, user_ids=[], encrypted=False):
     url = "/_matrix/client/%s/createRoom" % self.matrix_version
     request_body = {
       "preset": "private_chat",
@@ -484,6 +1361,11 @@ class MatrixUser(FastHttpUser):
       "invite": user_ids
     }
 
+    if encrypted:
+      request_body["initial_state"] = [
+        { "type": "m.room.encryption", "state_key": "", "content": ENCRYPTION_STATE_CONTENT }
+      ]
+
     if not (alias is None):
       request_body["room_alias_name"] = alias
 
@@ -492,15 +1374,34 @@ class MatrixUser(FastHttpUser):
       #logging.info("User [%s] Back from /createRoom" % self.username)
       room_id = response.js.get("room_id", None)
       if room_id is None:
-        #logging.error("User [%s] Failed to create room for [%s]" % (self.username, room_name if room_name is not None else "Unnamed room"))
-        logging.error("User [%s] Failed to create room for [%s]" % (self.username, room_name))
-        logging.error("%s: %s" % (response.js["errcode"], response.js["error"]))
-        return None
+        if not (alias is None) and response.js.get("errcode", None) == "M_ROOM_IN_USE":
+          # An earlier run already created the room, so look it up by its alias instead
+          response.success()
+        else:
+          #logging.error("User [%s] Failed to create room for [%s]" % (self.username, room_name if room_name is not None else "Unnamed room"))
+          logging.error("User [%s] Failed to create room for [%s]" % (self.username, room_name))
+          logging.error("%s: %s" % (response.js["errcode"], response.js["error"]))
+          return None
       else:
         logging.info("User [%s] Created room [%s]" % (self.username, room_id))
         return room_id
-    ## Not sure how we might end up here, but just to be safe...
-    #return None
+
+    room_id = self.resolve_room_alias(alias)
+    if not (room_id is None):
+      logging.info("User [%s] Found existing room [%s] for [%s]" % (self.username, room_id, room_name))
+    return room_id
+
+  def resolve_room_alias(self, alias):
+    """Returns the room id for an alias localpart on our homeserver, or None"""
+    room_alias = "#%s:%s" % (alias, self.matrix_domain)
+    url = "/_matrix/client/%s/directory/room/%s" % (self.matrix_version, urllib.parse.quote(room_alias))
+    label = "/_matrix/client/%s/directory/room/_" % self.matrix_version
+    with self._matrix_api_call("GET", url, name=label) as response:
+      room_id = None if response.js is None else response.js.get("room_id", None)
+      if room_id is None:
+        logging.error("User [%s] Failed to resolve room alias %s" % (self.username, room_alias))
+        response.failure("Failed to resolve room alias")
+      return room_id
 
 
   # Child classes should implement this
@@ -508,13 +1409,73 @@ class MatrixUser(FastHttpUser):
   #  pass
 
 
+  def seed_task_selection(self):
+    """Makes Locust pick this user's top-level @tasks with our per-user RNG
+
+    Locust's default task set picks tasks with the global `random` module, so we
+    override the choice on this user's own task set instance.  A behaviour profile
+    with task weights replaces the weights of the @task decorators.
+    """
+    if self.profile is not None and len(self.profile.task_weights) > 0:
+      self._taskset_instance.get_next_task = lambda: self.profile.pick_task(self)
+    else:
+      self._taskset_instance.get_next_task = lambda: self.rng.choice(self.tasks)
+
+
+  def next_txn_id(self):
+    self.txn_counter += 1
+    return "%s.%d" % (self.txn_prefix, self.txn_counter)
+
+  @contextmanager
   def send_matrix_event(self, room_id, event):
-    txn_id = "%04x" % random.randint(0, 1<<16)
+    """Sends an event, retrying with the same transaction id on timeouts, server errors and rate limits
+
+        Use it as a context manager, like _matrix_api_call(); the caller gets the final attempt.
+        Retries are reported as "TXN retried" requests, and the retries that the server
+        deduplicated (because the event had already come down /sync) as "TXN deduplicated".
+        A 429 is retried after its retry_after_ms, if it has one.
+    """
+    if self.e2ee and event["type"] != "m.room.encrypted":
+      event = self.encrypt_event(room_id, event)
+
+    txn_id = self.next_txn_id()
 
     url = "/_matrix/client/" + self.matrix_version + "/rooms/" + room_id + "/send/" + event["type"] + "/" + txn_id
     label = "/_matrix/client/" + self.matrix_version + "/rooms/_/send/" + event["type"]
 
-    return self._matrix_api_call("PUT", url, body=event["content"], name=label)
+    for attempt in range(send_retries + 1):
+      with self._matrix_api_call("PUT", url, body=event["content"], name=label) as response:
+        rate_limited = response.status_code == HTTPStatus.TOO_MANY_REQUESTS
+        retry = response.status_code == 0 or response.status_code >= 500 or rate_limited
+        if not retry or attempt == send_retries:
+          if attempt > 0:
+            self._finish_retried_send(room_id, txn_id, response)
+          yield response
+          return
+        response.failure("HTTP %d, retrying with the same transaction id" % response.status_code)
+        self.pending_txns.setdefault(txn_id, None)
+        retry_after_ms = response.js.get("retry_after_ms", None) if rate_limited and response.js is not None else None
+      self._report_txn(room_id, "retried")
+      if retry_after_ms is not None:
+        gevent.sleep(retry_after_ms / 1000.0)
+      else:
+        gevent.sleep(SEND_RETRY_BACKOFF * 2 ** attempt * self.rng.uniform(0.5, 1.5))
+
+  def _finish_retried_send(self, room_id, txn_id, response):
+    seen_event_id = self.pending_txns.pop(txn_id, None)
+    if len(self.pending_txns) == 0:
+      del self.pending_txns
+    if seen_event_id is not None and response.js is not None and response.js.get("event_id", None) == seen_event_id:
+      self._report_txn(room_id, "deduplicated")
+
+  def _report_txn(self, room_id, outcome):
+    bucket = room_size_bucket(self.get_room_size(room_id))
+    self.environment.events.request.fire(request_type="TXN",
+                                         name="%s [%s]" % (outcome, bucket),
+                                         response_time=0,
+                                         response_length=0,
+                                         exception=None,
+                                         context={ "room_size_bucket": bucket })
 
 
   def logout(self):
@@ -532,6 +1493,9 @@ class MatrixUser(FastHttpUser):
 
 
   def _matrix_api_call(self, method, url, body=None, name=None):
+    """Makes an authenticated Matrix API call, with the body (a JSON object, or pre-encoded bytes)
+       encoded by our JSON codec.  Use it as a context manager, like Locust's rest().
+    """
     if self.access_token is None:
       logging.warning("User [%s] API call to %s failed -- No access token" % (self.username, url))
       return
@@ -541,8 +1505,76 @@ class MatrixUser(FastHttpUser):
       "Accept": "application/json",
       "Authorization": "Bearer %s" % self.access_token,
     }
+
+    # Tag room operations with the size of their room, for the per-room-size statistics
+    is_sync = url.startswith("/_matrix/client/%s/sync" % self.matrix_version)
+    room_id = room_id_from_url(url)
+    if is_sync:
+      context = { "room_size_bucket": room_size_bucket(self.largest_room_size) }
+    elif room_id is not None:
+      context = { "room_size_bucket": room_size_bucket(self.get_room_size(room_id)) }
+    else:
+      context = {}
+
+    if body is None or isinstance(body, bytes):
+      payload = body
+    else:
+      payload = codec.encode(body)
+
+    if trace_writer is not None and not is_sync:
+      room = None if room_id is None else (self.room_display_names.get(room_id) or room_id)
+      payload_size = 0 if payload is None else len(payload)
+      trace_writer.record(time.time(), self.username, "%s %s" % (method, name or url), room, payload_size)
+
     #logging.info("User [%s] Making API call to %s" % (self.username, url))
-    return self.rest(method, url, headers=headers, json=body, name=name)
+    return self._json_request(method, url, headers, payload, name, context,
+                              client=self.sync_client if is_sync else self.client)
+
+  @contextmanager
+  def _json_request(self, method, url, headers, payload, name, context, client=None):
+    """Like Locust's rest(), but with our JSON codec, and optionally timing the decoding"""
+    if bandwidth.accept_encoding is not None:
+      headers["Accept-Encoding"] = bandwidth.accept_encoding
+    # While another of our greenlets gets a new access token, wait for it rather than send the old one
+    if self.recovering_session is not None and "Authorization" in headers \
+        and self.recovering_session[0] is not gevent.getcurrent():
+      self.recovering_session[1].wait()
+      headers["Authorization"] = "Bearer %s" % self.access_token
+    with (client or self.client).request(method, url, catch_response=True, headers=headers, data=payload,
+                             name=name, context=context) as response:
+      response.js = None
+      if response.content is None:
+        response.failure(str(response.error))
+      elif response.content:
+        start = time.perf_counter()
+        try:
+          response.js = codec.decode(response.content)
+        except ValueError as e:
+          response.failure("Could not parse response as JSON. %s, response code %d, error %s"
+                           % (response.text[:250], response.status_code, e))
+        if decode_stats:
+          events.request.fire(request_type="DECODE", name=name or url,
+                              response_time=(time.perf_counter() - start) * 1000,
+                              response_length=len(response.content), exception=None, context=context)
+      try:
+        yield response
+      except AssertionError as e:
+        response.failure(e.args[0] if e.args else "Assertion failed")
+      except Exception as e:
+        short_response = response.text[:200] if response.text else response.text
+        response.failure("%s: %s. Response was %s" % (e.__class__.__name__, e, short_response))
+
+    # The server rejected our access token: refresh it or log in again, once for all of our greenlets
+    if response.status_code == HTTPStatus.UNAUTHORIZED and response.js is not None \
+        and response.js.get("errcode", None) == "M_UNKNOWN_TOKEN" \
+        and headers.get("Authorization", None) == "Bearer %s" % self.access_token and self.recovering_session is None:
+      recovery = (gevent.getcurrent(), gevent.event.Event())
+      self.recovering_session = recovery
+      try:
+        self.recover_session(response.js)
+      finally:
+        self.recovering_session = None
+        recovery[1].set()
 
 
 
@@ -585,8 +1617,8 @@ class MatrixUser(FastHttpUser):
     url = "/_matrix/client/%s/profile/%s/avatar_url" % (self.matrix_version, user_id)
     label = "/_matrix/client/%s/profile/_/avatar_url" % self.matrix_version
     with self._matrix_api_call("GET", url, name=label) as response:
-      avatar_url = response.js.get("avatar_url", None)
-      self.user_avatar_urls[user_id] = avatar_url
+      avatar_url = intern_id(response.js.get("avatar_url", None))
+      self.user_avatar_urls[intern_id(user_id)] = avatar_url
       #return avatar_url
 
 
@@ -595,8 +1627,8 @@ class MatrixUser(FastHttpUser):
     url = "/_matrix/client/%s/profile/%s/displayname" % (self.matrix_version, user_id)
     label = "/_matrix/client/%s/profile/_/displayname" % self.matrix_version
     with self._matrix_api_call("GET", url, name=label) as response:
-      displayname = response.js.get("displayname", None)
-      self.user_display_names[user_id] = displayname
+      displayname = intern_id(response.js.get("displayname", None))
+      self.user_display_names[intern_id(user_id)] = displayname
       return displayname
 
 
@@ -620,10 +1652,12 @@ class MatrixUser(FastHttpUser):
 
     # Load the avatars for recent users
     # Load the thumbnails for any messages that have one
-    messages = self.recent_messages.get(room_id, [])
+    self.load_data_for_messages(self.recent_messages.get(room_id, []))
 
+  def load_data_for_messages(self, messages):
+    """Loads the sender profiles and avatars, and the thumbnails, that a client needs to display the messages"""
     for message in messages:
-      sender_userid = message["sender"]
+      sender_userid = message.sender
       sender_avatar_mxc = self.user_avatar_urls.get(sender_userid, None)
       if sender_avatar_mxc is None:
         # FIXME Fetch the avatar URL for sender_userid
@@ -640,19 +1674,21 @@ class MatrixUser(FastHttpUser):
         sender_displayname = self.get_user_displayname(sender_userid)
 
     for message in messages:
-      content = message["content"]
-      msgtype = content["msgtype"]
-      if msgtype in ["m.image", "m.video", "m.file"]:
-        thumb_mxc = message["content"].get("thumbnail_url", None)
+      if message.msgtype in ["m.image", "m.video", "m.file"]:
+        thumb_mxc = message.thumbnail_url
         if thumb_mxc is not None:
           self.download_matrix_media(thumb_mxc)
 
+  def get_room_size(self, room_id):
+    """Returns the number of members of a room, preferably from the rooms.json assignment"""
+    room_name = self.room_display_names.get(room_id, None)
+    room_size = room_sizes_by_name.get(room_name, None)
+    if room_size is None:
+      room_size = self.room_sizes.get(room_id, None)
+    return room_size
+
   def get_random_roomid(self):
-    if len(self.joined_room_ids) > 0:
-      room_id = random.choice(list(self.joined_room_ids))
-      return room_id
-    else:
-      return None
+    return self.joined_room_ids.choice(self.rng, weighted=self.weighted_room_selection)
 
 
   def join_room(self, room_id):
@@ -682,20 +1718,210 @@ class MatrixUser(FastHttpUser):
 
   def set_typing(self, room_id, typing):
     url = "/_matrix/client/%s/rooms/%s/typing/%s" % (self.matrix_version, room_id, self.user_id)
-    body = {
-      "timeout": 10 * 1000,  # Copied from Element iOS's default initial setting -- We don't do the fancy stuff that they do, trying to figure out how long since we last set this
-      "typing": typing
-    }
+    body = TYPING_BODIES[bool(typing)]
     label = "/_matrix/client/%s/rooms/_/typing/_" % self.matrix_version
-    with self._matrix_api_call("PUT", url, body=body, name=label) as _response:
-      pass
+    with self._matrix_api_call("PUT", url, body=body, name=label) as response:
+      if response.status_code == 200:
+        edus.count_sent("m.typing")
+
+  def start_typing(self, room_id):
+    """Tells the room that we're typing, unless we already told it less than TYPING_REFRESH seconds ago"""
+    now = time.time()
+    if self.typing_room_id == room_id and now - self.typing_sent_at < TYPING_REFRESH:
+      return
+    if self.typing_room_id is not None and self.typing_room_id != room_id:
+      self.stop_typing()
+    self.typing_room_id = room_id
+    self.typing_sent_at = now
+    self.set_typing(room_id, True)
+
+  def stop_typing(self):
+    """Clears our typing notification, if we have one"""
+    if self.typing_room_id is None:
+      return
+    room_id = self.typing_room_id
+    self.typing_room_id = None
+    self.set_typing(room_id, False)
+
+  def type_message(self, room_id, duration):
+    """Pretends to type for `duration` seconds, with a keystroke every KEYSTROKE_INTERVAL seconds
+
+        Every keystroke starts (or renews) our typing notification like a client would, debounced by
+        start_typing().  The caller sends the message, or calls stop_typing() to give up on it.
+    """
+    end = time.time() + duration
+    while True:
+      self.start_typing(room_id)
+      remaining = end - time.time()
+      if remaining <= 0:
+        return
+      gevent.sleep(min(KEYSTROKE_INTERVAL, remaining))
+
+  def set_presence(self, presence):
+    """Sets our presence to "online", "unavailable" or "offline", and uses it in our /sync requests from now on"""
+    url = "/_matrix/client/%s/presence/%s/status" % (self.matrix_version, self.user_id)
+    label = "/_matrix/client/%s/presence/_/status" % self.matrix_version
+    self.presence = presence
+    with self._matrix_api_call("PUT", url, body=PRESENCE_BODIES[presence], name=label) as response:
+      if response.status_code == 200:
+        edus.count_sent("m.presence")
 
   def send_read_receipt(self, room_id, event_id):
     # POST /_matrix/client/v3/rooms/{roomId}/receipt/{receiptType}/{eventId}
     url = "/_matrix/client/%s/rooms/%s/receipt/m.read/%s" % (self.matrix_version, room_id, event_id)
+    body = READ_RECEIPT_BODY
+    label = "/_matrix/client/%s/rooms/_/receipt/m.read/_" % self.matrix_version
+    with self._matrix_api_call("POST", url, body=body, name=label) as response:
+      if response.status_code == 200:
+        edus.count_sent("m.receipt")
+
+
+  def setup_encryption(self):
+    """Creates this device's (fake) identity keys and uploads them, with a batch of one-time keys"""
+    if self.device_id is None:
+      # Users logged in from tokens.csv don't know their device id yet
+      url = "/_matrix/client/%s/account/whoami" % self.matrix_version
+      with self._matrix_api_call("GET", url) as response:
+        self.device_id = None if response.js is None else intern_id(response.js.get("device_id", None))
+      if self.device_id is None:
+        logging.error("User [%s] Can't set up encryption without a device id" % self.username)
+        return
+
+    self.identity = DeviceIdentity(self.user_id, self.device_id)
     body = {
-      "thread_id": "main"
+      "device_keys": self.identity.device_keys(),
+      "one_time_keys": self.identity.one_time_keys(ONE_TIME_KEY_TARGET),
     }
-    label = "/_matrix/client/%s/rooms/_/receipt/m.read/_" % self.matrix_version
-    with self._matrix_api_call("POST", url, body=body, name=label) as _response:
+    self._upload_keys(body)
+
+  def _upload_keys(self, body):
+    url = "/_matrix/client/%s/keys/upload" % self.matrix_version
+    with self._matrix_api_call("POST", url, body=body) as response:
+      if response.js is not None:
+        self.one_time_key_count = response.js.get("one_time_key_counts", {}).get(ONE_TIME_KEY_ALGORITHM, 0)
+
+  def handle_e2ee_sync(self, response_json):
+    """Keeps our one-time keys topped up, and forgets the devices of users whose device list changed"""
+    counts = response_json.get("device_one_time_keys_count", None)
+    if counts is not None:
+      self.one_time_key_count = counts.get(ONE_TIME_KEY_ALGORITHM, 0)
+    if self.one_time_key_count is not None and self.one_time_key_count < ONE_TIME_KEY_TARGET // 2:
+      self._upload_keys({ "one_time_keys": self.identity.one_time_keys(ONE_TIME_KEY_TARGET - self.one_time_key_count) })
+
+    for user_id in response_json.get("device_lists", {}).get("changed", []):
+      self.device_lists.pop(user_id, None)
+
+    # The to-device events carry other users' room keys; we have nothing to decrypt, so we just drop them
+
+  def get_room_members(self, room_id):
+    """Returns the user ids of the joined and invited members of a room"""
+    members = self.room_members.get(room_id, None)
+    if members is None:
+      url = "/_matrix/client/%s/rooms/%s/members?not_membership=leave" % (self.matrix_version, room_id)
+      label = "/_matrix/client/%s/rooms/_/members" % self.matrix_version
+      with self._matrix_api_call("GET", url, name=label) as response:
+        if response.js is None or "chunk" not in response.js:
+          return ()
+        members = tuple(intern_id(event["state_key"]) for event in response.js["chunk"]
+                        if event.get("content", {}).get("membership", None) in ["join", "invite"])
+      self.room_members[room_id] = members
+    return members
+
+  def query_devices(self, user_ids):
+    """Fetches the device lists of the given users that we don't have already"""
+    user_ids = [user_id for user_id in user_ids if user_id not in self.device_lists]
+    if len(user_ids) == 0:
+      return
+    url = "/_matrix/client/%s/keys/query" % self.matrix_version
+    body = { "device_keys": { user_id: [] for user_id in user_ids } }
+    with self._matrix_api_call("POST", url, body=body) as response:
+      if response.js is None:
+        return
+      device_keys = response.js.get("device_keys", {})
+      for user_id in user_ids:
+        devices = device_keys.get(user_id, {})
+        self.device_lists[user_id] = tuple(
+          (intern_id(device_id), keys.get("keys", {}).get("curve25519:" + device_id, None))
+          for (device_id, keys) in devices.items()
+        )
+
+  def claim_one_time_keys(self, devices):
+    """Claims one-time keys to start Olm sessions with the given (user_id, device_id) devices
+
+        Returns the devices that we got a key for.
+    """
+    request = {}
+    for (user_id, device_id) in devices:
+      request.setdefault(user_id, {})[device_id] = ONE_TIME_KEY_ALGORITHM
+    url = "/_matrix/client/%s/keys/claim" % self.matrix_version
+    claimed = set()
+    with self._matrix_api_call("POST", url, body={ "one_time_keys": request }) as response:
+      if response.js is None:
+        return claimed
+      for user_id, user_keys in response.js.get("one_time_keys", {}).items():
+        claimed.update((user_id, device_id) for device_id in user_keys)
+    self.olm_sessions.update(claimed)
+    return claimed
+
+  def send_to_device(self, event_type, messages):
+    """Sends to-device events, given as { user_id: { device_id: content } }"""
+    url = "/_matrix/client/%s/sendToDevice/%s/%s" % (self.matrix_version, event_type, self.next_txn_id())
+    label = "/_matrix/client/%s/sendToDevice/%s" % (self.matrix_version, event_type)
+    with self._matrix_api_call("PUT", url, body={ "messages": messages }, name=label) as _response:
       pass
+
+  def share_room_key(self, room_id):
+    """Returns our outbound Megolm session for a room, after sending its key to any member devices
+       that don't have it yet -- the expensive part of end-to-end encryption for the server.
+    """
+    session = self.outbound_sessions.get(room_id, None)
+    if session is None or session.needs_rotation():
+      session = OutboundSession()
+      self.outbound_sessions[room_id] = session
+
+    members = self.get_room_members(room_id)
+    self.query_devices(members)
+    devices = [(user_id, device_id, key) for user_id in members
+               for (device_id, key) in self.device_lists.get(user_id, ())
+               if (user_id, device_id) not in session.shared_with and key is not None
+               and device_id != self.device_id]
+    if len(devices) == 0:
+      return session
+
+    new_devices = [(user_id, device_id) for (user_id, device_id, _key) in devices
+                   if (user_id, device_id) not in self.olm_sessions]
+    claimed = self.claim_one_time_keys(new_devices) if len(new_devices) > 0 else set()
+
+    # Send the room key in batches of at most TO_DEVICE_BATCH_SIZE devices
+    batch = {}
+    batch_size = 0
+    for (user_id, device_id, key) in devices:
+      if (user_id, device_id) not in self.olm_sessions:
+        # The device has run out of one-time keys, so don't try again until the next session
+        session.shared_with.add((user_id, device_id))
+        continue
+      batch.setdefault(user_id, {})[device_id] = olm_content(self.identity, key, (user_id, device_id) in claimed)
+      session.shared_with.add((user_id, device_id))
+      batch_size += 1
+      if batch_size >= TO_DEVICE_BATCH_SIZE:
+        self.send_to_device("m.room.encrypted", batch)
+        batch = {}
+        batch_size = 0
+    if batch_size > 0:
+      self.send_to_device("m.room.encrypted", batch)
+    return session
+
+  def encrypt_event(self, room_id, event):
+    """Returns an m.room.encrypted event with a ciphertext of the right size for the given event"""
+    if self.identity is None:
+      self.setup_encryption()
+      if self.identity is None:
+        return event
+    content = event["content"]
+    plaintext_length = len(content) if isinstance(content, bytes) else len(codec.encode(content))
+    session = self.share_room_key(room_id)
+    session.message_count += 1
+    prefix = megolm_content_prefix(self.identity, session, plaintext_length + len(room_id) + len(event["type"]))
+    # Only messages carry the delivery latency fields (see stamp_message_content())
+    encrypted_content = stamp_encoded_content(prefix) if event["type"] == "m.room.message" else prefix + b"}"
+    return { "type": "m.room.encrypted", "content": encrypted_content }
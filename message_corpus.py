@@ -0,0 +1,94 @@
+################################################################################
+#
+# message_corpus.py - Pre-encoded message payloads for the chat users
+#
+# generate_messages.py writes a corpus of m.room.message contents, already
+# encoded to JSON, and MatrixChatUser picks its messages from it, so sending a
+# message costs no JSON encoding at all.  The corpus file is memory-mapped, so
+# all the workers on a machine share one copy through the page cache.
+#
+# Each payload is the UTF-8 JSON of the content without its closing brace, so
+# that stamp_encoded_content() can append the delivery latency fields.  Replies
+# and edits refer to another event, and mentions to another user, so their
+# payloads contain placeholders (characters from the Unicode private use area,
+# which never appear in the generated text) that render() fills in.
+#
+# File layout:
+#   * 8 byte magic, followed by the number of payloads (uint32)
+#   * One index entry per payload: offset (uint32), length (uint32), flags (uint8)
+#   * The payloads
+#
+################################################################################
+
+import mmap
+import struct
+
+CORPUS_MAGIC = b"MXMSGS01"
+CORPUS_HEADER = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<IIB")
+
+# Placeholders, and the flags that say which ones a payload contains
+EVENT_ID_PLACEHOLDER = "\ue000"
+USER_ID_PLACEHOLDER = "\ue001"
+NEEDS_EVENT_ID = 0x01
+NEEDS_USER_ID = 0x02
+IS_EDIT = 0x04      # The event id must be one of the sender's own messages
+
+EVENT_ID_PLACEHOLDER_BYTES = EVENT_ID_PLACEHOLDER.encode("utf-8")
+USER_ID_PLACEHOLDER_BYTES = USER_ID_PLACEHOLDER.encode("utf-8")
+
+
+def write_corpus(path, payloads):
+    """Writes a corpus file from a list of (flags, payload bytes)"""
+    data_start = len(CORPUS_MAGIC) + CORPUS_HEADER.size + INDEX_ENTRY.size * len(payloads)
+    with open(path, "wb") as corpus_file:
+        corpus_file.write(CORPUS_MAGIC)
+        corpus_file.write(CORPUS_HEADER.pack(len(payloads)))
+        offset = data_start
+        for (flags, payload) in payloads:
+            corpus_file.write(INDEX_ENTRY.pack(offset, len(payload), flags))
+            offset += len(payload)
+        for (_flags, payload) in payloads:
+            corpus_file.write(payload)
+
+
+class MessageCorpus:
+    """A memory-mapped corpus of pre-encoded message contents"""
+
+    def __init__(self, path):
+        with open(path, "rb") as corpus_file:
+            self.data = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(CORPUS_MAGIC)] != CORPUS_MAGIC:
+            raise ValueError(f"{path} is not a message corpus")
+        (self.count,) = CORPUS_HEADER.unpack_from(self.data, len(CORPUS_MAGIC))
+        self.index_start = len(CORPUS_MAGIC) + CORPUS_HEADER.size
+        if self.count == 0:
+            raise ValueError(f"{path} is empty")
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index):
+        """Returns (flags, payload bytes) for the payload at the given index"""
+        offset, length, flags = INDEX_ENTRY.unpack_from(self.data, self.index_start + index * INDEX_ENTRY.size)
+        return flags, self.data[offset:offset + length]
+
+    def pick(self, rng):
+        """Returns (flags, payload bytes) for a random payload"""
+        return self.get(rng.randrange(self.count))
+
+    @staticmethod
+    def render(payload, flags, event_id=None, user_id=None):
+        """Fills in the placeholders of a payload
+
+        Returns None if the payload needs an event id or a user id that we don't have.
+        """
+        if flags & NEEDS_EVENT_ID:
+            if event_id is None:
+                return None
+            payload = payload.replace(EVENT_ID_PLACEHOLDER_BYTES, event_id.encode("utf-8"))
+        if flags & NEEDS_USER_ID:
+            if user_id is None:
+                return None
+            payload = payload.replace(USER_ID_PLACEHOLDER_BYTES, user_id.encode("utf-8"))
+        return payload
@@ -0,0 +1,772 @@
+#!/bin/env python3
+
+################################################################################
+#
+# mock_homeserver.py - A lightweight in-memory Matrix homeserver for testing
+#
+# This is not a real homeserver.  It implements just enough of the Matrix
+# client-server API for our Locust scripts (register, login, /sync long-polls,
+# createRoom, join, send, /messages, room members, profiles, media, typing,
+# receipts, and the end-to-end encryption key and to-device APIs) so
+# that we can exercise the load generator without a real server.  Because the
+# mock does almost no work per request, it shows how much load the generator
+# itself can produce before it becomes the bottleneck.
+#
+# The response times and the sizes of the events that the mock returns can be
+# shaped with a latency model and a payload size model, e.g.
+#
+#   python3 mock_homeserver.py --port 8008 --latency exp:20 --event-padding exp:512
+#
+# adds an exponentially distributed delay with a 20 ms mean to every request,
+# and pads every event with ~512 bytes of extra data on average.
+# --send-error-rate makes a fraction of the /send requests fail with a 500
+# after the event was stored, to exercise the clients' retries.  With
+# --compression gzip,br it compresses the JSON responses for the clients that
+# accept one of those encodings, like a server behind a compressing proxy.
+# --admin-token creates an admin user with the given access token, for the
+# admin user API that bulk_register.py can use.  Typing notifications and read
+# receipts reach the other members of the room through /sync, and so does
+# presence with --presence (off by default, like on servers that disable
+# presence).
+#
+################################################################################
+
+import argparse
+import bisect
+import hmac
+import json
+import random
+import re
+import secrets
+import time
+import urllib.parse
+import zlib
+
+import gevent
+import gevent.event
+from gevent.pywsgi import WSGIServer
+
+from registration import registration_mac
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are never compressed
+COMPRESSION_MIN_BYTES = 256
+
+
+class MatrixError(Exception):
+
+    def __init__(self, status, errcode, error, **extra):
+        super().__init__(error)
+        self.status = status
+        self.body = { "errcode": errcode, "error": error, **extra }
+
+
+def parse_model(spec):
+    """Parses a model spec like "none", "const:5", "exp:20" or "lognorm:6,1" into a sampling function"""
+    if spec is None or spec == "none":
+        return lambda: 0.0
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognorm":
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown model {spec!r}")
+
+
+class Room:
+
+    def __init__(self, room_id, creator, name):
+        self.room_id = room_id
+        self.creator = creator
+        self.name = name
+        self.members = set()
+        self.invited = set()
+        self.events = []    # List of (stream position, event)
+        self.encryption = None  # Content of the m.room.encryption state event, if any
+        self.typing = {}        # user_id -> when its typing notification times out
+        self.typing_position = 0    # Stream position of the last typing change
+        self.receipts = {}      # user_id -> (stream position, receipt type, event_id, ts)
+
+
+class MockHomeserver:
+
+    def __init__(self, server_name="mock.local", shared_secret="mock", latency=None, event_padding=None,
+                 send_error_rate=0.0, login_error_rate=0.0, token_lifetime=None, compression=(),
+                 presence=False, admin_token=None):
+        self.server_name = server_name
+        self.shared_secret = shared_secret
+        self.latency = parse_model(latency)
+        self.event_padding = parse_model(event_padding)
+        self.send_error_rate = send_error_rate
+        self.login_error_rate = login_error_rate
+        self.token_lifetime = token_lifetime
+        self.compression = compression      # Content encodings that we offer, in order of preference
+        self.presence_enabled = presence
+
+        self.passwords = {}     # user_id -> password
+        self.tokens = {}        # access_token -> user_id
+        self.devices = {}       # access_token -> device_id
+        self.token_expiry = {}  # access_token -> expiry time, for the tokens that came with a refresh token
+        self.refresh_tokens = {}    # refresh_token -> (user_id, device_id)
+        self.profiles = {}      # user_id -> {"displayname": ..., "avatar_url": ...}
+        self.rooms = {}         # room_id -> Room
+        self.aliases = {}       # room alias -> room_id
+        self.joined = {}        # user_id -> set of room_ids
+        self.invites = {}       # user_id -> {room_id: stream position}
+        self.wakeups = {}       # user_id -> gevent Event, set when there is something new to sync
+        self.media = {}         # media_id -> (content_type, data)
+        self.nonces = set()
+        self.admins = set()     # user_ids of the admin users
+        self.txns = {}          # (access_token, txn_id) -> event_id
+        self.presence = {}      # user_id -> (presence, stream position, last active time)
+
+        # End-to-end encryption
+        self.device_keys = {}   # user_id -> {device_id: device keys}
+        self.one_time_keys = {} # (user_id, device_id) -> list of {key_id: key}
+        self.to_device = {}     # (user_id, device_id) -> list of (stream position, event)
+        self.device_changes = []    # List of (stream position, user_id)
+
+        self.stream_position = 0
+        self.num_requests = 0
+
+        self.routes = [
+            ("POST", r"/_matrix/client/v3/register", self.register),
+            ("GET", r"/_synapse/admin/v1/register", self.admin_register_nonce),
+            ("POST", r"/_synapse/admin/v1/register", self.admin_register),
+            ("PUT", r"/_synapse/admin/v2/users/(?P<user_id>[^/]+)", self.admin_put_user),
+            ("POST", r"/_synapse/admin/v1/users/(?P<user_id>[^/]+)/login", self.admin_login_as_user),
+            ("POST", r"/_matrix/client/v3/login", self.login),
+            ("POST", r"/_matrix/client/v3/logout", self.logout),
+            ("POST", r"/_matrix/client/v3/refresh", self.refresh),
+            ("GET", r"/_matrix/client/v3/account/whoami", self.whoami),
+            ("GET", r"/_matrix/client/v3/sync", self.sync),
+            ("POST", r"/_matrix/client/v3/createRoom", self.create_room),
+            ("POST", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/join", self.join),
+            ("POST", r"/_matrix/client/v3/join/(?P<room_id>[^/]+)", self.join),
+            ("PUT", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/send/(?P<event_type>[^/]+)/(?P<txn_id>[^/]+)",
+             self.send),
+            ("GET", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/messages", self.messages),
+            ("GET", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/members", self.members),
+            ("GET", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/joined_members", self.joined_members),
+            ("GET", r"/_matrix/client/v3/directory/room/(?P<room_alias>[^/]+)", self.directory),
+            ("PUT", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/typing/(?P<user_id>[^/]+)", self.typing),
+            ("POST", r"/_matrix/client/v3/rooms/(?P<room_id>[^/]+)/receipt/(?P<receipt_type>[^/]+)/(?P<event_id>[^/]+)",
+             self.receipt),
+            ("PUT", r"/_matrix/client/v3/presence/(?P<user_id>[^/]+)/status", self.set_presence),
+            ("GET", r"/_matrix/client/v3/profile/(?P<user_id>[^/]+)/(?P<field>displayname|avatar_url)",
+             self.get_profile),
+            ("PUT", r"/_matrix/client/v3/profile/(?P<user_id>[^/]+)/(?P<field>displayname|avatar_url)",
+             self.set_profile),
+            ("POST", r"/_matrix/client/v3/profile/(?P<user_id>[^/]+)/(?P<field>displayname|avatar_url)",
+             self.set_profile),
+            ("POST", r"/_matrix/client/v3/keys/upload", self.keys_upload),
+            ("POST", r"/_matrix/client/v3/keys/query", self.keys_query),
+            ("POST", r"/_matrix/client/v3/keys/claim", self.keys_claim),
+            ("PUT", r"/_matrix/client/v3/sendToDevice/(?P<event_type>[^/]+)/(?P<txn_id>[^/]+)", self.send_to_device),
+            ("POST", r"/_matrix/media/v3/upload", self.upload),
+            ("GET", r"/_matrix/media/v3/download/(?P<server_name>[^/]+)/(?P<media_id>[^/]+)", self.download),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler) for (method, pattern, handler) in self.routes]
+
+        if admin_token is not None:
+            admin_user_id = self._new_user("admin", secrets.token_hex(16))
+            self.admins.add(admin_user_id)
+            self.tokens[admin_token] = admin_user_id
+            self.devices[admin_token] = "ADMIN"
+
+    # Helpers ##################################################################
+
+    def _new_user(self, username, password):
+        user_id = f"@{username}:{self.server_name}"
+        if user_id in self.passwords:
+            raise MatrixError(400, "M_USER_IN_USE", "User ID already taken")
+        self.passwords[user_id] = password
+        self.profiles[user_id] = {}
+        self.joined[user_id] = set()
+        self.invites[user_id] = {}
+        self.wakeups[user_id] = gevent.event.Event()
+        return user_id
+
+    def _new_session(self, user_id, device_id=None, refreshable=False):
+        access_token = secrets.token_hex(16)
+        device_id = device_id or secrets.token_hex(5).upper()
+        self.tokens[access_token] = user_id
+        self.devices[access_token] = device_id
+        session = { "user_id": user_id, "access_token": access_token,
+                    "device_id": device_id, "home_server": self.server_name }
+        if refreshable:
+            refresh_token = secrets.token_hex(16)
+            self.refresh_tokens[refresh_token] = (user_id, device_id)
+            session["refresh_token"] = refresh_token
+            if self.token_lifetime is not None:
+                self.token_expiry[access_token] = time.time() + self.token_lifetime
+                session["expires_in_ms"] = int(self.token_lifetime * 1000)
+        return session
+
+    def _authenticate(self, request):
+        header = request["headers"].get("HTTP_AUTHORIZATION", "")
+        access_token = header[len("Bearer "):] if header.startswith("Bearer ") else None
+        user_id = self.tokens.get(access_token, None)
+        if user_id is None:
+            raise MatrixError(401, "M_UNKNOWN_TOKEN", "Unknown access token", soft_logout=False)
+        if self.token_expiry.get(access_token, float("inf")) < time.time():
+            raise MatrixError(401, "M_UNKNOWN_TOKEN", "Access token has expired", soft_logout=True)
+        return user_id
+
+    def _device(self, request):
+        header = request["headers"].get("HTTP_AUTHORIZATION", "")
+        return self.devices.get(header[len("Bearer "):], None)
+
+    def _room(self, room_id):
+        room = self.rooms.get(room_id, None)
+        if room is None:
+            raise MatrixError(404, "M_NOT_FOUND", "Unknown room")
+        return room
+
+    def _wake(self, user_ids):
+        for user_id in user_ids:
+            wakeup = self.wakeups.get(user_id, None)
+            if wakeup is not None:
+                wakeup.set()
+
+    def _shared_users(self, user_id):
+        return set(member for room_id in self.joined[user_id] for member in self.rooms[room_id].members)
+
+    def _append_event(self, room, sender, event_type, content, state_key=None):
+        self.stream_position += 1
+        event = {
+            "type": event_type,
+            "sender": sender,
+            "content": content,
+            "event_id": f"${self.stream_position}:{self.server_name}",
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room.room_id,
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+        padding = int(self.event_padding())
+        if padding > 0:
+            event["unsigned"] = { "padding": "x" * padding }
+        room.events.append((self.stream_position, event))
+        self._wake(room.members)
+        return event
+
+    # Accounts #################################################################
+
+    def register(self, request, body):
+        auth = body.get("auth", None)
+        if auth is None or auth.get("type", None) != "m.login.dummy":
+            raise MatrixError(401, "M_FORBIDDEN", "Authentication required",
+                              flows=[{ "stages": ["m.login.dummy"] }], params={}, session=secrets.token_hex(8))
+        user_id = self._new_user(body["username"], body["password"])
+        return 200, self._new_session(user_id)
+
+    def admin_register_nonce(self, request, body):
+        nonce = secrets.token_hex(16)
+        self.nonces.add(nonce)
+        return 200, { "nonce": nonce }
+
+    def admin_register(self, request, body):
+        nonce = body.get("nonce", None)
+        if nonce not in self.nonces:
+            raise MatrixError(400, "M_UNKNOWN", "Unrecognised nonce")
+        self.nonces.discard(nonce)
+        admin = body.get("admin", False)
+        mac = registration_mac(self.shared_secret, nonce, body["username"], body["password"], admin)
+        if not hmac.compare_digest(mac, body.get("mac", "")):
+            raise MatrixError(403, "M_FORBIDDEN", "HMAC incorrect")
+        user_id = self._new_user(body["username"], body["password"])
+        if admin:
+            self.admins.add(user_id)
+        return 200, self._new_session(user_id)
+
+    def _authenticate_admin(self, request):
+        user_id = self._authenticate(request)
+        if user_id not in self.admins:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not a server admin")
+        return user_id
+
+    def admin_put_user(self, request, body, user_id):
+        self._authenticate_admin(request)
+        if not user_id.endswith(f":{self.server_name}"):
+            raise MatrixError(400, "M_INVALID_PARAM", "Can only create local users")
+        if user_id in self.passwords:
+            self.passwords[user_id] = body.get("password", self.passwords[user_id])
+            return 200, { "name": user_id, "admin": user_id in self.admins }
+        self._new_user(user_id[1:].split(":", 1)[0], body.get("password", None))
+        if body.get("admin", False):
+            self.admins.add(user_id)
+        return 201, { "name": user_id, "admin": user_id in self.admins }
+
+    def admin_login_as_user(self, request, body, user_id):
+        self._authenticate_admin(request)
+        if user_id not in self.passwords:
+            raise MatrixError(404, "M_NOT_FOUND", "Unknown user")
+        return 200, { "access_token": self._new_session(user_id)["access_token"] }
+
+    def login(self, request, body):
+        username = body.get("identifier", {}).get("user", body.get("user", ""))
+        user_id = username if username.startswith("@") else f"@{username}:{self.server_name}"
+        if self.login_error_rate > 0 and random.random() < self.login_error_rate:
+            raise MatrixError(429, "M_LIMIT_EXCEEDED", "Too many requests", retry_after_ms=500)
+        if self.passwords.get(user_id, None) != body.get("password", None):
+            raise MatrixError(403, "M_FORBIDDEN", "Invalid username or password")
+        return 200, self._new_session(user_id, body.get("device_id", None), body.get("refresh_token", False))
+
+    def refresh(self, request, body):
+        session = self.refresh_tokens.pop(body.get("refresh_token", None), None)
+        if session is None:
+            raise MatrixError(401, "M_UNKNOWN_TOKEN", "Unknown refresh token", soft_logout=False)
+        user_id, device_id = session
+        return 200, self._new_session(user_id, device_id, refreshable=True)
+
+    def logout(self, request, body):
+        self._authenticate(request)
+        header = request["headers"]["HTTP_AUTHORIZATION"]
+        self.tokens.pop(header[len("Bearer "):], None)
+        self.devices.pop(header[len("Bearer "):], None)
+        return 200, {}
+
+    def whoami(self, request, body):
+        return 200, { "user_id": self._authenticate(request), "device_id": self._device(request) }
+
+    # Sync #####################################################################
+
+    def _sync_response(self, user_id, device_id, since):
+        rooms_join = {}
+        for room_id in self.joined[user_id]:
+            room = self.rooms[room_id]
+            first = bisect.bisect_right(room.events, since, key=lambda position_event: position_event[0])
+            events = [event for (_position, event) in room.events[first:]]
+            ephemeral = self._ephemeral_events(room, since)
+            if since > 0 and len(events) == 0 and len(ephemeral) == 0:
+                continue
+            joined_room = { "timeline": { "events": events[-20:], "limited": len(events) > 20,
+                                          "prev_batch": str(room.events[-1][0]) } }
+            if len(ephemeral) > 0:
+                joined_room["ephemeral"] = { "events": ephemeral }
+            if since == 0:
+                joined_room["state"] = { "events": [
+                    { "type": "m.room.name", "state_key": "", "sender": room.creator, "content": { "name": room.name } }
+                ] if room.name else [] }
+                if room.encryption is not None:
+                    joined_room["state"]["events"].append({ "type": "m.room.encryption", "state_key": "",
+                                                            "sender": room.creator, "content": room.encryption })
+                joined_room["summary"] = { "m.joined_member_count": len(room.members) }
+            rooms_join[room_id] = joined_room
+
+        rooms_invite = {}
+        for room_id, position in self.invites[user_id].items():
+            if position > since:
+                room = self.rooms[room_id]
+                rooms_invite[room_id] = { "invite_state": { "events": [
+                    { "type": "m.room.name", "state_key": "", "sender": room.creator, "content": { "name": room.name } }
+                ] } }
+
+        to_device = [event for (position, event) in self.to_device.get((user_id, device_id), []) if position > since]
+        # Forget the to-device messages that this sync acknowledges
+        if since > 0 and (user_id, device_id) in self.to_device:
+            self.to_device[(user_id, device_id)] = [(position, event) for (position, event)
+                                                    in self.to_device[(user_id, device_id)] if position > since]
+
+        first = bisect.bisect_right(self.device_changes, since, key=lambda position_user: position_user[0])
+        shared_users = self._shared_users(user_id)
+        changed = sorted(set(changed_user for (_position, changed_user) in self.device_changes[first:]
+                             if changed_user in shared_users)) if since > 0 else []
+
+        now = time.time()
+        presence = [{ "type": "m.presence", "sender": other_user,
+                      "content": { "presence": state, "last_active_ago": int((now - last_active) * 1000),
+                                   "currently_active": state == "online" } }
+                    for (other_user, (state, position, last_active))
+                    in ((other_user, self.presence[other_user]) for other_user in shared_users
+                        if other_user in self.presence)
+                    if position > since]
+
+        # The initial sync always returns right away, even when there is nothing in it
+        if since > 0 and len(rooms_join) == 0 and len(rooms_invite) == 0 and len(to_device) == 0 \
+                and len(changed) == 0 and len(presence) == 0:
+            return None
+        response = { "next_batch": str(self.stream_position),
+                     "rooms": { "join": rooms_join, "invite": rooms_invite } }
+        if len(presence) > 0:
+            response["presence"] = { "events": presence }
+        if len(to_device) > 0:
+            response["to_device"] = { "events": to_device }
+        if len(changed) > 0:
+            response["device_lists"] = { "changed": changed }
+        if device_id is not None and (user_id, device_id) in self.one_time_keys:
+            response["device_one_time_keys_count"] = {
+                "signed_curve25519": len(self.one_time_keys[(user_id, device_id)])
+            }
+        return response
+
+    def sync(self, request, body):
+        user_id = self._authenticate(request)
+        query = request["query"]
+        since = int(query.get("since", "0") or 0)
+        timeout = int(query.get("timeout", "0")) / 1000.0
+
+        device_id = self._device(request)
+        # Polling /sync marks the user online, unless it asks for another presence
+        self._update_presence(user_id, query.get("set_presence", "online"))
+        wakeup = self.wakeups[user_id]
+        deadline = time.monotonic() + timeout
+        while True:
+            wakeup.clear()
+            response = self._sync_response(user_id, device_id, since)
+            if response is not None:
+                return 200, response
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not wakeup.wait(remaining):
+                return 200, { "next_batch": str(max(since, self.stream_position)), "rooms": {} }
+
+    # Rooms ####################################################################
+
+    def create_room(self, request, body):
+        user_id = self._authenticate(request)
+        room_id = f"!{secrets.token_hex(9)}:{self.server_name}"
+        room = Room(room_id, user_id, body.get("name", None))
+        self.rooms[room_id] = room
+
+        alias = body.get("room_alias_name", None)
+        if alias is not None:
+            full_alias = f"#{alias}:{self.server_name}"
+            if full_alias in self.aliases:
+                del self.rooms[room_id]
+                raise MatrixError(400, "M_ROOM_IN_USE", "Room alias already taken")
+            self.aliases[full_alias] = room_id
+
+        room.members.add(user_id)
+        self.joined[user_id].add(room_id)
+        self._append_event(room, user_id, "m.room.create", { "creator": user_id }, state_key="")
+        for state_event in body.get("initial_state", []):
+            if state_event.get("type", None) == "m.room.encryption":
+                room.encryption = state_event.get("content", {})
+            self._append_event(room, user_id, state_event["type"], state_event.get("content", {}),
+                               state_key=state_event.get("state_key", ""))
+        for invitee in body.get("invite", []):
+            if invitee not in self.passwords:
+                continue
+            room.invited.add(invitee)
+            self._append_event(room, user_id, "m.room.member", { "membership": "invite" }, state_key=invitee)
+            self.invites[invitee][room_id] = self.stream_position
+            self._wake([invitee])
+        return 200, { "room_id": room_id }
+
+    def join(self, request, body, room_id):
+        user_id = self._authenticate(request)
+        room_id = self.aliases.get(room_id, room_id)
+        room = self._room(room_id)
+        if user_id not in room.members:
+            if user_id not in room.invited:
+                raise MatrixError(403, "M_FORBIDDEN", "You are not invited to this room")
+            room.invited.discard(user_id)
+            self.invites[user_id].pop(room_id, None)
+            room.members.add(user_id)
+            self.joined[user_id].add(room_id)
+            self._append_event(room, user_id, "m.room.member", { "membership": "join" }, state_key=user_id)
+        return 200, { "room_id": room_id }
+
+    def send(self, request, body, room_id, event_type, txn_id):
+        user_id = self._authenticate(request)
+        room = self._room(room_id)
+        if user_id not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+        txn_key = (request["headers"]["HTTP_AUTHORIZATION"], txn_id)
+        event_id = self.txns.get(txn_key, None)
+        if event_id is None:
+            event = self._append_event(room, user_id, event_type, body)
+            event["unsigned"] = { **event.get("unsigned", {}), "transaction_id": txn_id }
+            event_id = event["event_id"]
+            self.txns[txn_key] = event_id
+            if self.send_error_rate > 0 and random.random() < self.send_error_rate:
+                raise MatrixError(500, "M_UNKNOWN", "Simulated failure after the event was stored")
+        return 200, { "event_id": event_id }
+
+    def messages(self, request, body, room_id):
+        user_id = self._authenticate(request)
+        room = self._room(room_id)
+        if user_id not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+        query = request["query"]
+        start = int(query.get("from", str(self.stream_position)) or self.stream_position)
+        limit = int(query.get("limit", "10"))
+        chunk = [event for (position, event) in reversed(room.events) if position <= start][:limit]
+        response = { "chunk": chunk, "start": str(start) }
+        if len(chunk) == limit:
+            response["end"] = str(int(chunk[-1]["event_id"][1:].split(":")[0]) - 1)
+        return 200, response
+
+    def members(self, request, body, room_id):
+        user_id = self._authenticate(request)
+        room = self._room(room_id)
+        if user_id not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+        chunk = [{ "type": "m.room.member", "state_key": member, "sender": member, "room_id": room_id,
+                   "content": { "membership": "join" } } for member in sorted(room.members)]
+        if request["query"].get("not_membership", None) != "invite":
+            chunk += [{ "type": "m.room.member", "state_key": invitee, "sender": room.creator, "room_id": room_id,
+                        "content": { "membership": "invite" } } for invitee in sorted(room.invited)]
+        return 200, { "chunk": chunk }
+
+    def joined_members(self, request, body, room_id):
+        user_id = self._authenticate(request)
+        room = self._room(room_id)
+        if user_id not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+        return 200, { "joined": { member: self.profiles.get(member, {}) for member in sorted(room.members) } }
+
+    def directory(self, request, body, room_alias):
+        room_id = self.aliases.get(room_alias, None)
+        if room_id is None:
+            raise MatrixError(404, "M_NOT_FOUND", "Room alias not found")
+        return 200, { "room_id": room_id, "servers": [self.server_name] }
+
+    # Typing, receipts and presence ###########################################
+
+    def _ephemeral_events(self, room, since):
+        """Returns the room's m.typing and m.receipt EDUs that changed after the given stream position"""
+        ephemeral = []
+        if room.typing_position > since:
+            now = time.time()
+            ephemeral.append({ "type": "m.typing", "content": {
+                "user_ids": sorted(user_id for (user_id, expiry) in room.typing.items() if expiry > now) } })
+        receipts = {}
+        for user_id, (position, receipt_type, event_id, ts) in room.receipts.items():
+            if position > since:
+                receipts.setdefault(event_id, {}).setdefault(receipt_type, {})[user_id] = { "ts": ts }
+        if len(receipts) > 0:
+            ephemeral.append({ "type": "m.receipt", "content": receipts })
+        return ephemeral
+
+    def typing(self, request, body, room_id, user_id):
+        sender = self._authenticate(request)
+        room = self._room(room_id)
+        if user_id != sender or sender not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You can't set the typing state of this user in this room")
+        if body.get("typing", False):
+            room.typing[sender] = time.time() + body.get("timeout", 30000) / 1000.0
+        elif room.typing.pop(sender, None) is None:
+            return 200, {}
+        self.stream_position += 1
+        room.typing_position = self.stream_position
+        self._wake(room.members)
+        return 200, {}
+
+    def receipt(self, request, body, room_id, receipt_type, event_id):
+        sender = self._authenticate(request)
+        room = self._room(room_id)
+        if sender not in room.members:
+            raise MatrixError(403, "M_FORBIDDEN", "You are not in this room")
+        self.stream_position += 1
+        room.receipts[sender] = (self.stream_position, receipt_type, event_id, int(time.time() * 1000))
+        self._wake(room.members)
+        return 200, {}
+
+    def _update_presence(self, user_id, presence):
+        if not self.presence_enabled:
+            return
+        current = self.presence.get(user_id, None)
+        if current is not None and current[0] == presence:
+            return
+        self.stream_position += 1
+        self.presence[user_id] = (presence, self.stream_position, time.time())
+        self._wake(self._shared_users(user_id))
+
+    def set_presence(self, request, body, user_id):
+        sender = self._authenticate(request)
+        if user_id != sender:
+            raise MatrixError(403, "M_FORBIDDEN", "You can't set the presence of another user")
+        if body.get("presence", None) not in ["online", "unavailable", "offline"]:
+            raise MatrixError(400, "M_INVALID_PARAM", "Unknown presence state")
+        self._update_presence(sender, body["presence"])
+        return 200, {}
+
+    # End-to-end encryption ####################################################
+
+    def keys_upload(self, request, body):
+        user_id = self._authenticate(request)
+        device_id = self._device(request)
+        device_keys = body.get("device_keys", None)
+        if device_keys is not None:
+            is_new = device_id not in self.device_keys.get(user_id, {})
+            self.device_keys.setdefault(user_id, {})[device_id] = device_keys
+            if is_new:
+                # Tell everyone who shares a room with us to query our keys again
+                self.stream_position += 1
+                self.device_changes.append((self.stream_position, user_id))
+                self._wake(set(member for room_id in self.joined[user_id] for member in self.rooms[room_id].members))
+        keys = self.one_time_keys.setdefault((user_id, device_id), [])
+        keys.extend({ key_id: key } for (key_id, key) in body.get("one_time_keys", {}).items())
+        return 200, { "one_time_key_counts": { "signed_curve25519": len(keys) } }
+
+    def keys_query(self, request, body):
+        self._authenticate(request)
+        device_keys = {}
+        for user_id, device_ids in body.get("device_keys", {}).items():
+            devices = self.device_keys.get(user_id, {})
+            device_keys[user_id] = { device_id: keys for (device_id, keys) in devices.items()
+                                     if len(device_ids) == 0 or device_id in device_ids }
+        return 200, { "device_keys": device_keys, "failures": {} }
+
+    def keys_claim(self, request, body):
+        self._authenticate(request)
+        one_time_keys = {}
+        for user_id, devices in body.get("one_time_keys", {}).items():
+            for device_id in devices:
+                keys = self.one_time_keys.get((user_id, device_id), [])
+                if len(keys) > 0:
+                    one_time_keys.setdefault(user_id, {})[device_id] = keys.pop(0)
+        return 200, { "one_time_keys": one_time_keys, "failures": {} }
+
+    def send_to_device(self, request, body, event_type, txn_id):
+        sender = self._authenticate(request)
+        txn_key = (request["headers"]["HTTP_AUTHORIZATION"], txn_id)
+        if txn_key in self.txns:
+            return 200, {}
+        self.txns[txn_key] = None
+        self.stream_position += 1
+        recipients = set()
+        for user_id, devices in body.get("messages", {}).items():
+            device_ids = list(self.device_keys.get(user_id, {}).keys()) if "*" in devices else devices.keys()
+            for device_id in device_ids:
+                content = devices.get(device_id, devices.get("*", {}))
+                event = { "type": event_type, "sender": sender, "content": content }
+                self.to_device.setdefault((user_id, device_id), []).append((self.stream_position, event))
+                recipients.add(user_id)
+        self._wake(recipients)
+        return 200, {}
+
+    # Profiles and media #######################################################
+
+    def get_profile(self, request, body, user_id, field):
+        self._authenticate(request)
+        profile = self.profiles.get(user_id, None)
+        if profile is None:
+            raise MatrixError(404, "M_NOT_FOUND", "Profile not found")
+        return 200, { field: profile.get(field, None) }
+
+    def set_profile(self, request, body, user_id, field):
+        if self._authenticate(request) != user_id:
+            raise MatrixError(403, "M_FORBIDDEN", "Cannot set another user's profile")
+        self.profiles[user_id][field] = body.get(field, None)
+        return 200, {}
+
+    def upload(self, request, body):
+        self._authenticate(request)
+        media_id = secrets.token_hex(12)
+        self.media[media_id] = (request["headers"].get("CONTENT_TYPE", "application/octet-stream"), request["raw"])
+        return 200, { "content_uri": f"mxc://{self.server_name}/{media_id}" }
+
+    def download(self, request, body, server_name, media_id):
+        media = self.media.get(media_id, None)
+        if media is None:
+            raise MatrixError(404, "M_NOT_FOUND", "Media not found")
+        return 200, media
+
+    # WSGI #####################################################################
+
+    def __call__(self, environ, start_response):
+        self.num_requests += 1
+        method = environ["REQUEST_METHOD"]
+        path = urllib.parse.unquote(environ.get("PATH_INFO", ""))
+        query = dict(urllib.parse.parse_qsl(environ.get("QUERY_STRING", "")))
+        length = int(environ.get("CONTENT_LENGTH", "0") or 0)
+        raw = environ["wsgi.input"].read(length) if length > 0 else b""
+        request = { "headers": environ, "query": query, "raw": raw }
+
+        delay = self.latency() / 1000.0
+        if delay > 0:
+            gevent.sleep(delay)
+
+        status, result = 404, { "errcode": "M_UNRECOGNIZED", "error": "Unrecognized request" }
+        for (route_method, pattern, handler) in self.routes:
+            match = pattern.match(path)
+            if match is None or route_method != method:
+                continue
+            try:
+                is_json = environ.get("CONTENT_TYPE", "application/json").startswith("application/json")
+                body = json.loads(raw) if raw and is_json else {}
+                status, result = handler(request, body, **match.groupdict())
+            except MatrixError as e:
+                status, result = e.status, e.body
+            except (ValueError, KeyError) as e:
+                status, result = 400, { "errcode": "M_BAD_JSON", "error": str(e) }
+            break
+
+        if isinstance(result, tuple):
+            content_type, data = result
+        else:
+            content_type, data = "application/json", json.dumps(result).encode("utf-8")
+        headers = [("Content-Type", content_type)]
+        encoding = self._content_encoding(environ, content_type, data)
+        if encoding == "gzip":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+        elif encoding == "br":
+            data = brotli.compress(data, quality=4)
+        if encoding is not None:
+            headers.append(("Content-Encoding", encoding))
+        start_response(f"{status} Mock", headers + [("Content-Length", str(len(data)))])
+        return [data]
+
+    def _content_encoding(self, environ, content_type, data):
+        """Returns our preferred encoding that the client accepts for a response, or None to send it as it is"""
+        if len(self.compression) == 0 or content_type != "application/json" or len(data) < COMPRESSION_MIN_BYTES:
+            return None
+        accepted = set(encoding.split(";")[0].strip().lower()
+                       for encoding in environ.get("HTTP_ACCEPT_ENCODING", "").split(","))
+        for encoding in self.compression:
+            if encoding in accepted:
+                return encoding
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs an in-memory mock Matrix homeserver")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8008,
+                        help="Port to listen on")
+    parser.add_argument("--server-name", type=str, default="mock.local",
+                        help="The server name in user ids and room ids")
+    parser.add_argument("--shared-secret", type=str, default="mock",
+                        help="Registration shared secret for /_synapse/admin/v1/register")
+    parser.add_argument("--latency", type=str, default="none",
+                        help="Latency model in ms: none, const:MS, exp:MEAN or lognorm:MU,SIGMA")
+    parser.add_argument("--event-padding", type=str, default="none",
+                        help="Extra bytes per event: none, const:BYTES, exp:MEAN or lognorm:MU,SIGMA")
+    parser.add_argument("--send-error-rate", type=float, default=0.0,
+                        help="Fraction of /send requests that store the event but fail with a 500")
+    parser.add_argument("--login-error-rate", type=float, default=0.0,
+                        help="Fraction of /login requests that are rate-limited with a 429")
+    parser.add_argument("--token-lifetime", type=float, default=None,
+                        help="Seconds until the access tokens of clients that asked for a refresh token expire")
+    parser.add_argument("--compression", type=str, default="",
+                        help="Comma-separated content encodings to compress the JSON responses with (gzip, br)")
+    parser.add_argument("--presence", action="store_true", default=False,
+                        help="Track the users' presence and send it to the users who share a room with them")
+    parser.add_argument("--admin-token", type=str, default=None,
+                        help="Create an admin user with this access token, for the admin user API")
+    args = parser.parse_args()
+
+    compression = [encoding.strip() for encoding in args.compression.split(",") if encoding.strip()]
+    if "br" in compression and brotli is None:
+        parser.error("--compression br needs the brotli package (pip install brotli)")
+    homeserver = MockHomeserver(args.server_name, args.shared_secret, args.latency, args.event_padding,
+                                args.send_error_rate, args.login_error_rate, args.token_lifetime,
+                                compression, args.presence, args.admin_token)
+    print(f"Mock homeserver listening on http://{args.host}:{args.port}", flush=True)
+    WSGIServer((args.host, args.port), homeserver, log=None).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/bin/env python3
+
+################################################################################
+#
+# prefork.py - Start Locust workers from a pre-loaded parent process
+#
+# Every Locust worker normally imports matrixuser.py (which parses tokens.csv),
+# matrixchatuser.py (which globs the images and avatars and builds the lorem
+# ipsum messages) and, for create_room.py, all of rooms.json, so a machine with
+# 64 workers holds 64 copies of the same read-only data.  This launcher loads
+# those modules and datasets once, freezes them out of the garbage collector,
+# and then forks the workers, which share the loaded pages copy-on-write.
+#
+# Any arguments that prefork.py doesn't know are passed on to the workers:
+#
+#   python3 prefork.py -f chat.py -n 64 --master-host 10.0.0.1
+#
+# It reports how long the workers took to start, and the unique (USS) and
+# proportional (PSS) memory of every worker from /proc/<pid>/smaps_rollup.
+# Run it with --no-preload to compare against workers that load everything
+# themselves.
+#
+# By default it preloads the repository modules that the locustfile imports
+# itself (and so everything that they import), so register.py workers don't
+# pay for matrixchatuser.py's images and messages, or get its event hooks.
+# Pick the modules with --preload instead.
+#
+################################################################################
+
+import argparse
+import ast
+import gc
+import importlib
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import time
+
+# Memory accounting ############################################################
+
+def read_memory(pid):
+    """Returns the Rss, Pss and Uss of a process in KiB, or None if it's gone"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as smaps:
+            for line in smaps:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return None
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def report_memory(workers):
+    rows = [(index, pid, read_memory(pid)) for (index, pid) in sorted(workers.items())]
+    rows = [(index, pid, memory) for (index, pid, memory) in rows if memory is not None]
+    if len(rows) == 0:
+        return
+    print(f"{'Worker':>6} {'PID':>8} {'RSS MiB':>9} {'PSS MiB':>9} {'USS MiB':>9}")
+    for (index, pid, memory) in rows:
+        print(f"{index:>6} {pid:>8} {memory['rss'] / 1024:>9.1f} {memory['pss'] / 1024:>9.1f} "
+              f"{memory['uss'] / 1024:>9.1f}")
+    mean_uss = sum(memory["uss"] for (_, _, memory) in rows) / len(rows)
+    total_pss = sum(memory["pss"] for (_, _, memory) in rows)
+    print(f"Mean unique memory per worker: {mean_uss / 1024:.1f} MiB, "
+          f"total proportional memory: {total_pss / 1024:.1f} MiB", flush=True)
+
+
+# Preloading ###################################################################
+
+def locustfile_imports(locustfile, search_dirs):
+    """Returns the modules that the locustfile imports at its top level and that are in search_dirs"""
+    with open(locustfile, "r", encoding="utf-8") as source:
+        tree = ast.parse(source.read(), filename=locustfile)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            local = any(os.path.isfile(os.path.join(directory, name.split(".")[0] + ".py"))
+                        for directory in search_dirs)
+            if local and name not in modules:
+                modules.append(name)
+    return modules
+
+
+def preload(modules):
+    """Imports the shared modules and loads the read-only datasets into this process"""
+    for module in modules:
+        importlib.import_module(module)
+
+    # rooms.json is only needed by create_room.py, but it's cheap to share
+    matrixuser = sys.modules.get("matrixuser", None)
+    if matrixuser is not None:
+        matrixuser.load_rooms()
+
+    # Keep the garbage collector from touching (and so un-sharing) the preloaded objects
+    gc.collect()
+    gc.freeze()
+
+
+# Workers ######################################################################
+
+def run_worker(locustfile, locust_args, ready_fd, fork_time):
+    """Runs one Locust worker in a forked child.  Never returns."""
+    exit_code = 1
+    try:
+        from locust import events
+
+        @events.init.add_listener
+        def on_locust_init(environment, **_kwargs):
+            os.write(ready_fd, f"{os.getpid()} {time.perf_counter() - fork_time:.3f}\n".encode("utf-8"))
+            os.close(ready_fd)
+
+        sys.argv = ["locust", "-f", locustfile, "--worker"] + locust_args
+
+        from locust.main import main
+        main()
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def wait_until_ready(ready_fd, num_workers, timeout):
+    """Collects the startup time of each worker from the ready pipe"""
+    startup_times = {}
+    buffer = b""
+    deadline = time.perf_counter() + timeout
+    while len(startup_times) < num_workers:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        readable, _, _ = select.select([ready_fd], [], [], remaining)
+        if not readable:
+            break
+        data = os.read(ready_fd, 4096)
+        if not data:
+            break
+        buffer += data
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            pid, seconds = line.decode("utf-8").split()
+            startup_times[int(pid)] = float(seconds)
+    return startup_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forks Locust workers from a parent with the shared data pre-loaded")
+    parser.add_argument("-f", "--locustfile", type=str, required=True,
+                        help="The Locust script for the workers")
+    parser.add_argument("-n", "--num_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of workers to fork. Defaults to the number of CPU threads.")
+    parser.add_argument("--preload", type=lambda s: [m for m in s.split(",") if m], default=None,
+                        help="Comma-separated modules to import before forking. Defaults to the repository "
+                             "modules that the locustfile imports.")
+    parser.add_argument("--no-preload", action="store_true", default=False,
+                        help="Don't preload anything, to measure the saving")
+    parser.add_argument("--report-interval", type=float, default=60,
+                        help="Seconds between worker memory reports (0 to only report at startup)")
+    parser.add_argument("--ready-timeout", type=float, default=120,
+                        help="Seconds to wait for the workers to start")
+    args, locust_args = parser.parse_known_args()
+
+    # Make the repository's modules and the locustfile's directory importable, like Locust does
+    search_dirs = [os.path.dirname(os.path.abspath(args.locustfile)), os.getcwd()]
+    sys.path.insert(0, search_dirs[1])
+    sys.path.insert(0, search_dirs[0])
+    if args.preload is None:
+        args.preload = locustfile_imports(args.locustfile, search_dirs)
+
+    start_time = time.perf_counter()
+    if not args.no_preload:
+        preload(args.preload)
+    preload_time = time.perf_counter() - start_time
+    print(f"Preloaded {', '.join(args.preload) if not args.no_preload else 'nothing'} in {preload_time:.2f}s",
+          flush=True)
+
+    ready_read, ready_write = os.pipe()
+    workers = {}
+    for index in range(args.num_workers):
+        fork_time = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            run_worker(args.locustfile, locust_args, ready_write, fork_time)
+        workers[index] = pid
+    os.close(ready_write)
+
+    # Pass Ctrl-C and friends on to the workers
+    def forward_signal(signum, _frame):
+        for pid in workers.values():
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+
+    startup_times = wait_until_ready(ready_read, args.num_workers, args.ready_timeout)
+    os.close(ready_read)
+    if len(startup_times) > 0:
+        print(f"{len(startup_times)}/{args.num_workers} workers started in "
+              f"{time.perf_counter() - start_time:.2f}s (preload {preload_time:.2f}s, "
+              f"slowest worker {max(startup_times.values()):.2f}s after fork)", flush=True)
+    else:
+        print(f"No workers reported ready within {args.ready_timeout:.0f}s", flush=True)
+    report_memory(workers)
+
+    # Wait for the workers to finish, reporting their memory every so often
+    last_report = time.perf_counter()
+    exit_code = 0
+    while len(workers) > 0:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(1)
+            if args.report_interval > 0 and time.perf_counter() - last_report >= args.report_interval:
+                report_memory(workers)
+                last_report = time.perf_counter()
+            continue
+        for (index, worker_pid) in list(workers.items()):
+            if worker_pid == pid:
+                del workers[index]
+        if os.waitstatus_to_exitcode(status) != 0:
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+################################################################################
+#
+# profiles.py - Declarative behaviour profiles for the simulated users
+#
+# By default every MatrixChatUser behaves the same way, with the task weights
+# and wait times in matrixchatuser.py.  A profiles file describes a population
+# of different kinds of users instead, without touching the code:
+#
+#   {
+#     "profiles": {
+#       "lurker":  { "tasks": { "do_nothing": 40, "look_at_room": 8, "go_afk": 2 },
+#                    "wait_time": "exp:20" },
+#       "chatter": { "tasks": { "do_nothing": 10, "send_text": 3, "look_at_room": 4, "ChatInARoom": 6 },
+#                    "wait_time": "exp:8", "room_selection": "weighted",
+#                    "chat": { "wait_time": "exp:15", "messages": "gauss:20,5" } }
+#     },
+#     "assignment": [
+#       { "max_rooms": 3, "profiles": { "lurker": 0.8, "chatter": 0.2 } },
+#       { "profiles": { "lurker": 0.4, "chatter": 0.6 } }
+#     ]
+#   }
+#
+# A profile has:
+#
+#   * tasks           The weights of the user's top-level tasks, by name.  Tasks
+#                     that are left out are never picked.
+#   * wait_time       The time between tasks (see parse_distribution())
+#   * room_selection  "uniform", or "weighted" by the rooms' message activity
+#   * chat            The wait time between the messages of a ChatInARoom
+#                     session, and the number of messages in one
+#
+# The assignment rules are tried in order, and the first one whose max_rooms
+# is at least the number of rooms that the user is in (from rooms.json) picks
+# the user's profile, at random with the given weights.  With --seed, every
+# user gets the same profile in every run.
+#
+# Pick a profiles file with --profiles, or with a "profiles" field in a test
+# suite (see run.py).
+#
+################################################################################
+
+import json
+import logging
+import random
+from bisect import bisect
+from collections import Counter
+from itertools import accumulate
+
+from locust import events
+from locust.runners import WorkerRunner
+
+ROOM_SELECTIONS = ["uniform", "weighted"]
+
+
+def parse_distribution(spec):
+    """Parses a distribution like "const:5", "exp:20", "uniform:1,10", "gauss:15,4" or "lognorm:1,1"
+
+        Returns a function that draws a value with the given random number generator.
+    """
+    kind, _, params = str(spec).partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    samplers = {
+        "const": (1, lambda rng: values[0]),
+        "exp": (1, lambda rng: rng.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0),
+        "uniform": (2, lambda rng: rng.uniform(values[0], values[1])),
+        "gauss": (2, lambda rng: rng.gauss(values[0], values[1])),
+        "lognorm": (2, lambda rng: rng.lognormvariate(values[0], values[1])),
+    }
+    if kind not in samplers or len(values) != samplers[kind][0]:
+        raise ValueError(f"Invalid distribution '{spec}': expected one of const:X, exp:MEAN, uniform:A,B, "
+                         "gauss:MEAN,STDDEV or lognorm:MU,SIGMA")
+    return samplers[kind][1]
+
+
+class Profile:
+    """The behaviour of one kind of user"""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.task_weights = dict(spec.get("tasks", {}))
+        self.wait_time = parse_distribution(spec["wait_time"]) if "wait_time" in spec else None
+        self.room_selection = spec.get("room_selection", None)
+        if self.room_selection is not None and self.room_selection not in ROOM_SELECTIONS:
+            raise ValueError(f"Profile {name}: unknown room selection '{self.room_selection}'")
+        chat = spec.get("chat", {})
+        self.chat_wait_time = parse_distribution(chat["wait_time"]) if "wait_time" in chat else None
+        self.chat_messages = parse_distribution(chat["messages"]) if "messages" in chat else None
+        # User class -> (tasks, cumulative weights)
+        self._task_tables = {}
+
+    def task_table(self, user_class):
+        """Returns the tasks of the user class that this profile picks from, with their cumulative weights"""
+        table = self._task_tables.get(user_class, None)
+        if table is None:
+            tasks_by_name = { task.__name__: task for task in user_class.tasks }
+            unknown = set(self.task_weights) - set(tasks_by_name)
+            if len(unknown) > 0:
+                raise ValueError(f"Profile {self.name}: {user_class.__name__} has no tasks {', '.join(sorted(unknown))}")
+            tasks = [tasks_by_name[name] for (name, weight) in self.task_weights.items() if weight > 0]
+            if len(tasks) == 0:
+                raise ValueError(f"Profile {self.name}: no task has a positive weight")
+            table = (tasks, list(accumulate(weight for weight in self.task_weights.values() if weight > 0)))
+            self._task_tables[user_class] = table
+        return table
+
+    def pick_task(self, user):
+        tasks, cum_weights = self.task_table(type(user))
+        return tasks[bisect(cum_weights, user.rng.random() * cum_weights[-1])]
+
+
+class Population:
+    """The profiles of a test, and the rules that assign them to users"""
+
+    def __init__(self, spec):
+        self.profiles = { name: Profile(name, profile_spec) for (name, profile_spec) in spec["profiles"].items() }
+        self.rules = []
+        for rule in spec.get("assignment", [{ "profiles": { name: 1 for name in self.profiles } }]):
+            unknown = set(rule["profiles"]) - set(self.profiles)
+            if len(unknown) > 0:
+                raise ValueError(f"Assignment to unknown profiles {', '.join(sorted(unknown))}")
+            names = list(rule["profiles"].keys())
+            self.rules.append((rule.get("max_rooms", None), names, list(accumulate(rule["profiles"].values()))))
+        self.assigned = Counter()
+
+    @staticmethod
+    def load(path):
+        with open(path, "r", encoding="utf-8") as json_file:
+            return Population(json.load(json_file))
+
+    def assign(self, username, num_rooms, seed=None):
+        """Returns the profile of a user, or None if no rule covers the user's number of rooms"""
+        rng = random.Random("%s:%s:profile" % (seed, username)) if seed is not None else random
+        for (max_rooms, names, cum_weights) in self.rules:
+            if max_rooms is None or num_rooms <= max_rooms:
+                profile = self.profiles[names[bisect(cum_weights, rng.random() * cum_weights[-1])]]
+                self.assigned[profile.name] += 1
+                return profile
+        return None
+
+
+# The profiles of this test, or None for the default behaviour
+population = None
+
+
+# Locust event hooks ###########################################################
+
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+    parser.add_argument("--profiles", type=str, default=None,
+                        help="JSON file of behaviour profiles, and how to assign them to the users (see profiles.py)")
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global population
+    path = getattr(environment.parsed_options, "profiles", None)
+    population = None if path is None else Population.load(path)
+    if population is not None and not isinstance(environment.runner, WorkerRunner):
+        print(f"Behaviour profiles from {path}: {', '.join(population.profiles)}")
+
+
+@events.test_stopping.add_listener
+def on_test_stopping(environment, **_kwargs):
+    if population is not None and len(population.assigned) > 0:
+        logging.info("Users per profile: %s", ", ".join("%s %d" % (name, count)
+                                                       for (name, count) in sorted(population.assigned.items())))
@@ -0,0 +1,25 @@
+################################################################################
+#
+# registration.py - Shared helpers for the admin registration APIs
+#
+# The shared-secret registration API (/_synapse/admin/v1/register) is used by
+# bulk_register.py and MatrixUser to create accounts, and implemented by the
+# mock homeserver, so they all compute its HMAC here.
+#
+################################################################################
+
+import hashlib
+import hmac
+
+
+def registration_mac(shared_secret, nonce, username, password, admin=False):
+    """Computes the HMAC for the shared-secret registration API"""
+    mac = hmac.new(key=shared_secret.encode("utf-8"), digestmod=hashlib.sha1)
+    mac.update(nonce.encode("utf-8"))
+    mac.update(b"\x00")
+    mac.update(username.encode("utf-8"))
+    mac.update(b"\x00")
+    mac.update(password.encode("utf-8"))
+    mac.update(b"\x00")
+    mac.update(b"admin" if admin else b"notadmin")
+    return mac.hexdigest()
@@ -0,0 +1,209 @@
+#!/bin/env python3
+
+################################################################################
+#
+# replay.py - Replays a recorded Matrix workload trace
+#
+# Record a trace by passing --trace-record to any of our locustfiles, e.g.
+#
+#   locust -f chat.py --trace-record traces/chat.trace ...
+#
+# which writes one file per worker (traces/chat.trace.0, traces/chat.trace.1, ...).
+# Then replay it against another server build with
+#
+#   locust -f replay.py --trace-replay "traces/chat.trace.*" --replay-speed 1 ...
+#
+# Each worker receives its share of users.csv as usual and replays the recorded
+# operations of those users, so the trace can be replayed with any number of
+# workers.  Use at least as many Locust users as there are users in the trace.
+#
+################################################################################
+
+import csv
+import json
+import logging
+import resource
+
+import gevent
+from locust import task, events
+from locust.exception import StopUser
+from locust.runners import MasterRunner, WorkerRunner
+
+from matrixuser import PRESENCE_BODIES, TYPING_BODIES, MatrixUser, master_time, stamp_message_content
+from workload_trace import load_trace_by_user
+
+# Seconds between the start of the test and the start of the replay, to give
+# the workers time to receive the replay epoch and the users time to log in
+REPLAY_LEAD_TIME = 10.0
+
+# Preflight ####################################################################
+
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+    parser.add_argument("--trace-replay", type=str, default=None,
+                        help="Path or glob pattern of the trace file(s) to replay")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Replay speed multiplier (e.g. 2 for 2x).  Use 0 to replay as fast as possible")
+
+@events.init.add_listener
+def on_locust_init(environment, **_kwargs):
+    # Increase resource limits to prevent OS running out of descriptors
+    resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
+
+    # Multi-worker
+    if isinstance(environment.runner, WorkerRunner):
+        print(f"Registered 'load_users' handler on {environment.runner.client_id}")
+        environment.runner.register_message("load_users", MatrixReplayUser.load_users)
+        environment.runner.register_message("replay_epoch", MatrixReplayUser.set_replay_epoch)
+    # Single-worker
+    elif not isinstance(environment.runner, MasterRunner):
+        MatrixReplayUser.worker_users = csv.DictReader(open("users.csv", encoding="utf-8"))
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    # All workers start replaying at the same moment on the master's clock
+    replay_epoch = master_time() + REPLAY_LEAD_TIME
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.send_message("replay_epoch", replay_epoch)
+    elif not isinstance(environment.runner, WorkerRunner):
+        MatrixReplayUser.replay_epoch = replay_epoch
+
+################################################################################
+
+
+class MatrixReplayUser(MatrixUser):
+    worker_id = None
+    worker_users = []
+    worker_usernames = None
+    worker_trace = None
+    replay_epoch = None
+
+    @staticmethod
+    def load_users(environment, msg, **_kwargs):
+        MatrixReplayUser.worker_users = iter(msg.data)
+        MatrixReplayUser.worker_usernames = set(user["username"] for user in msg.data)
+        MatrixReplayUser.worker_id = environment.runner.client_id
+        logging.info("Worker [%s] Received %s users", environment.runner.client_id, len(msg.data))
+
+    @staticmethod
+    def set_replay_epoch(_environment, msg, **_kwargs):
+        MatrixReplayUser.replay_epoch = msg.data
+
+    def wait_time(self):
+        return 0
+
+    def on_start(self):
+        if MatrixReplayUser.worker_trace is None:
+            pattern = self.environment.parsed_options.trace_replay
+            if pattern is None:
+                logging.error("No trace to replay, use --trace-replay")
+                self.environment.runner.quit()
+                return
+            MatrixReplayUser.worker_trace = load_trace_by_user(pattern, MatrixReplayUser.worker_usernames)
+            logging.info("Loaded trace for %d users", len(MatrixReplayUser.worker_trace))
+
+        # Load the next user, exactly like MatrixChatUser does
+        try:
+            user_dict = next(MatrixReplayUser.worker_users)
+        except StopIteration:
+            gevent.sleep(999999)
+            return
+
+        self.login_from_csv(user_dict)
+        if self.user_id is not None and self.access_token is not None:
+            self.start_syncing()
+        if self.user_id is None or self.access_token is None:
+            if not self.login(start_syncing=True, log_request=True):
+                raise StopUser()
+
+        self.trace_ops = MatrixReplayUser.worker_trace.get(self.username, [])
+
+    @task
+    def replay_trace(self):
+        # Wait until we know our rooms and their names before replaying anything
+        while self.initial_sync_token is None or MatrixReplayUser.replay_epoch is None:
+            gevent.sleep(1)
+
+        speed = self.environment.parsed_options.replay_speed
+        for (t, op, room, payload_size) in self.trace_ops:
+            if speed > 0:
+                delay = MatrixReplayUser.replay_epoch + t / speed - master_time()
+                if delay > 0:
+                    gevent.sleep(delay)
+            self.replay_op(op, room, payload_size)
+
+        # Our part of the trace is done, but keep syncing like the recorded user did
+        gevent.sleep(999999)
+
+    def resolve_room(self, room):
+        """Maps a room from the trace (its name, or its room id if it had no name) to one of our room ids"""
+        if room is None:
+            return None
+        for room_id, room_name in self.room_display_names.items():
+            if room_name == room:
+                return room_id
+        if room in self.joined_room_ids or room in self.invited_room_ids:
+            return room
+        # The room is unknown on this server, so fall back to one of our rooms
+        return self.get_random_roomid()
+
+    def replay_op(self, op, room, payload_size):
+        method, label = op.split(" ", 1)
+        room_id = self.resolve_room(room)
+        messages = self.recent_messages.get(room_id, [])
+
+        if "/send/" in label and room_id is not None:
+            event_type = label.rsplit("/", 1)[-1]
+            if event_type == "m.reaction":
+                if len(messages) < 1:
+                    return
+                content = { "m.relates_to": { "rel_type": "m.annotation",
+                                              "event_id": messages[-1].event_id, "key": "👍" } }
+            else:
+                content = stamp_message_content({ "msgtype": "m.text", "body": "" })
+                # Pad the body so that the request has the recorded size
+                content["body"] = "x" * max(1, payload_size - len(json.dumps(content)))
+            with self.send_matrix_event(room_id, { "type": event_type, "content": content }) as _response:
+                pass
+
+        elif "/typing/" in label and room_id is not None:
+            # The recorded body size tells whether the user started or stopped typing
+            self.set_typing(room_id, payload_size != len(TYPING_BODIES[False]))
+
+        elif "/presence/" in label:
+            presences = { len(body): presence for (presence, body) in PRESENCE_BODIES.items() }
+            self.set_presence(presences.get(payload_size, "online"))
+
+        elif "/receipt/" in label and room_id is not None:
+            if len(messages) > 0:
+                self.send_read_receipt(room_id, messages[-1].event_id)
+
+        elif label.endswith("/messages") and room_id is not None:
+            token = self.earliest_sync_tokens.get(room_id, self.initial_sync_token)
+            url = "/_matrix/client/%s/rooms/%s/messages?dir=b&from=%s" % (self.matrix_version, room_id, token)
+            with self._matrix_api_call("GET", url, name=label) as response:
+                if "end" in response.js:
+                    self.earliest_sync_tokens[room_id] = response.js["end"]
+
+        elif label.endswith("/join") and room_id is not None:
+            self.join_room(room_id)
+
+        elif label.endswith("/createRoom"):
+            self.create_room(alias=None, room_name=room)
+
+        elif "/profile/" in label:
+            senders = [message.sender for message in messages] or [self.user_id]
+            if method == "PUT" and label.endswith("/displayname"):
+                self.set_displayname()
+            elif label.endswith("/displayname"):
+                self.get_user_displayname(senders[-1])
+            elif label.endswith("/avatar_url"):
+                self.get_user_avatar_url(senders[-1])
+
+        elif "/download" in label:
+            avatar_urls = [mxc for mxc in self.user_avatar_urls.values() if mxc]
+            if len(avatar_urls) > 0:
+                self.download_matrix_media(avatar_urls[0])
+
+        else:
+            logging.debug("User [%s] Not replaying unsupported operation %s", self.username, op)
@@ -0,0 +1,442 @@
+#!/bin/env python3
+
+################################################################################
+#
+# results.py - Stores test runs in a results database, and compares them
+#
+# Every run of run.py leaves a handful of CSV files in its output directory.
+# This tool ingests them into an SQLite database, along with the parameters
+# of the run, the git commit of the load generator and the version of the
+# server, so that runs can be compared without any spreadsheet work:
+#
+#   python3 results.py --db results.db ingest --dir data/conduit/t1 --name chat --label conduit-0.6
+#   python3 results.py --db results.db list
+#   python3 results.py --db results.db compare --baseline conduit-0.6 --candidate conduit-0.7
+#
+# run.py ingests every run by itself when it's given --results-db.
+#
+# A comparison takes every run with the baseline label and every run with the
+# candidate label as repeated trials.  It reports the change in throughput,
+# latency and failures of every endpoint (and the mean resource usage), with
+# the p-value of Welch's t-test across the trials, and flags the significant
+# regressions.  Failure ratios are also compared in absolute terms, so that a
+# build that starts failing requests is flagged even though its baseline had
+# no failures at all.
+#
+################################################################################
+
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.request
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    label TEXT,
+    name TEXT,
+    output_dir TEXT,
+    started REAL,
+    finished REAL,
+    git_commit TEXT,
+    server_version TEXT,
+    host TEXT,
+    params TEXT,
+    ingested REAL,
+    UNIQUE (output_dir, name, started)
+);
+CREATE TABLE IF NOT EXISTS endpoint_stats (
+    run_id INTEGER REFERENCES runs(id),
+    room_size TEXT,     -- '' for the overall statistics
+    type TEXT,
+    name TEXT,
+    request_count INTEGER,
+    failure_count INTEGER,
+    median REAL, average REAL, min REAL, max REAL,
+    rps REAL,
+    failures_per_s REAL,
+    p50 REAL, p90 REAL, p95 REAL, p99 REAL, p999 REAL
+);
+CREATE TABLE IF NOT EXISTS history (
+    run_id INTEGER REFERENCES runs(id),
+    timestamp REAL,
+    user_count INTEGER,
+    type TEXT,
+    name TEXT,
+    rps REAL,
+    failures_per_s REAL,
+    p50 REAL, p95 REAL, p99 REAL
+);
+CREATE TABLE IF NOT EXISTS resources (
+    run_id INTEGER REFERENCES runs(id),
+    timestamp REAL,
+    metric TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS endpoint_stats_run ON endpoint_stats (run_id);
+CREATE INDEX IF NOT EXISTS history_run ON history (run_id);
+CREATE INDEX IF NOT EXISTS resources_run ON resources (run_id, metric);
+"""
+
+# Locust CSV column -> endpoint_stats column
+STATS_COLUMNS = {
+    "Type": "type", "Name": "name", "Request Count": "request_count", "Failure Count": "failure_count",
+    "Median Response Time": "median", "Average Response Time": "average", "Min Response Time": "min",
+    "Max Response Time": "max", "Requests/s": "rps", "Failures/s": "failures_per_s",
+    "50%": "p50", "90%": "p90", "95%": "p95", "99%": "p99", "99.9%": "p999",
+}
+HISTORY_COLUMNS = {
+    "Timestamp": "timestamp", "User Count": "user_count", "Type": "type", "Name": "name",
+    "Requests/s": "rps", "Failures/s": "failures_per_s", "50%": "p50", "95%": "p95", "99%": "p99",
+}
+
+# Metrics that compare() reports for every endpoint, and whether higher is better
+ENDPOINT_METRICS = [("rps", True), ("median", False), ("p95", False), ("p99", False), ("failure_ratio", False)]
+
+# Seconds around the Locust statistics history that the resource samples of a run may extend
+RESOURCE_MARGIN = 10
+
+RESOURCE_METRICS = ["host_cpu_percent", "generator_cpu_percent", "generator_rss_bytes",
+                    "target_cpu_percent", "target_mem_bytes", "host_net_rx_bytes_per_s", "target_net_tx_bytes_per_s",
+                    "generator_loop_lag_ms", "generator_saturated"]
+
+# Columns of the saturation monitor's worker reports (see saturation.py), as resource metrics
+SATURATION_COLUMNS = {
+    "Loop Lag Mean (ms)": "generator_loop_lag_ms",
+    "Loop Lag Max (ms)": "generator_loop_lag_max_ms",
+    "CPU %": "generator_worker_cpu_percent",
+    "Saturated": "generator_saturated",
+}
+
+
+# Ingestion ###################################################################
+
+def open_db(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def parse_number(value):
+    """Parses a number from a Locust CSV, where missing values are empty or N/A"""
+    if value is None or value in ("", "N/A"):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def read_csv(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8", newline="") as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def map_row(row, columns):
+    return { column: (row.get(csv_column) if column in ("type", "name") else parse_number(row.get(csv_column)))
+             for (csv_column, column) in columns.items() }
+
+
+def git_commit():
+    """Returns the commit of the load generator, with -dirty if it has local changes"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def server_version(host):
+    """Asks the homeserver for its name and version, or returns None"""
+    if host is None:
+        return None
+    try:
+        with urllib.request.urlopen(host.rstrip("/") + "/_matrix/federation/v1/version", timeout=5) as response:
+            server = json.load(response).get("server", {})
+        return " ".join(part for part in [server.get("name"), server.get("version")] if part) or None
+    except (OSError, ValueError):
+        return None
+
+
+def ingest_run(db, output_dir, name, label=None, params=None, host=None, version=None):
+    """Stores the results of the run with the given name from its output directory
+
+    Returns the id of the run, or None if there were no results, or if the run was already stored.
+    """
+    prefix = os.path.join(output_dir, name)
+    stats = read_csv(prefix + ".csv_stats.csv")
+    if len(stats) == 0:
+        print(f"No Locust statistics in {prefix}.csv_stats.csv", file=sys.stderr)
+        return None
+    history = read_csv(prefix + ".csv_stats_history.csv")
+    room_sizes = read_csv(prefix + ".csv_room_sizes.csv")
+    resources = read_csv(prefix + "_resources.csv")
+    saturation = read_csv(prefix + ".csv_saturation.csv")
+    params = dict(params or {})
+    if os.path.exists(prefix + ".csv_saturation.json"):
+        with open(prefix + ".csv_saturation.json", "r", encoding="utf-8") as json_file:
+            params["saturation"] = json.load(json_file)
+
+    timestamps = [float(row["Timestamp"]) for row in history if row.get("Timestamp")]
+    started = min(timestamps) if timestamps else os.path.getmtime(prefix + ".csv_stats.csv")
+    finished = max(timestamps) if timestamps else started
+    if version is None:
+        version = server_version(host)
+
+    try:
+        cursor = db.execute("INSERT INTO runs (label, name, output_dir, started, finished, git_commit, server_version,"
+                            " host, params, ingested) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (label or version or "default", name, os.path.abspath(output_dir), started, finished,
+                             git_commit(), version, host, json.dumps(params, sort_keys=True), time.time()))
+    except sqlite3.IntegrityError:
+        print(f"Run {name} in {output_dir} was already ingested", file=sys.stderr)
+        return None
+    run_id = cursor.lastrowid
+
+    def insert(table, rows):
+        if len(rows) == 0:
+            return
+        columns = list(rows[0].keys())
+        db.executemany(f"INSERT INTO {table} (run_id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})",
+                       [(run_id, *(row[column] for column in columns)) for row in rows])
+
+    insert("endpoint_stats", [{ "room_size": "", **map_row(row, STATS_COLUMNS) } for row in stats])
+    insert("endpoint_stats", [{ "room_size": row["Room Size"], **map_row(row, STATS_COLUMNS) } for row in room_sizes])
+    insert("history", [map_row(row, HISTORY_COLUMNS) for row in history])
+    # Skip the samples from any earlier run in the same directory
+    resources = [row for row in resources if started - RESOURCE_MARGIN <= float(row["Timestamp"]) <= finished + RESOURCE_MARGIN]
+    insert("resources", [{ "timestamp": float(row["Timestamp"]), "metric": metric, "value": float(value) }
+                         for row in resources for (metric, value) in row.items()
+                         if metric != "Timestamp" and value not in ("", None)])
+    # Every worker report flags whether that worker was saturated
+    insert("resources", [{ "timestamp": float(row["Timestamp"]), "metric": metric, "value": float(row[column]) }
+                         for row in saturation for (column, metric) in SATURATION_COLUMNS.items()
+                         if row.get(column) not in ("", None)])
+    db.commit()
+    return run_id
+
+
+# Statistics ##################################################################
+
+def incomplete_beta(x, a, b):
+    """The regularized incomplete beta function I_x(a, b), by Lentz's continued fraction"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1.0 - incomplete_beta(1 - x, b, a)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x)) / a
+    tiny = 1e-300
+    f = c = 1.0
+    d = 0.0
+    for i in range(400):
+        m = i // 2
+        if i == 0:
+            numerator = 1.0
+        elif i % 2 == 0:
+            numerator = m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m))
+        else:
+            numerator = -((a + m) * (a + b + m) * x) / ((a + 2 * m) * (a + 2 * m + 1))
+        d = 1.0 + numerator * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + numerator / (c if abs(c) > tiny else tiny)
+        f *= c * d
+        if abs(1.0 - c * d) < 1e-12:
+            break
+    return front * (f - 1.0)
+
+
+def welch_t_test(baseline, candidate):
+    """Returns the two-sided p-value of Welch's t-test, or None with fewer than two trials on either side"""
+    n1, n2 = len(baseline), len(candidate)
+    if n1 < 2 or n2 < 2:
+        return None
+    mean1, mean2 = sum(baseline) / n1, sum(candidate) / n2
+    var1 = sum((x - mean1) ** 2 for x in baseline) / (n1 - 1)
+    var2 = sum((x - mean2) ** 2 for x in candidate) / (n2 - 1)
+    se2 = var1 / n1 + var2 / n2
+    if se2 == 0:
+        return 1.0 if mean1 == mean2 else 0.0
+    t = (mean2 - mean1) / math.sqrt(se2)
+    df = se2 ** 2 / ((var1 / n1) ** 2 / (n1 - 1) + (var2 / n2) ** 2 / (n2 - 1))
+    return incomplete_beta(df / (df + t * t), df / 2, 0.5)
+
+
+# Comparison ##################################################################
+
+def select_runs(db, selector, name=None):
+    """Returns the ids of the runs with the given label, or in a comma-separated list of run ids"""
+    if all(part.strip().isdigit() for part in selector.split(",")):
+        return [int(part) for part in selector.split(",")]
+    query = "SELECT id FROM runs WHERE label = ?" + ("" if name is None else " AND name = ?")
+    return [run_id for (run_id,) in db.execute(query, (selector,) if name is None else (selector, name))]
+
+
+def run_metrics(db, run_ids):
+    """Returns { (type, name, metric): [value per run] } for the given runs"""
+    values = {}
+    for run_id in run_ids:
+        rows = db.execute("SELECT type, name, rps, median, p95, p99, request_count, failure_count FROM endpoint_stats"
+                          " WHERE run_id = ? AND room_size = ''", (run_id,))
+        for (request_type, name, rps, median, p95, p99, requests, failures) in rows:
+            metrics = { "rps": rps, "median": median, "p95": p95, "p99": p99,
+                        "failure_ratio": (failures or 0) / requests if requests else None }
+            for (metric, value) in metrics.items():
+                if value is not None:
+                    values.setdefault((request_type or "", name, metric), []).append(value)
+        for (metric, mean) in db.execute("SELECT metric, AVG(value) FROM resources WHERE run_id = ? GROUP BY metric",
+                                         (run_id,)):
+            if metric in RESOURCE_METRICS:
+                values.setdefault(("RESOURCE", metric, "mean"), []).append(mean)
+    return values
+
+
+def compare(db, baseline_ids, candidate_ids, alpha, max_regression, max_failure_increase=0.01):
+    """Returns the report rows, and the significant regressions"""
+    baseline = run_metrics(db, baseline_ids)
+    candidate = run_metrics(db, candidate_ids)
+    higher_is_better = dict(ENDPOINT_METRICS)
+    rows = []
+    regressions = []
+    for key in sorted(set(baseline) & set(candidate)):
+        request_type, name, metric = key
+        before, after = baseline[key], candidate[key]
+        mean_before, mean_after = sum(before) / len(before), sum(after) / len(after)
+        change = None if mean_before == 0 else mean_after / mean_before - 1
+        p_value = welch_t_test(before, after)
+        significant = p_value is not None and p_value < alpha
+        flag = ""
+        # A relative change means nothing from a zero baseline, so failures are also judged by their absolute increase
+        if metric == "failure_ratio" and mean_after - mean_before > max_failure_increase \
+                and (significant or mean_before == 0):
+            flag = "regression"
+            p_text = "" if p_value is None else f", p={p_value:.3g}"
+            regressions.append(f"{request_type} {name} {metric}: {mean_before:.4g} -> {mean_after:.4g} "
+                               f"(+{(mean_after - mean_before) * 100:.2f} points{p_text})")
+        elif significant and change is not None and metric in higher_is_better:
+            worse = change < 0 if higher_is_better[metric] else change > 0
+            flag = "regression" if worse else "improvement"
+            if worse and abs(change) > max_regression:
+                regressions.append(f"{request_type} {name} {metric}: {mean_before:.4g} -> {mean_after:.4g} "
+                                   f"({change * 100:+.1f}%, p={p_value:.3g})")
+        elif significant:
+            flag = "changed"
+        rows.append((request_type, name, metric, mean_before, mean_after, change, p_value, flag))
+    return rows, regressions
+
+
+def run_bottlenecks(db, run_ids):
+    """Returns [(run id, bottleneck, reason)] for the runs with a saturation verdict"""
+    bottlenecks = []
+    for run_id in run_ids:
+        (params,) = db.execute("SELECT params FROM runs WHERE id = ?", (run_id,)).fetchone() or ("{}",)
+        verdict = json.loads(params or "{}").get("saturation", None)
+        if verdict is not None:
+            bottlenecks.append((run_id, verdict["bottleneck"], verdict["reason"]))
+    return bottlenecks
+
+
+def format_report(rows, baseline, candidate, baseline_ids, candidate_ids):
+    lines = [f"# {candidate} vs {baseline}", "",
+             f"Baseline runs: {', '.join(map(str, baseline_ids))}; candidate runs: {', '.join(map(str, candidate_ids))}",
+             "",
+             "| Type | Name | Metric | Baseline | Candidate | Change | p-value | |",
+             "|------|------|--------|---------:|----------:|-------:|--------:|-|"]
+    for (request_type, name, metric, before, after, change, p_value, flag) in rows:
+        change_text = "" if change is None else f"{change * 100:+.1f}%"
+        p_text = "n/a" if p_value is None else f"{p_value:.3g}"
+        lines.append(f"| {request_type} | {name} | {metric} | {before:.4g} | {after:.4g} | {change_text} | {p_text} | {flag} |")
+    return "\n".join(lines) + "\n"
+
+
+# Command line ################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Stores test runs in a results database, and compares them")
+    parser.add_argument("--db", type=str, default="results.db",
+                        help="SQLite results database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="Store the results of a run")
+    ingest_parser.add_argument("--dir", type=str, required=True,
+                               help="Output directory of the run")
+    ingest_parser.add_argument("--name", type=str, required=True,
+                               help="Name of the run (the prefix of its CSV files)")
+    ingest_parser.add_argument("--label", type=str, default=None,
+                               help="Label to compare runs by, e.g. the server build (defaults to the server version)")
+    ingest_parser.add_argument("--host", type=str, default=None,
+                               help="Homeserver URL, to ask it for its version")
+    ingest_parser.add_argument("--server-version", type=str, default=None,
+                               help="Server version, if the server can't be asked")
+
+    commands.add_parser("list", help="List the stored runs")
+
+    compare_parser = commands.add_parser("compare", help="Compare two sets of runs")
+    compare_parser.add_argument("--baseline", type=str, required=True,
+                                help="Label, or comma-separated run ids, of the baseline runs")
+    compare_parser.add_argument("--candidate", type=str, required=True,
+                                help="Label, or comma-separated run ids, of the candidate runs")
+    compare_parser.add_argument("--name", type=str, default=None,
+                                help="Only compare the runs with this name")
+    compare_parser.add_argument("--alpha", type=float, default=0.05,
+                                help="Significance level of the t-tests")
+    compare_parser.add_argument("--max-regression", type=float, default=0.1,
+                                help="Fail if a metric significantly regresses by more than this fraction")
+    compare_parser.add_argument("--max-failure-increase", type=float, default=0.01,
+                                help="Fail if the failure ratio of an endpoint grows by more than this (absolute)")
+    compare_parser.add_argument("-o", "--output", type=str, default=None,
+                                help="Write the Markdown report to this file instead of the standard output")
+    args = parser.parse_args()
+
+    db = open_db(args.db)
+    if args.command == "ingest":
+        run_id = ingest_run(db, args.dir, args.name, label=args.label, host=args.host, version=args.server_version)
+        if run_id is None:
+            return 1
+        print(f"Stored run {run_id}")
+    elif args.command == "list":
+        print(f"{'Id':>4}  {'Label':<24} {'Name':<16} {'Started':<19} {'Minutes':>7}  {'Commit':<14} Server")
+        for (run_id, label, name, started, finished, commit, version) in db.execute(
+                "SELECT id, label, name, started, finished, git_commit, server_version FROM runs ORDER BY started"):
+            started_text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))
+            print(f"{run_id:>4}  {label:<24} {name:<16} {started_text:<19} {(finished - started) / 60:>7.1f}  "
+                  f"{commit or '':<14} {version or ''}")
+    elif args.command == "compare":
+        baseline_ids = select_runs(db, args.baseline, args.name)
+        candidate_ids = select_runs(db, args.candidate, args.name)
+        if len(baseline_ids) == 0 or len(candidate_ids) == 0:
+            print("No runs to compare", file=sys.stderr)
+            return 1
+        rows, regressions = compare(db, baseline_ids, candidate_ids, args.alpha, args.max_regression,
+                                      args.max_failure_increase)
+        report = format_report(rows, args.baseline, args.candidate, baseline_ids, candidate_ids)
+        bottlenecks = run_bottlenecks(db, sorted(set(baseline_ids + candidate_ids)))
+        if len(bottlenecks) > 0:
+            report += "\n## Bottlenecks\n\n" + "".join(f"* Run {run_id}: {bottleneck} ({reason})\n"
+                                                       for (run_id, bottleneck, reason) in bottlenecks)
+            if any(bottleneck == "load generator" for (_, bottleneck, _) in bottlenecks):
+                report += "\nThe load generator was saturated in some runs, so their response times are not " \
+                          "the server's alone.\n"
+        if len(regressions) > 0:
+            report += "\n## Significant regressions\n\n" + "".join(f"* {regression}\n" for regression in regressions)
+        if args.output is not None:
+            with open(args.output, "w", encoding="utf-8") as report_file:
+                report_file.write(report)
+        else:
+            print(report, end="")
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
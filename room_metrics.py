@@ -0,0 +1,194 @@
+################################################################################
+#
+# room_metrics.py - Request statistics broken down by room size
+#
+# A handful of huge rooms dominate the load on the server, but Locust only
+# labels requests by endpoint.  MatrixUser tags every room operation with the
+# size bucket of its room (taken from the rooms.json assignment) in the request
+# context, and this module keeps a separate set of Locust request statistics
+# for each bucket.  Workers send their statistics to the master along with the
+# regular Locust reports, so the breakdown is live on the master.  It is shown
+# on an extra "Room sizes" tab at http://<master>:8089/room-sizes and written
+# to <csv prefix>_room_sizes.csv at the end of the test.
+#
+################################################################################
+
+import csv
+import io
+import logging
+
+from locust import events
+from locust.runners import WorkerRunner
+from locust.stats import RequestStats, StatsEntry
+
+ROOM_SIZE_BUCKETS = ["2", "3-5", "6-10", "11-50", "51-200", "201-1000", "1000+", "unknown"]
+
+CSV_HEADER = ["Room Size", "Type", "Name", "Request Count", "Failure Count",
+              "Median Response Time", "Average Response Time", "Min Response Time",
+              "Max Response Time", "95%", "99%", "Requests/s", "Failures/s"]
+
+# Room size bucket -> RequestStats
+bucket_stats = {}
+
+
+def room_size_bucket(num_members):
+    """Maps a room's member count to a coarse bucket label for the statistics"""
+    if num_members is None:
+        return "unknown"
+    for upper, label in [(2, "2"), (5, "3-5"), (10, "6-10"), (50, "11-50"), (200, "51-200"), (1000, "201-1000")]:
+        if num_members <= upper:
+            return label
+    return "1000+"
+
+
+def get_bucket_stats(bucket):
+    stats = bucket_stats.get(bucket, None)
+    if stats is None:
+        stats = RequestStats(use_response_times_cache=False)
+        bucket_stats[bucket] = stats
+    return stats
+
+
+def stats_rows(global_stats):
+    """Returns one row per (bucket, request) plus one aggregated row per bucket, in CSV_HEADER order
+
+        The rates are over the whole test so far, from Locust's own statistics, rather than over the
+        time between the first and the last request of each bucket.
+    """
+    duration = 0.0
+    if global_stats.start_time and global_stats.last_request_timestamp:
+        duration = global_stats.last_request_timestamp - global_stats.start_time
+    rows = []
+    for bucket in sorted(bucket_stats.keys(), key=lambda b: ROOM_SIZE_BUCKETS.index(b)
+                         if b in ROOM_SIZE_BUCKETS else len(ROOM_SIZE_BUCKETS)):
+        stats = bucket_stats[bucket]
+        entries = sorted(stats.entries.values(), key=lambda e: (e.name, e.method))
+        for entry in entries + [stats.total]:
+            rows.append([bucket, entry.method or "", entry.name, entry.num_requests, entry.num_failures,
+                         entry.median_response_time, round(entry.avg_response_time, 2),
+                         round(entry.min_response_time or 0, 2), round(entry.max_response_time, 2),
+                         entry.get_response_time_percentile(0.95), entry.get_response_time_percentile(0.99),
+                         round(entry.num_requests / duration, 2) if duration > 0 else 0.0,
+                         round(entry.num_failures / duration, 2) if duration > 0 else 0.0])
+    return rows
+
+
+def write_csv(csvfile, global_stats):
+    writer = csv.writer(csvfile)
+    writer.writerow(CSV_HEADER)
+    writer.writerows(stats_rows(global_stats))
+
+
+# Locust event hooks ###########################################################
+
+@events.request.add_listener
+def on_request(request_type, name, response_time, response_length, exception=None, context=None, **_kwargs):
+    bucket = (context or {}).get("room_size_bucket", None)
+    if bucket is None:
+        return
+    stats = get_bucket_stats(bucket)
+    stats.log_request(request_type, name, response_time, response_length)
+    if exception is not None:
+        stats.log_error(request_type, name, exception)
+
+
+@events.report_to_master.add_listener
+def on_report_to_master(client_id, data):
+    # get_stripped_report() resets the worker's entries, just like Locust's own statistics
+    data["room_size_stats"] = {
+        bucket: { "entries": stats.serialize_stats(), "total": stats.total.get_stripped_report() }
+        for bucket, stats in bucket_stats.items()
+    }
+
+
+@events.worker_report.add_listener
+def on_worker_report(client_id, data):
+    for bucket, report in data.get("room_size_stats", {}).items():
+        stats = get_bucket_stats(bucket)
+        for entry_data in report["entries"]:
+            entry = StatsEntry.unserialize(entry_data)
+            stats.get(entry.name, entry.method).extend(entry)
+        stats.total.extend(StatsEntry.unserialize(report["total"]))
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    bucket_stats.clear()
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **_kwargs):
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    csv_prefix = getattr(environment.parsed_options, "csv_prefix", None)
+    if csv_prefix:
+        path = f"{csv_prefix}_room_sizes.csv"
+        logging.info("Writing room size statistics to %s", path)
+        with open(path, "w", encoding="utf-8", newline="") as csvfile:
+            write_csv(csvfile, environment.stats)
+
+
+# Web UI #######################################################################
+
+ROOM_SIZES_TEMPLATE = """
+{% extends "index.html" %}
+{% block extended_tabs %}
+<li><a href="#" class="room-sizes-tab-link">Room sizes</a></li>
+{% endblock extended_tabs %}
+{% block extended_panes %}
+<div style="display:none;">
+  <p><a href="./room-sizes/csv">Download room size statistics CSV</a></p>
+  <table id="room-sizes-table" class="stats">
+    <thead><tr>{% for column in columns %}<th>{{ column }}</th>{% endfor %}</tr></thead>
+    <tbody></tbody>
+  </table>
+</div>
+{% endblock extended_panes %}
+{% block extended_script %}
+<script type="text/javascript">
+function updateRoomSizes() {
+  $.get("./room-sizes/stats", function (data) {
+    var body = $("#room-sizes-table tbody").empty();
+    data.rows.forEach(function (row) {
+      var tr = $("<tr>");
+      row.forEach(function (cell) { tr.append($("<td>").text(cell)); });
+      body.append(tr);
+    });
+  });
+  setTimeout(updateRoomSizes, 2000);
+}
+updateRoomSizes();
+</script>
+{% endblock extended_script %}
+"""
+
+
+@events.init.add_listener
+def on_locust_init(environment, **_kwargs):
+    if environment.web_ui is None or isinstance(environment.runner, WorkerRunner):
+        return
+
+    from flask import jsonify, make_response, render_template_string
+
+    web_ui = environment.web_ui
+
+    @web_ui.app.route("/room-sizes")
+    @web_ui.auth_required_if_enabled
+    def room_sizes_page():
+        web_ui.update_template_args()
+        return render_template_string(ROOM_SIZES_TEMPLATE, columns=CSV_HEADER, **web_ui.template_args)
+
+    @web_ui.app.route("/room-sizes/stats")
+    @web_ui.auth_required_if_enabled
+    def room_sizes_stats():
+        return jsonify({ "columns": CSV_HEADER, "rows": stats_rows(environment.stats) })
+
+    @web_ui.app.route("/room-sizes/csv")
+    @web_ui.auth_required_if_enabled
+    def room_sizes_csv():
+        data = io.StringIO()
+        write_csv(data, environment.stats)
+        response = make_response(data.getvalue())
+        response.headers["Content-type"] = "text/csv"
+        response.headers["Content-disposition"] = "attachment;filename=room_sizes.csv"
+        return response
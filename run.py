@@ -5,8 +5,13 @@ import datetime
 import json
 import multiprocessing
 import os
+import subprocess
+import sys
 
 from argparse import Namespace
+from json import dump as dump_json
+
+import results
 
 # Define JSON test schema and set default parameters
 TEST_SCHEMA = {
@@ -20,6 +25,8 @@ TEST_SCHEMA = {
     "spawn_rate": None,
     "runtime": None,
     "autoquit": 5,
+    "seed": None,
+    "profiles": None,
     "output_dir": os.getcwd()
 }
 
@@ -45,9 +52,27 @@ def run_script(args, json=None):
                            "fields: 'num_users', 'spawn_rate', or 'runtime'")
         script_path = json.script
 
+    # Sample the resource usage of the load generator (and the server) next to the Locust statistics
+    sampler = None
+    if not args.no_sampler:
+        output_dir = args.output_dir if json is None else json.output_dir
+        name = args.name if json is None else json.name
+        os.makedirs(output_dir, exist_ok=True)
+        sampler_command = [sys.executable, "sampler.py", "-o", f"{output_dir}/{name}_resources.csv",
+                           "--interval", str(args.sample_interval)]
+        if not (args.target_container is None):
+            sampler_command += ["--target-container", args.target_container]
+        if not (args.target_process is None):
+            sampler_command += ["--target-process", args.target_process]
+        sampler = subprocess.Popen(sampler_command)
+
     # Start up locust worker background processes
-    for i in range(args.num_workers):
-        os.system(f"locust -f {script_path} --headless --worker &")
+    if args.prefork:
+        # Fork the workers from one parent, so that they share the read-only data
+        os.system(f"python3 prefork.py -f {script_path} -n {args.num_workers} --headless &")
+    else:
+        for i in range(args.num_workers):
+            os.system(f"locust -f {script_path} --headless --worker &")
 
     # Start up master process
     master_command = f"locust -f {script_path}"
@@ -55,6 +80,10 @@ def run_script(args, json=None):
     master_command += f" --expect-workers {args.num_workers}"
     master_command += " --csv-full-history"
 
+    seed = args.seed if json is None or json.seed is None else json.seed
+    if not (seed is None):
+        master_command += f" --seed {seed}"
+
     if json is None:
         master_command += f" --csv {args.output_dir}/{args.name}.csv"
         master_command += f" --html {args.output_dir}/{args.name}.html"
@@ -71,10 +100,40 @@ def run_script(args, json=None):
         master_command += f" --run-time {json.runtime}"
         master_command += "" if json.autoquit is None else f" --autoquit {json.autoquit}"
 
+        # Behaviour profiles, from a file or given inline in the test suite (see profiles.py)
+        if isinstance(json.profiles, dict):
+            os.makedirs(json.output_dir, exist_ok=True)
+            profiles_path = f"{json.output_dir}/{json.name}_profiles.json"
+            with open(profiles_path, "w", encoding="utf-8") as profiles_file:
+                dump_json(json.profiles, profiles_file, indent=2)
+            master_command += f" --profiles {profiles_path}"
+        elif not (json.profiles is None):
+            master_command += f" --profiles {json.profiles}"
+
     os.system(master_command)
 
+    if not (sampler is None):
+        sampler.terminate()
+        sampler.wait()
+
     # Terminate background worker processes (do not always terminate on CTRL-C)
     os.system("killall locust")
+    if args.prefork:
+        os.system("pkill -f prefork.py")
+
+    # Store the run in the results database, for comparing runs with results.py
+    if not (args.results_db is None):
+        output_dir = args.output_dir if json is None else json.output_dir
+        name = args.name if json is None else json.name
+        params = { "script": script_path, "num_workers": args.num_workers, "seed": seed, "prefork": args.prefork }
+        if not (json is None):
+            params.update(vars(json))
+        db = results.open_db(args.results_db)
+        run_id = results.ingest_run(db, output_dir, name, label=args.label, params=params,
+                                    host=None if args.host is None else host)
+        db.close()
+        if not (run_id is None):
+            print(f"[{datetime.datetime.now()}] Stored the results as run {run_id} in {args.results_db}")
 
 parser = argparse.ArgumentParser(description="Runs a matrix load-test")
 parser.add_argument("path", type=str,
@@ -88,6 +147,22 @@ parser.add_argument("-o", "--output_dir", type=str, nargs="?", default=os.getcwd
                     help="Path to store csv and html data")
 parser.add_argument("--name", type=str, nargs="?", default="locust",
                     help="Path to store csv and html data")
+parser.add_argument("--seed", type=str, nargs="?", default=None,
+                    help="Seed for reproducible user behaviour (overridden by a test's 'seed' field)")
+parser.add_argument("--prefork", action="store_true", default=False,
+                    help="Fork the workers from a parent process that has the shared data pre-loaded")
+parser.add_argument("--sample-interval", type=float, default=0.5,
+                    help="Seconds between samples of the resource usage, written to <name>_resources.csv")
+parser.add_argument("--target-container", type=str, default=None,
+                    help="Also sample the resource usage of this Docker container (e.g. the homeserver)")
+parser.add_argument("--target-process", type=str, default=None,
+                    help="Also sample the resource usage of the processes whose command line contains this string")
+parser.add_argument("--no-sampler", action="store_true", default=False,
+                    help="Don't sample the resource usage")
+parser.add_argument("--results-db", type=str, default=None,
+                    help="Store every run in this results database (see results.py)")
+parser.add_argument("--label", type=str, default=None,
+                    help="Label for the runs in the results database, e.g. the server build (defaults to its version)")
 
 args = parser.parse_args()
 
@@ -0,0 +1,373 @@
+#!/bin/env python3
+
+################################################################################
+#
+# sampler.py - Samples the resource usage of the load generator and the server
+#
+# run.py starts this sampler next to the Locust master for every test, so the
+# resource usage ends up next to the Locust statistics.  Every interval (half a
+# second by default) it writes one CSV row with:
+#
+#   * The CPU, memory and network use of this host
+#   * The CPU and memory use of the load generator itself (every locust and
+#     prefork.py process on this host)
+#   * Optionally, the CPU, memory, disk and network use of the server under
+#     test: a Docker container (like the homeserver in docker-compose.yaml), a
+#     cgroup (e.g. a systemd service), or a process matched by its command line
+#
+# Rows are stamped with the Unix time in seconds, like the Timestamp column of
+# Locust's --csv-full-history output, so the two files can be joined on time.
+# CPU use is in percent of one CPU for processes and containers, and in percent
+# of all CPUs for the host.  Everything reads /proc and /sys/fs/cgroup, so the
+# sampler needs no extra packages and can also be copied to a remote server
+# (see scripts/start-monitoring.sh).
+#
+#   python3 sampler.py -o resources.csv --target-container matrix-homeserver-1
+#
+################################################################################
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Command line substrings of the load generator's processes
+GENERATOR_PATTERNS = ["locust", "prefork.py"]
+
+# How often to look for new or restarted processes, in seconds
+PROCESS_RESCAN_INTERVAL = 2.0
+
+CSV_HEADER = [
+    "Timestamp",
+    "host_cpu_percent", "host_mem_used_bytes", "host_load1", "host_net_rx_bytes_per_s", "host_net_tx_bytes_per_s",
+    "generator_processes", "generator_cpu_percent", "generator_rss_bytes",
+    "target_cpu_percent", "target_mem_bytes", "target_read_bytes_per_s", "target_write_bytes_per_s",
+    "target_net_rx_bytes_per_s", "target_net_tx_bytes_per_s",
+]
+
+
+# /proc #######################################################################
+
+def read_host_cpu():
+    """Returns the busy and total CPU time of the host, in clock ticks"""
+    with open("/proc/stat", "r", encoding="utf-8") as stat:
+        fields = [int(value) for value in stat.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)    # idle + iowait
+    total = sum(fields[:8])     # Guest time is already counted in user and nice
+    return total - idle, total
+
+
+def read_mem_used():
+    fields = {}
+    with open("/proc/meminfo", "r", encoding="utf-8") as meminfo:
+        for line in meminfo:
+            name, value = line.split(":", 1)
+            fields[name] = int(value.split()[0]) * 1024
+    return fields["MemTotal"] - fields.get("MemAvailable", fields.get("MemFree", 0))
+
+
+def read_load1():
+    with open("/proc/loadavg", "r", encoding="utf-8") as loadavg:
+        return float(loadavg.read().split()[0])
+
+
+def read_net_bytes(pid=None):
+    """Returns the received and sent bytes of all interfaces but loopback, in our network namespace or a process's"""
+    path = "/proc/net/dev" if pid is None else f"/proc/{pid}/net/dev"
+    rx = tx = 0
+    try:
+        with open(path, "r", encoding="utf-8") as net_dev:
+            for line in net_dev.readlines()[2:]:
+                interface, counters = line.split(":", 1)
+                if interface.strip() == "lo":
+                    continue
+                counters = counters.split()
+                rx += int(counters[0])
+                tx += int(counters[8])
+    except OSError:
+        return None
+    return rx, tx
+
+
+def read_process(pid):
+    """Returns the CPU time (in ticks), RSS, and disk read and write bytes of a process, or None if it's gone"""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as stat:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = stat.read().rsplit(")", 1)[1].split()
+        cpu_ticks = int(fields[11]) + int(fields[12])   # utime + stime
+        rss = int(fields[21]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+    read_bytes = write_bytes = None
+    try:
+        with open(f"/proc/{pid}/io", "r", encoding="utf-8") as io:
+            counters = dict(line.split(":", 1) for line in io if ":" in line)
+        read_bytes = int(counters["read_bytes"])
+        write_bytes = int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        pass    # Only readable for our own processes, or as root
+    return cpu_ticks, rss, read_bytes, write_bytes
+
+
+def find_processes(patterns):
+    """Returns the pids of the processes whose command line contains any of the patterns"""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as cmdline:
+                command = cmdline.read().replace(b"\0", b" ").decode("utf-8", "replace")
+        except OSError:
+            continue
+        if "sampler.py" not in command and any(pattern in command for pattern in patterns):
+            pids.append(int(entry))
+    return pids
+
+
+# cgroups #####################################################################
+
+class Cgroup:
+    """Reads the CPU, memory and I/O counters of a cgroup, in cgroup v2 or v1 layout"""
+
+    def __init__(self, path):
+        self.path = path
+        self.v2 = os.path.exists(os.path.join(path, "cpu.stat"))
+
+    def _read(self, *parts):
+        with open(os.path.join(*parts), "r", encoding="utf-8") as counter_file:
+            return counter_file.read()
+
+    def cpu_usec(self):
+        if self.v2:
+            for line in self._read(self.path, "cpu.stat").splitlines():
+                name, value = line.split()
+                if name == "usage_usec":
+                    return int(value)
+            return None
+        return int(self._read(self.path.replace("/memory/", "/cpuacct/"), "cpuacct.usage")) // 1000
+
+    def memory_bytes(self):
+        if self.v2:
+            return int(self._read(self.path, "memory.current"))
+        return int(self._read(self.path, "memory.usage_in_bytes"))
+
+    def io_bytes(self):
+        read_bytes = write_bytes = 0
+        if self.v2:
+            for line in self._read(self.path, "io.stat").splitlines():
+                for field in line.split()[1:]:
+                    name, value = field.split("=", 1)
+                    if name == "rbytes":
+                        read_bytes += int(value)
+                    elif name == "wbytes":
+                        write_bytes += int(value)
+        else:
+            path = self.path.replace("/memory/", "/blkio/")
+            for line in self._read(path, "blkio.throttle.io_service_bytes").splitlines():
+                parts = line.split()
+                if len(parts) == 3 and parts[1] == "Read":
+                    read_bytes += int(parts[2])
+                elif len(parts) == 3 and parts[1] == "Write":
+                    write_bytes += int(parts[2])
+        return read_bytes, write_bytes
+
+
+def find_container(name):
+    """Returns the cgroup and the main pid of a Docker container, or (None, None)"""
+    try:
+        output = subprocess.run(["docker", "inspect", "-f", "{{.Id}} {{.State.Pid}}", name],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error("Could not inspect container %s: %s", name, e)
+        return None, None
+    container_id, pid = output.split()
+    candidates = [
+        f"/sys/fs/cgroup/system.slice/docker-{container_id}.scope",    # cgroup v2 with systemd
+        f"/sys/fs/cgroup/docker/{container_id}",                        # cgroup v2 with cgroupfs
+        f"/sys/fs/cgroup/memory/docker/{container_id}",                 # cgroup v1
+        f"/sys/fs/cgroup/memory/system.slice/docker-{container_id}.scope",
+    ]
+    candidates += glob.glob(f"/sys/fs/cgroup/**/*{container_id}*", recursive=True)
+    for path in candidates:
+        if os.path.isdir(path) and (os.path.exists(os.path.join(path, "cpu.stat"))
+                                    or os.path.exists(os.path.join(path, "memory.usage_in_bytes"))):
+            return Cgroup(path), int(pid)
+    logging.error("Could not find the cgroup of container %s", name)
+    return None, int(pid)
+
+
+# Sampling ####################################################################
+
+class Sampler:
+    """Turns the raw counters into one row of rates per sample"""
+
+    def __init__(self, target_patterns=None, target_pids=None, cgroup=None, net_pid=None):
+        self.target_patterns = target_patterns
+        self.fixed_target_pids = target_pids
+        self.cgroup = cgroup
+        self.net_pid = net_pid
+        self.generator_pids = []
+        self.target_pids = target_pids or []
+        self.last_scan = None
+        self.previous = None
+
+    def has_target(self):
+        return self.target_patterns is not None or self.fixed_target_pids is not None or self.cgroup is not None
+
+    def rescan(self, now):
+        if self.last_scan is not None and now - self.last_scan < PROCESS_RESCAN_INTERVAL:
+            return
+        self.last_scan = now
+        self.generator_pids = find_processes(GENERATOR_PATTERNS)
+        if self.target_patterns is not None:
+            self.target_pids = [pid for pid in find_processes(self.target_patterns) if pid not in self.generator_pids]
+
+    def read_counters(self, now):
+        self.rescan(now)
+        counters = { "time": now, "host_cpu": read_host_cpu(), "host_net": read_net_bytes() }
+        generator = [read_process(pid) for pid in self.generator_pids]
+        counters["generator"] = { pid: process for (pid, process) in zip(self.generator_pids, generator)
+                                  if process is not None }
+
+        if self.cgroup is not None:
+            for (name, read) in [("target_cpu_usec", self.cgroup.cpu_usec), ("target_mem", self.cgroup.memory_bytes),
+                                 ("target_io", self.cgroup.io_bytes)]:
+                try:
+                    counters[name] = read()
+                except (OSError, ValueError):
+                    pass    # The controller isn't enabled for this cgroup, or the container stopped
+        elif self.has_target():
+            target = { pid: process for (pid, process) in ((pid, read_process(pid)) for pid in self.target_pids)
+                       if process is not None }
+            counters["target"] = target
+        if self.net_pid is not None:
+            counters["target_net"] = read_net_bytes(self.net_pid)
+        return counters
+
+    def sample(self):
+        """Returns the row for the interval since the previous sample (None for the first sample)"""
+        now = time.time()
+        counters = self.read_counters(now)
+        previous, self.previous = self.previous, counters
+        if previous is None:
+            return None
+        elapsed = now - previous["time"]
+
+        def rate(current, last):
+            return None if current is None or last is None else (current - last) / elapsed
+
+        def process_cpu(current, last):
+            # Only count the processes that were there for the whole interval
+            ticks = sum(process[0] - last[pid][0] for (pid, process) in current.items() if pid in last)
+            return ticks / CLOCK_TICKS / elapsed * 100
+
+        busy, total = counters["host_cpu"]
+        last_busy, last_total = previous["host_cpu"]
+        row = {
+            "Timestamp": "%.3f" % now,
+            "host_cpu_percent": "%.1f" % ((busy - last_busy) / max(1, total - last_total) * 100),
+            "host_mem_used_bytes": read_mem_used(),
+            "host_load1": read_load1(),
+        }
+        if counters["host_net"] is not None and previous["host_net"] is not None:
+            row["host_net_rx_bytes_per_s"] = "%.0f" % rate(counters["host_net"][0], previous["host_net"][0])
+            row["host_net_tx_bytes_per_s"] = "%.0f" % rate(counters["host_net"][1], previous["host_net"][1])
+
+        generator = counters["generator"]
+        row["generator_processes"] = len(generator)
+        row["generator_cpu_percent"] = "%.1f" % process_cpu(generator, previous["generator"])
+        row["generator_rss_bytes"] = sum(process[1] for process in generator.values())
+
+        if self.cgroup is not None:
+            if counters.get("target_cpu_usec", None) is not None and previous.get("target_cpu_usec", None) is not None:
+                row["target_cpu_percent"] = "%.1f" % (rate(counters["target_cpu_usec"], previous["target_cpu_usec"]) / 10000)
+            row["target_mem_bytes"] = counters.get("target_mem", None)
+            if "target_io" in counters and "target_io" in previous:
+                row["target_read_bytes_per_s"] = "%.0f" % rate(counters["target_io"][0], previous["target_io"][0])
+                row["target_write_bytes_per_s"] = "%.0f" % rate(counters["target_io"][1], previous["target_io"][1])
+        elif "target" in counters and "target" in previous:
+            target, last_target = counters["target"], previous["target"]
+            row["target_cpu_percent"] = "%.1f" % process_cpu(target, last_target)
+            row["target_mem_bytes"] = sum(process[1] for process in target.values())
+            common = [pid for pid in target if pid in last_target and target[pid][2] is not None
+                      and last_target[pid][2] is not None]
+            if len(common) > 0:
+                row["target_read_bytes_per_s"] = "%.0f" % (sum(target[pid][2] - last_target[pid][2] for pid in common) / elapsed)
+                row["target_write_bytes_per_s"] = "%.0f" % (sum(target[pid][3] - last_target[pid][3] for pid in common) / elapsed)
+        if counters.get("target_net", None) is not None and previous.get("target_net", None) is not None:
+            row["target_net_rx_bytes_per_s"] = "%.0f" % rate(counters["target_net"][0], previous["target_net"][0])
+            row["target_net_tx_bytes_per_s"] = "%.0f" % rate(counters["target_net"][1], previous["target_net"][1])
+        return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Samples the resource usage of the load generator and the server")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="CSV file to write")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="Seconds between samples")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Stop after this many seconds (default: run until interrupted)")
+    parser.add_argument("--target-container", type=str, default=None,
+                        help="Name or id of the Docker container of the server")
+    parser.add_argument("--target-cgroup", type=str, default=None,
+                        help="cgroup directory of the server, e.g. /sys/fs/cgroup/system.slice/matrix-synapse.service")
+    parser.add_argument("--target-process", type=str, action="append", default=None,
+                        help="Command line substring of the server's processes (may be repeated)")
+    parser.add_argument("--target-pid", type=int, action="append", default=None,
+                        help="Pid of a server process (may be repeated)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s sampler: %(message)s")
+
+    cgroup = None
+    net_pid = None
+    if args.target_container is not None:
+        cgroup, net_pid = find_container(args.target_container)
+    elif args.target_cgroup is not None:
+        cgroup = Cgroup(args.target_cgroup)
+    elif args.target_pid is not None:
+        net_pid = args.target_pid[0]
+    sampler = Sampler(target_patterns=args.target_process, target_pids=args.target_pid,
+                      cgroup=cgroup, net_pid=net_pid)
+
+    stopping = False
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    start = time.monotonic()
+    num_samples = 0
+    with open(args.output, "w", encoding="utf-8", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_HEADER)
+        writer.writeheader()
+        sampler.sample()
+        next_sample = start + args.interval
+        while not stopping and (args.duration is None or time.monotonic() - start < args.duration):
+            # Keep a fixed schedule, so that the sampling itself doesn't make the intervals drift
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_sample += args.interval
+            row = sampler.sample()
+            if row is not None:
+                writer.writerow(row)
+                csvfile.flush()
+                num_samples += 1
+    logging.info("Wrote %d samples to %s", num_samples, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+################################################################################
+#
+# saturation.py - Detects a saturated load generator, and throttles spawning
+#
+# When a worker's gevent loop falls behind (thousands of sync_forever greenlets
+# plus the task greenlets), the response times it measures include the time
+# that finished requests wait for the loop to get round to them, and stop
+# saying anything about the server.  Every worker runs a probe greenlet that
+# measures how late the loop wakes it up, along with the worker's CPU use, and
+# sends both to the master with the regular Locust reports.
+#
+# A worker is saturated while its mean loop lag or CPU use passes a threshold
+# (--saturation-lag, --saturation-cpu).  While any worker is saturated during
+# the ramp-up, the master stops spawning users, and it carries on at half the
+# spawn rate once no worker has been saturated for --saturation-resume-after
+# seconds (--no-spawn-throttle turns this off).  Every report is written to
+# <csv prefix>_saturation.csv, flagging the saturated intervals, and at the end
+# of the test <csv prefix>_saturation.json says whether the load generator or
+# the server was the bottleneck.
+#
+################################################################################
+
+import csv
+import json
+import logging
+import time
+from collections import Counter
+
+import gevent
+from locust import events
+from locust.runners import STATE_SPAWNING, MasterRunner, WorkerRunner
+from locust.stats import calculate_response_time_percentile
+
+# How often the probe greenlet asks to be woken up, in seconds
+LAG_PROBE_INTERVAL = 0.1
+
+# How often a single-process run takes a sample, like Locust's worker reports
+LOCAL_SAMPLE_INTERVAL = 3.0
+
+# The load generator was the bottleneck if at least this fraction of the samples was saturated
+GENERATOR_BOTTLENECK_FRACTION = 0.05
+
+# The server was the bottleneck if at least this fraction of the requests failed,
+# or if the 95th percentile response time grew by more than this factor during the test
+SERVER_FAILURE_RATIO = 0.01
+SERVER_SLOWDOWN_FACTOR = 2.0
+
+# The request types of real HTTP requests, rather than our synthetic PHASE, DELIVER, DECODE etc. samples
+HTTP_METHODS = {"GET", "POST", "PUT", "DELETE"}
+
+CSV_HEADER = ["Timestamp", "Worker", "User Count", "Loop Lag Mean (ms)", "Loop Lag Max (ms)", "CPU %",
+              "Saturated", "Spawning Paused", "Interval 95% (ms)"]
+
+
+class LoopMonitor:
+    """Measures how late the gevent loop wakes up a probe greenlet, and this process's CPU use"""
+
+    def __init__(self):
+        self.greenlet = None
+        self.runner = None
+        self.reset()
+
+    def reset(self):
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.num_probes = 0
+        self.wall_start = time.monotonic()
+        self.cpu_start = time.process_time()
+
+    def run(self):
+        while True:
+            before = time.monotonic()
+            gevent.sleep(LAG_PROBE_INTERVAL)
+            lag = max(0.0, time.monotonic() - before - LAG_PROBE_INTERVAL)
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.num_probes += 1
+
+    def start(self, runner):
+        self.stop()
+        self.runner = runner
+        self.reset()
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill(block=False)
+            self.greenlet = None
+
+    def sample(self):
+        """Returns the loop lag and CPU use since the last sample, and starts a new one"""
+        wall_time = time.monotonic() - self.wall_start
+        cpu_time = time.process_time() - self.cpu_start
+        # With no probes at all, the loop was blocked for the whole interval
+        lag_mean = self.lag_total / self.num_probes if self.num_probes > 0 else wall_time
+        sample = { "user_count": self.runner.user_count if self.runner is not None else 0,
+                   "lag_mean_ms": round(lag_mean * 1000, 2),
+                   "lag_max_ms": round(max(self.lag_max, lag_mean) * 1000, 2),
+                   "cpu_percent": round(100 * cpu_time / wall_time, 1) if wall_time > 0 else 0.0 }
+        self.reset()
+        return sample
+
+
+class SaturationTracker:
+    """The master's view of the workers' samples, and the spawn throttle"""
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.csv_file = None
+        self.csv_writer = None
+        self.num_samples = 0
+        self.num_saturated = 0
+        self.saturated_workers = set()
+        self.last_saturated = None      # When a worker last reported a saturated sample
+        self.paused_target = None       # The user count to resume spawning to, while paused
+        self.paused_since = None
+        self.paused_seconds = 0.0
+        self.num_pauses = 0
+        self.spawn_rate = getattr(environment.parsed_options, "spawn_rate", None) or 1
+        self.p95_samples = []           # (timestamp, 95th percentile response time since the last sample)
+        self.last_p95 = None
+        self.last_p95_time = 0.0
+        self.last_response_times = Counter()
+
+    def open_csv(self, path):
+        self.csv_file = open(path, "w", encoding="utf-8", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(CSV_HEADER)
+
+    def close_csv(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
+
+    def is_saturated(self, sample):
+        options = self.environment.parsed_options
+        return sample["lag_mean_ms"] >= getattr(options, "saturation_lag", 50) or \
+            sample["cpu_percent"] >= getattr(options, "saturation_cpu", 90)
+
+    def add_sample(self, worker, sample):
+        now = time.time()
+        saturated = self.is_saturated(sample)
+        self.num_samples += 1
+        if saturated:
+            self.num_saturated += 1
+            self.last_saturated = now
+            if worker not in self.saturated_workers:
+                logging.warning("Worker %s is saturated: %.0f ms loop lag, %.0f%% CPU with %d users",
+                                worker, sample["lag_mean_ms"], sample["cpu_percent"], sample["user_count"])
+            self.saturated_workers.add(worker)
+        else:
+            self.saturated_workers.discard(worker)
+
+        if not getattr(self.environment.parsed_options, "no_spawn_throttle", False):
+            self.throttle(now, saturated)
+
+        # The workers all report at about the same time, so share one interval between their samples
+        if now - self.last_p95_time >= LOCAL_SAMPLE_INTERVAL / 2:
+            self.last_p95 = self.interval_p95()
+            self.last_p95_time = now
+            if self.last_p95 is not None:
+                self.p95_samples.append((now, self.last_p95))
+        p95 = self.last_p95
+        if self.csv_writer is not None:
+            self.csv_writer.writerow([int(now), worker, sample["user_count"], sample["lag_mean_ms"],
+                                      sample["lag_max_ms"], sample["cpu_percent"], int(saturated),
+                                      int(self.paused_target is not None), "" if p95 is None else p95])
+            self.csv_file.flush()
+
+    def interval_p95(self):
+        """Returns the 95th percentile response time of the HTTP requests since the last call
+
+            The /sync long polls, and our synthetic samples of other request types, are left out.
+        """
+        response_times = Counter()
+        for entry in self.environment.runner.stats.entries.values():
+            if entry.method in HTTP_METHODS and not entry.name.endswith("/sync"):
+                response_times.update(entry.response_times)
+        interval = response_times - self.last_response_times
+        self.last_response_times = response_times
+        num_requests = sum(interval.values())
+        if num_requests == 0:
+            return None
+        return calculate_response_time_percentile(interval, num_requests, 0.95)
+
+    def throttle(self, now, saturated):
+        """Pauses spawning while a worker is saturated, and resumes it at half the spawn rate"""
+        runner = self.environment.runner
+        if saturated and self.paused_target is None and runner.state == STATE_SPAWNING:
+            user_count = runner.user_count
+            if user_count >= runner.target_user_count:
+                return
+            self.paused_target = runner.target_user_count
+            self.paused_since = now
+            if self.num_pauses == 0:
+                # The master knows the spawn rate from the web UI too
+                self.spawn_rate = getattr(runner, "spawn_rate", None) or self.spawn_rate
+            self.num_pauses += 1
+            print(f"Load generator saturated: paused spawning at {user_count} of {self.paused_target} users")
+            # Restarting the test at the users spawned so far ends the ramp-up, like a new target from the web UI
+            gevent.spawn(runner.start, user_count, self.spawn_rate)
+        elif self.paused_target is not None and now - self.last_saturated >= \
+                getattr(self.environment.parsed_options, "saturation_resume_after", 10):
+            self.spawn_rate = max(1.0, self.spawn_rate / 2)
+            target = self.paused_target
+            self.paused_seconds += now - self.paused_since
+            self.paused_target = None
+            self.paused_since = None
+            print(f"Load generator recovered: resuming spawning to {target} users at {self.spawn_rate:g}/s")
+            gevent.spawn(runner.start, target, self.spawn_rate)
+
+    def verdict(self):
+        """Returns which side was the bottleneck of the test, and the figures that tell"""
+        total = self.environment.runner.stats.total
+        saturated_fraction = self.num_saturated / self.num_samples if self.num_samples > 0 else 0.0
+        failure_ratio = total.num_failures / total.num_requests if total.num_requests > 0 else 0.0
+        quarter = len(self.p95_samples) // 4
+        early_p95 = sorted(p95 for (_, p95) in self.p95_samples[:quarter])[quarter // 2] if quarter > 0 else None
+        late_p95 = sorted(p95 for (_, p95) in self.p95_samples[-quarter:])[quarter // 2] if quarter > 0 else None
+
+        if saturated_fraction >= GENERATOR_BOTTLENECK_FRACTION:
+            bottleneck = "load generator"
+            reason = f"{saturated_fraction * 100:.0f}% of the worker reports were saturated"
+        elif failure_ratio >= SERVER_FAILURE_RATIO:
+            bottleneck = "server"
+            reason = f"{failure_ratio * 100:.1f}% of the requests failed"
+        elif early_p95 and late_p95 and late_p95 > SERVER_SLOWDOWN_FACTOR * early_p95:
+            bottleneck = "server"
+            reason = f"the 95th percentile response time grew from {early_p95} ms to {late_p95} ms"
+        else:
+            bottleneck = "none"
+            reason = "neither the load generator nor the server was saturated"
+        paused_seconds = self.paused_seconds + (time.time() - self.paused_since if self.paused_since else 0)
+        return { "bottleneck": bottleneck, "reason": reason,
+                 "samples": self.num_samples, "saturated_samples": self.num_saturated,
+                 "saturated_fraction": round(saturated_fraction, 4),
+                 "spawn_pauses": self.num_pauses, "spawn_paused_seconds": round(paused_seconds, 1),
+                 "failure_ratio": round(failure_ratio, 4), "early_p95_ms": early_p95, "late_p95_ms": late_p95 }
+
+
+# Every process's loop monitor, and the master's (or single process's) tracker
+monitor = LoopMonitor()
+tracker = None
+local_sampler = None
+
+
+def sample_locally(environment):
+    while True:
+        gevent.sleep(LOCAL_SAMPLE_INTERVAL)
+        tracker.add_sample("local", monitor.sample())
+
+
+# Locust event hooks ###########################################################
+
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+    parser.add_argument("--saturation-lag", type=float, default=50,
+                        help="Mean event loop lag in ms at which a worker counts as saturated")
+    parser.add_argument("--saturation-cpu", type=float, default=90,
+                        help="CPU use in percent at which a worker counts as saturated")
+    parser.add_argument("--saturation-resume-after", type=float, default=10,
+                        help="Seconds without a saturated worker before spawning resumes")
+    parser.add_argument("--no-spawn-throttle", action="store_true", default=False,
+                        help="Keep spawning users while a worker is saturated")
+
+
+@events.report_to_master.add_listener
+def on_report_to_master(client_id, data):
+    data["saturation"] = monitor.sample()
+
+
+@events.worker_report.add_listener
+def on_worker_report(client_id, data):
+    if tracker is not None and "saturation" in data:
+        tracker.add_sample(client_id, data["saturation"])
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global tracker, local_sampler
+    if not isinstance(environment.runner, MasterRunner):
+        monitor.start(environment.runner)
+    if isinstance(environment.runner, WorkerRunner):
+        return
+
+    tracker = SaturationTracker(environment)
+    csv_prefix = getattr(environment.parsed_options, "csv_prefix", None)
+    if csv_prefix:
+        tracker.open_csv(f"{csv_prefix}_saturation.csv")
+    if not isinstance(environment.runner, MasterRunner):
+        local_sampler = gevent.spawn(sample_locally, environment)
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **_kwargs):
+    global local_sampler
+    monitor.stop()
+    if local_sampler is not None:
+        local_sampler.kill(block=False)
+        local_sampler = None
+    if isinstance(environment.runner, WorkerRunner) or tracker is None:
+        return
+
+    tracker.close_csv()
+    verdict = tracker.verdict()
+    print(f"Bottleneck: {verdict['bottleneck']} ({verdict['reason']})")
+    csv_prefix = getattr(environment.parsed_options, "csv_prefix", None)
+    if csv_prefix:
+        with open(f"{csv_prefix}_saturation.json", "w", encoding="utf-8") as json_file:
+            json.dump(verdict, json_file, indent=2)
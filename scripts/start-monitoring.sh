@@ -6,6 +6,13 @@ output_dir=$2
 
 # Script paramters
 output_name=$3
+# Any further parameters are passed on to sampler.py (e.g. --target-container conduit)
+shift 3
 
 # Server commands
-ssh root@$server 'bash -s' < scripts/start-pcp.sh $output_name
+
+# Copy the sampler to the server and start it in the background.
+# Have to share pid across shell sessions, so store pid in temp file
+scp sampler.py root@$server:/matrix/sampler.py
+ssh root@$server "nohup python3 /matrix/sampler.py -o /matrix/resources_$output_name.csv $* \
+    > /dev/null 2>&1 & echo \$! > /matrix/tmp_sampler_pid"
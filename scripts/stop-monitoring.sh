@@ -10,14 +10,14 @@ remove_tokens=$4
 
 # Server commands
 
-# Restore persisted pid for pcp termination
-ssh root@$server "kill -9 \`cat /matrix/tmp_pcp_pid\`; yes | rm /matrix/tmp_pcp_pid"
+# Restore persisted pid for sampler termination (SIGTERM, so that it flushes its output)
+ssh root@$server "kill \`cat /matrix/tmp_sampler_pid\`; sleep 1; yes | rm /matrix/tmp_sampler_pid"
 
 # Local commands
-scp root@$server:/matrix/pcp_$output_name.csv $output_dir/pcp_$output_name.csv
+scp root@$server:/matrix/resources_$output_name.csv $output_dir/${output_name}_server_resources.csv
 
 # Clean up files on server after copying
-ssh root@$server "yes | rm /matrix/pcp_$output_name.csv"
+ssh root@$server "yes | rm /matrix/resources_$output_name.csv"
 
 if [ "$remove_tokens" = "remove-tokens" ]; then
     yes | rm tokens.csv
@@ -0,0 +1,158 @@
+################################################################################
+#
+# setup_journal.py - Progress journal for resumable population setup
+#
+# Setting up a large population (create_room.py, join.py, setup_pipeline.py)
+# takes long enough that a crash or the --run-time limit may stop it halfway.
+# The setup scripts record their progress in a journal on the master, one JSON
+# object per line, as they go:
+#
+#   { "type": "room", "name": "Room 0", "room_id": "!abc:example.com" }
+#   { "type": "join", "username": "user.000001", "room_id": "!abc:example.com" }
+#   { "type": "joined_all", "username": "user.000001" }
+#
+# and skip what the journal says is done when they run again, without even
+# logging in the users that have nothing left to do.  Only the master reads the
+# journal file; it sends the rooms that were created and the users that have
+# joined all their rooms to the workers, which may run on other machines.  Rooms are created with
+# deterministic aliases, so a room whose creation reached the server but not
+# the journal is found again through its alias instead of being duplicated.
+#
+# verify_setup.py checks the server's rooms and memberships against rooms.json,
+# and can rewrite the journal from what it finds.
+#
+################################################################################
+
+import json
+import logging
+import os
+
+from locust import events
+from locust.runners import MasterRunner, WorkerRunner
+
+JOURNAL_PATH = "setup_journal.jsonl"
+
+
+def room_alias_name(room_name):
+    """Returns the deterministic alias localpart of a room from rooms.json"""
+    return room_name.lower().replace(" ", "-")
+
+
+class SetupJournal:
+    """The setup progress recorded in a journal file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rooms = {}             # Room name -> room id
+        self.joins = set()          # (username, room_id)
+        self.joined_all = set()     # Usernames that have joined all the rooms they were invited to
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    self.apply(json.loads(line))
+                except ValueError:
+                    # The last line is cut short if we crashed while writing it
+                    logging.warning("Skipping a corrupt line in %s", self.path)
+        return self
+
+    def apply(self, entry):
+        entry_type = entry.get("type", None)
+        if entry_type == "room":
+            self.rooms[entry["name"]] = entry["room_id"]
+        elif entry_type == "join":
+            self.joins.add((entry["username"], entry["room_id"]))
+        elif entry_type == "joined_all":
+            self.joined_all.add(entry["username"])
+
+    def append(self, entry):
+        """Records an entry, flushing it to disk right away"""
+        self.apply(entry)
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            journal_file.write(json.dumps(entry) + "\n")
+
+
+# Every process's copy of the journal, loaded at the start of the test
+journal = SetupJournal(JOURNAL_PATH)
+
+# Username -> the names of their rooms in rooms.json (see joined_all_rooms())
+rooms_by_member = None
+
+
+def record(environment, entry):
+    """Records setup progress in the master's journal, and in our own copy"""
+    if isinstance(environment.runner, WorkerRunner):
+        journal.apply(entry)
+        environment.runner.send_message("setup_journal", entry)
+    else:
+        journal.append(entry)
+
+def joined_all_rooms(user, rooms):
+    """Returns whether the user has joined every room that rooms (from rooms.json) puts them in
+
+        Only then does the journal mark the user as done: accepting every pending invite isn't
+        enough if some of the user's rooms were never created, or never invited them.  Rooms that
+        aren't in our copy of the journal, e.g. ones that another worker created, are looked up by
+        their alias, like verify_setup.py does.
+    """
+    global rooms_by_member
+    if rooms_by_member is None:
+        rooms_by_member = {}
+        for room_name, members in rooms.items():
+            for member in members:
+                rooms_by_member.setdefault(member, []).append(room_name)
+    for room_name in rooms_by_member.get(user.username, []):
+        room_id = journal.rooms.get(room_name, None)
+        if room_id is None:
+            room_id = user.resolve_room_alias(room_alias_name(room_name))
+            if room_id is None:
+                return False
+            journal.rooms[room_name] = room_id
+        if room_id not in user.joined_room_ids:
+            return False
+    return True
+
+def on_setup_journal(environment, msg, **_kwargs):
+    """(Master) Records a worker's setup progress"""
+    journal.append(msg.data)
+
+def on_setup_journal_state(environment, msg, **_kwargs):
+    """(Worker) Takes over the setup progress from the master's journal"""
+    global journal
+    journal = SetupJournal(msg.data["path"])
+    journal.rooms = msg.data["rooms"]
+    journal.joined_all = set(msg.data["joined_all"])
+
+
+# Preflight ####################################################################
+
+@events.init_command_line_parser.add_listener
+def on_init_command_line_parser(parser):
+    parser.add_argument("--setup-journal", type=str, default=JOURNAL_PATH,
+                        help="Journal of the setup progress, for resuming an interrupted setup")
+
+@events.init.add_listener
+def on_locust_init(environment, **_kwargs):
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.register_message("setup_journal", on_setup_journal)
+    elif isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("setup_journal_state", on_setup_journal_state)
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global journal
+    # The workers get the master's journal before their test starts (see on_setup_journal_state())
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    journal = SetupJournal(getattr(environment.parsed_options, "setup_journal", JOURNAL_PATH)).load()
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.send_message("setup_journal_state", { "path": journal.path, "rooms": journal.rooms,
+                                                                 "joined_all": sorted(journal.joined_all) })
+    if len(journal.rooms) > 0 or len(journal.joined_all) > 0:
+        print(f"Resuming from {journal.path}: {len(journal.rooms)} rooms created, "
+              f"{len(journal.joined_all)} users have joined all their rooms")
+
+################################################################################
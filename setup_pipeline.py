@@ -0,0 +1,296 @@
+#!/bin/env python3
+
+################################################################################
+#
+# setup_pipeline.py - Registers the users, creates and joins the rooms, and
+# then chats, all in one Locust run
+#
+# The conduit-full.json suite runs register.py, create_room.py, join.py and
+# chat.py as four separate Locust runs.  Every run restarts the workers,
+# reloads users.csv and tokens.csv and logs every user in again, and the only
+# state that passes from one run to the next is tokens.csv on the master.
+#
+# Here every Locust user takes one account from users.csv and carries it
+# through all the phases in order, keeping its access token, sync token and
+# rooms in memory:
+#
+#   1. register     Register the account (or reuse its tokens.csv entry)
+#   2. create_room  Create the rooms from rooms.json that the account owns
+#                   (unless the setup journal says they exist already)
+#   3. join         Accept the invites to the account's rooms
+#   4. chat         Behave like a MatrixChatUser until the end of the test
+#
+# Every user waits at a barrier at the end of each phase until every user on
+# every worker has finished it, because the rooms can only be created once
+# their members exist and joined once they have been created.  The master
+# reports the duration of each phase as a PHASE request in the statistics.
+#
+# Run it with one Locust user per account in users.csv:
+#
+#   python3 run.py --host YOUR_HOMESERVER test-suites/conduit-pipeline.json
+#
+################################################################################
+
+import logging
+import resource
+import time
+
+import gevent
+import gevent.event
+from locust import events
+from locust.runners import MasterRunner, WorkerRunner
+
+import matrixchatuser
+import matrixuser
+import setup_journal
+from matrixuser import load_rooms
+from setup_journal import room_alias_name
+
+
+# The setup phases, in order; the chat phase follows the last one
+SETUP_PHASES = ["register", "create_room", "join"]
+
+# Attempts at each registration, room creation or join before giving up on it
+SETUP_RETRIES = 3
+
+# Master: when each phase started, and the workers that have finished it
+phase_start_times = {}
+phase_finished_workers = {}
+
+# Workers: the number of accounts on this worker, how many of their users
+# have finished each phase, and the events that release them into the next one
+worker_accounts = 0
+phase_arrivals = { phase: 0 for phase in SETUP_PHASES }
+phase_releases = { phase: gevent.event.Event() for phase in SETUP_PHASES }
+
+# The rooms that each account creates, with the other members to invite
+rooms_for_users = None
+
+
+# Preflight ####################################################################
+
+@events.init.add_listener
+def on_locust_init(environment, **_kwargs):
+    # Increase resource limits to prevent OS running out of descriptors
+    resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
+
+    # Register event hooks (replacing MatrixChatUser's 'load_users' handler)
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.register_message("phase_done", on_phase_done)
+    elif isinstance(environment.runner, WorkerRunner):
+        print(f"Registered 'load_users' handler on {environment.runner.client_id}")
+        environment.runner.register_message("load_users", MatrixPipelineUser.load_users)
+        environment.runner.register_message("phase_release", on_phase_release)
+
+@events.test_start.add_listener
+def on_test_start(environment, **_kwargs):
+    global worker_accounts
+
+    phase_start_times.clear()
+    phase_finished_workers.clear()
+    phase_arrivals.clear()
+    phase_releases.clear()
+    for phase in SETUP_PHASES:
+        phase_arrivals[phase] = 0
+        phase_releases[phase] = gevent.event.Event()
+
+    if isinstance(environment.runner, MasterRunner):
+        phase_start_times[SETUP_PHASES[0]] = time.time()
+        num_users = getattr(environment.parsed_options, "num_users", None)
+        if not (num_users is None) and num_users < len(matrixuser.locust_users):
+            logging.warning("Only %d Locust users for %d accounts: the setup phases will never finish",
+                            num_users, len(matrixuser.locust_users))
+    elif not isinstance(environment.runner, WorkerRunner):
+        # Single-worker: MatrixChatUser has already opened users.csv
+        matrixchatuser.MatrixChatUser.worker_users = list(matrixchatuser.MatrixChatUser.worker_users)
+        worker_accounts = len(matrixchatuser.MatrixChatUser.worker_users)
+        matrixchatuser.MatrixChatUser.worker_users = iter(matrixchatuser.MatrixChatUser.worker_users)
+        phase_start_times[SETUP_PHASES[0]] = time.time()
+
+################################################################################
+
+
+# Phase barriers ###############################################################
+
+def finish_phase(environment, phase):
+    """Reports the duration of a phase, and starts the next one"""
+    now = time.time()
+    duration = now - phase_start_times[phase]
+    environment.events.request.fire(request_type="PHASE",
+                                    name=phase,
+                                    response_time=duration * 1000,
+                                    response_length=0,
+                                    exception=None,
+                                    context={})
+
+    index = SETUP_PHASES.index(phase)
+    next_phase = "chat" if index + 1 == len(SETUP_PHASES) else SETUP_PHASES[index + 1]
+    phase_start_times[next_phase] = now
+    print(f"Phase {phase} finished in {duration:.1f}s, starting the {next_phase} phase")
+
+def on_phase_done(environment, msg, **_kwargs):
+    """Master: a worker's users have all finished a phase"""
+    phase = msg.data["phase"]
+    finished = phase_finished_workers.setdefault(phase, set())
+    finished.add(msg.node_id)
+    if len(finished) == environment.runner.worker_count:
+        finish_phase(environment, phase)
+        environment.runner.send_message("phase_release", { "phase": phase })
+
+def on_phase_release(environment, msg, **_kwargs):
+    """Worker: every user on every worker has finished a phase"""
+    phase_releases[msg.data["phase"]].set()
+
+def wait_for_phase(environment, phase):
+    """Blocks the calling user until every user on every worker has finished the phase"""
+    phase_arrivals[phase] += 1
+    if phase_arrivals[phase] == worker_accounts:
+        if isinstance(environment.runner, WorkerRunner):
+            environment.runner.send_message("phase_done", { "phase": phase })
+        else:
+            finish_phase(environment, phase)
+            phase_releases[phase].set()
+    phase_releases[phase].wait()
+
+################################################################################
+
+
+def get_rooms_for_users():
+    """Returns the rooms that each user creates, from rooms.json
+
+        The first member of every room creates it and invites the others.
+    """
+    global rooms_for_users
+    if rooms_for_users is None:
+        rooms_for_users = {}
+        for room_name, room_users in load_rooms().items():
+            rooms_for_users.setdefault(room_users[0], []).append({ "name": room_name, "users": room_users[1:] })
+    return rooms_for_users
+
+
+class MatrixPipelineUser(matrixchatuser.MatrixChatUser):
+
+    @staticmethod
+    def load_users(environment, msg, **_kwargs):
+        global worker_accounts
+        worker_accounts = len(msg.data)
+        matrixchatuser.MatrixChatUser.load_users(environment, msg)
+
+        # With more workers than accounts, some workers have nothing to wait for
+        if worker_accounts == 0:
+            for phase in SETUP_PHASES:
+                environment.runner.send_message("phase_done", { "phase": phase })
+
+    def on_start(self):
+        # Load the next account to set up
+        try:
+            user_dict = next(matrixchatuser.MatrixChatUser.worker_users)
+        except StopIteration:
+            gevent.sleep(999999)
+            return
+
+        self.login_from_csv(user_dict)
+        self.seed_task_selection()
+
+        registered = self.register_account()
+        wait_for_phase(self.environment, "register")
+
+        if registered:
+            self.create_own_rooms()
+        wait_for_phase(self.environment, "create_room")
+
+        if registered:
+            self.accept_invites()
+        wait_for_phase(self.environment, "join")
+
+        if not registered:
+            gevent.sleep(999999)
+            return
+
+        # Chat, picking up from the sync token of the join phase
+        self.start_syncing()
+        if self.e2ee:
+            self.setup_encryption()
+
+    def register_account(self):
+        """Registers our account, unless tokens.csv already has its tokens
+
+            Falls back to logging in, for accounts that were registered without saving their tokens.
+            Returns whether we have an access token.
+        """
+        if not (self.user_id is None) and not (self.access_token is None):
+            return True
+
+        shared_secret = self.environment.parsed_options.registration_shared_secret
+        for attempt in range(1, SETUP_RETRIES + 1):
+            if shared_secret is None:
+                self.register()
+            else:
+                self.register_with_shared_secret(shared_secret)
+            if not (self.user_id is None) and not (self.access_token is None):
+                self.matrix_domain = self.user_id.split(":")[-1]
+                self.save_tokens()
+                return True
+            logging.info("[%s] Could not register user (attempt %d). Trying again...", self.username, attempt)
+
+        self.login(start_syncing=False, log_request=True)
+        if self.user_id is None or self.access_token is None:
+            logging.error("Error registering user %s. Skipping...", self.username)
+            return False
+        return True
+
+    def create_own_rooms(self):
+        def username_to_userid(uname):
+            uid = uname + ":" + self.matrix_domain
+            if not uid.startswith("@"):
+                uid = "@" + uid
+            return uid
+
+        for room_info in get_rooms_for_users().get(self.username, []):
+            room_name = room_info["name"]
+            if room_name in setup_journal.journal.rooms:
+                continue
+            user_ids = list(map(username_to_userid, room_info["users"]))
+            logging.info("User [%s] Creating room [%s] with %d users", self.username, room_name, len(user_ids))
+
+            for attempt in range(1, SETUP_RETRIES + 1):
+                room_id = self.create_room(alias=room_alias_name(room_name), room_name=room_name, user_ids=user_ids,
+                                           encrypted=self.e2ee)
+                if not (room_id is None):
+                    setup_journal.record(self.environment, { "type": "room", "name": room_name, "room_id": room_id })
+                    break
+                logging.info("[%s] Could not create room %s (attempt %d). Trying again...",
+                             self.username, room_name, attempt)
+            else:
+                logging.error("[%s] Error creating room %s. Skipping...", self.username, room_name)
+
+    def accept_invites(self):
+        # Call /sync to get our list of invited rooms, and keep its token for the chat phase
+        for attempt in range(1, SETUP_RETRIES + 1):
+            response = self.sync()
+            if response is not None and response.status_code == 200:
+                break
+            logging.info("[%s] Could not sync (attempt %d). Trying again...", self.username, attempt)
+        else:
+            logging.error("[%s] Error syncing. Skipping...", self.username)
+            return
+        self.save_tokens()
+
+        # self.invited_room_ids set is modified by the MatrixUser class after joining a room
+        rooms_to_join = self.invited_room_ids.copy()
+        logging.info("User [%s] has %d pending invites", self.username, len(rooms_to_join))
+        num_failed = 0
+        for room_id in rooms_to_join:
+            for attempt in range(1, SETUP_RETRIES + 1):
+                if not (self.join_room(room_id) is None):
+                    setup_journal.record(self.environment, { "type": "join", "username": self.username,
+                                                             "room_id": room_id })
+                    break
+                logging.info("[%s] Could not join room %s (attempt %d). Trying again...",
+                             self.username, room_id, attempt)
+            else:
+                logging.error("[%s] Error joining room %s. Skipping...", self.username, room_id)
+                num_failed += 1
+
+        if num_failed == 0 and setup_journal.joined_all_rooms(self, load_rooms()):
+            setup_journal.record(self.environment, { "type": "joined_all", "username": self.username })
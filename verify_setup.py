@@ -0,0 +1,189 @@
+#!/bin/env python3
+
+################################################################################
+#
+# verify_setup.py - Checks the server's rooms and memberships against rooms.json
+#
+# After (or instead of trusting) a population setup, this looks up every room
+# from rooms.json on the server, through the setup journal or the room's
+# deterministic alias, and fetches its joined members with the creator's
+# access token from tokens.csv, with many concurrent requests.  It reports the
+# rooms that are missing and the members that have not joined (or should not
+# be there), and exits with status 1 if anything is off.
+#
+# With --write-journal it rewrites the setup journal from what it found, so
+# that create_room.py and join.py resume from the server's actual state:
+#
+#   python3 verify_setup.py --host http://127.0.0.1:8008 --write-journal
+#
+################################################################################
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import gevent
+import gevent.pool
+from geventhttpclient import HTTPClient, URL
+
+from setup_journal import JOURNAL_PATH, SetupJournal, room_alias_name
+
+
+class SetupVerification:
+
+    def __init__(self, host, concurrency, tokens, journal):
+        url = URL(host)
+        self.client = HTTPClient.from_url(url, concurrency=concurrency,
+                                          connection_timeout=30, network_timeout=120)
+        self.tokens = tokens
+        self.journal = journal
+
+        self.room_ids = {}          # Room name -> room id on the server
+        self.missing_rooms = []     # Room names
+        self.missing_joins = {}     # Room name -> user ids that haven't joined
+        self.extra_members = {}     # Room name -> user ids that aren't in rooms.json
+        self.errors = []
+
+    def _call(self, method, path, access_token):
+        headers = { "Accept": "application/json", "Authorization": "Bearer %s" % access_token }
+        response = self.client.request(method, path, body=b"", headers=headers)
+        try:
+            data = response.read()
+        finally:
+            response.release()
+        return response.status_code, json.loads(data) if data else {}
+
+    def find_room(self, room_name, access_token, server_name):
+        """Returns the room id of a room from rooms.json, or None if it doesn't exist"""
+        room_id = self.journal.rooms.get(room_name, None)
+        if room_id is not None:
+            return room_id
+        room_alias = urllib.parse.quote(f"#{room_alias_name(room_name)}:{server_name}")
+        status, js = self._call("GET", f"/_matrix/client/v3/directory/room/{room_alias}", access_token)
+        if status == 404:
+            return None
+        if status != 200:
+            raise RuntimeError(f"GET /directory/room failed: {status} {js}")
+        return js["room_id"]
+
+    def verify_room(self, room_name, members):
+        creator = self.tokens.get(members[0], None)
+        if creator is None:
+            self.errors.append(f"{room_name}: no access token for its creator {members[0]}")
+            return
+        server_name = creator["user_id"].split(":", 1)[1]
+        expected = set(f"@{username}:{server_name}" for username in members)
+
+        try:
+            room_id = self.find_room(room_name, creator["access_token"], server_name)
+            if room_id is None:
+                self.missing_rooms.append(room_name)
+                return
+            quoted_room_id = urllib.parse.quote(room_id)
+            status, js = self._call("GET", f"/_matrix/client/v3/rooms/{quoted_room_id}/joined_members",
+                                    creator["access_token"])
+            if status != 200:
+                raise RuntimeError(f"GET /joined_members for {room_id} failed: {status} {js}")
+        except Exception as e:
+            self.errors.append(f"{room_name}: {e}")
+            return
+
+        self.room_ids[room_name] = room_id
+        joined = set(js.get("joined", {}).keys())
+        if len(expected - joined) > 0:
+            self.missing_joins[room_name] = sorted(expected - joined)
+        if len(joined - expected) > 0:
+            self.extra_members[room_name] = sorted(joined - expected)
+
+    def write_journal(self, path, rooms):
+        """Rewrites the setup journal with the rooms and joins that we found on the server"""
+        if os.path.exists(path):
+            os.rename(path, path + ".bak")
+        journal = SetupJournal(path)
+        incomplete_users = set()
+        for room_name, members in sorted(rooms.items()):
+            room_id = self.room_ids.get(room_name, None)
+            if room_id is None:
+                incomplete_users.update(members[1:])
+                continue
+            journal.append({ "type": "room", "name": room_name, "room_id": room_id })
+            missing = set(user_id[1:].split(":", 1)[0] for user_id in self.missing_joins.get(room_name, []))
+            incomplete_users.update(missing)
+            for username in members[1:]:
+                if username not in missing:
+                    journal.append({ "type": "join", "username": username, "room_id": room_id })
+        for username in sorted(set(self.tokens.keys()) - incomplete_users):
+            journal.append({ "type": "joined_all", "username": username })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the server's rooms and memberships against rooms.json")
+    parser.add_argument("--host", type=str, required=True,
+                        help="URL of the homeserver (e.g. 'https://www.example.com')")
+    parser.add_argument("-c", "--concurrency", type=int, default=64,
+                        help="Number of concurrent requests")
+    parser.add_argument("-r", "--rooms", type=str, default="rooms.json",
+                        help="Assignment of users to rooms")
+    parser.add_argument("-t", "--tokens", type=str, default="tokens.csv",
+                        help="Token store with the access tokens of the room creators")
+    parser.add_argument("-j", "--journal", type=str, default=JOURNAL_PATH,
+                        help="Setup journal with the room ids of the rooms created so far")
+    parser.add_argument("--write-journal", action="store_true", default=False,
+                        help="Rewrite the setup journal from the server's state (keeping a .bak copy)")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="List every missing room and membership")
+    args = parser.parse_args()
+
+    host = args.host if args.host.startswith("http://") or args.host.startswith("https://") \
+                     else f"https://{args.host}"
+
+    with open(args.rooms, "r", encoding="utf-8") as jsonfile:
+        rooms = json.load(jsonfile)
+    with open(args.tokens, "r", encoding="utf-8") as csvfile:
+        tokens = { row["username"]: row for row in csv.DictReader(csvfile) if row["access_token"] }
+    journal = SetupJournal(args.journal).load()
+    print(f"Verifying {len(rooms)} rooms ({len(journal.rooms)} in {args.journal})")
+
+    verification = SetupVerification(host, args.concurrency, tokens, journal)
+    start_time = time.perf_counter()
+    pool = gevent.pool.Pool(args.concurrency)
+    for room_name, members in rooms.items():
+        pool.spawn(verification.verify_room, room_name, members)
+    pool.join()
+
+    num_missing_joins = sum(len(user_ids) for user_ids in verification.missing_joins.values())
+    num_extra_members = sum(len(user_ids) for user_ids in verification.extra_members.values())
+    print("###################################")
+    print("Rooms found = %d of %d" % (len(verification.room_ids), len(rooms)))
+    print("Rooms missing = %d" % len(verification.missing_rooms))
+    print("Rooms with missing members = %d (%d joins)" % (len(verification.missing_joins), num_missing_joins))
+    print("Rooms with unexpected members = %d (%d members)" % (len(verification.extra_members), num_extra_members))
+    print("Errors = %d" % len(verification.errors))
+    print("Time = %.1fs" % (time.perf_counter() - start_time))
+    print("###################################")
+
+    if args.verbose:
+        for room_name in sorted(verification.missing_rooms):
+            print(f"Missing room: {room_name}")
+        for room_name, user_ids in sorted(verification.missing_joins.items()):
+            print(f"Not joined {room_name}: {', '.join(user_ids)}")
+        for room_name, user_ids in sorted(verification.extra_members.items()):
+            print(f"Unexpected in {room_name}: {', '.join(user_ids)}")
+    for error in verification.errors:
+        print(f"Error: {error}", file=sys.stderr)
+
+    if args.write_journal:
+        verification.write_journal(args.journal, rooms)
+        print(f"Rewrote {args.journal} from the server's state")
+
+    complete = len(verification.missing_rooms) == 0 and num_missing_joins == 0 and num_extra_members == 0 \
+        and len(verification.errors) == 0
+    return 0 if complete else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+################################################################################
+#
+# workload_trace.py - Compact binary traces of Matrix operations
+#
+# A trace records every Matrix API call that a MatrixUser makes (except the
+# background /sync loop) so that the exact same workload can be replayed later
+# against a different server build with replay.py.
+#
+# File layout:
+#   * 8 byte magic, followed by the trace epoch as a little-endian double
+#     (seconds since the Unix epoch, on the Locust master's clock)
+#   * A stream of records, each starting with a one byte tag:
+#       "S" defines the next string of a string table:
+#           table (uint8), length (uint16), UTF-8 bytes
+#       "O" is one operation:
+#           time since epoch in ms (uint32), user (uint32), op (uint16),
+#           room (uint32, NO_ROOM if none), payload size in bytes (int32)
+#     Users, ops and rooms are stored as indexes into their string tables, and
+#     strings are defined the first time that they are used, so traces can be
+#     written as a stream and each operation costs 19 bytes.
+#
+################################################################################
+
+import glob
+import struct
+import time
+
+TRACE_MAGIC = b"MXTRACE1"
+TRACE_HEADER = struct.Struct("<d")
+STRING_HEADER = struct.Struct("<BH")
+OP_RECORD = struct.Struct("<IIHIi")
+
+TABLE_USERS = 0
+TABLE_OPS = 1
+TABLE_ROOMS = 2
+
+NO_ROOM = 0xFFFFFFFF
+
+
+class TraceWriter:
+    """Appends Matrix operations to a binary trace file
+
+    Operations are timed on the local clock.  The offset to the master's clock
+    is usually not known yet when the trace starts, so close() moves the epoch
+    in the header onto the master's clock instead.
+    """
+
+    def __init__(self, path, epoch=None):
+        self.epoch = time.time() if epoch is None else epoch
+        self.tables = ({}, {}, {})
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.file.write(TRACE_HEADER.pack(self.epoch))
+
+    def _index(self, table, value):
+        strings = self.tables[table]
+        index = strings.get(value, None)
+        if index is None:
+            index = len(strings)
+            strings[value] = index
+            data = value.encode("utf-8")
+            self.file.write(b"S" + STRING_HEADER.pack(table, len(data)) + data)
+        return index
+
+    def record(self, now, username, op, room, payload_size):
+        """Records one operation
+
+        Args:
+            now (float): time of the operation, on the local clock
+            username (str): the user who made the call
+            op (str): the operation, e.g. "PUT /_matrix/client/v3/rooms/_/typing/_"
+            room (str): the room that the operation was made in (or None)
+            payload_size (int): size of the request body in bytes
+        """
+        t_ms = max(0, int((now - self.epoch) * 1000))
+        user_index = self._index(TABLE_USERS, username)
+        op_index = self._index(TABLE_OPS, op)
+        room_index = NO_ROOM if room is None else self._index(TABLE_ROOMS, room)
+        self.file.write(b"O" + OP_RECORD.pack(t_ms, user_index, op_index, room_index, payload_size))
+
+    def close(self, clock_offset=0.0):
+        """Closes the trace, with its epoch shifted by clock_offset seconds onto the master's clock"""
+        if clock_offset != 0.0:
+            self.file.seek(len(TRACE_MAGIC))
+            self.file.write(TRACE_HEADER.pack(self.epoch + clock_offset))
+        self.file.close()
+
+
+def read_trace(path):
+    """Reads a trace file
+
+    Returns:
+        (epoch, ops): the trace epoch and the list of
+        (time_ms, username, op, room, payload_size) tuples in the file
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError(f"{path} is not a Matrix workload trace")
+    offset = len(TRACE_MAGIC)
+    (epoch,) = TRACE_HEADER.unpack_from(data, offset)
+    offset += TRACE_HEADER.size
+
+    tables = ([], [], [])
+    ops = []
+    while offset < len(data):
+        tag = data[offset:offset + 1]
+        offset += 1
+        if tag == b"S":
+            table, length = STRING_HEADER.unpack_from(data, offset)
+            offset += STRING_HEADER.size
+            tables[table].append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+        elif tag == b"O":
+            t_ms, user_index, op_index, room_index, payload_size = OP_RECORD.unpack_from(data, offset)
+            offset += OP_RECORD.size
+            room = None if room_index == NO_ROOM else tables[TABLE_ROOMS][room_index]
+            ops.append((t_ms, tables[TABLE_USERS][user_index], tables[TABLE_OPS][op_index], room, payload_size))
+        else:
+            raise ValueError(f"{path}: unknown record tag {tag!r} at offset {offset - 1}")
+
+    return epoch, ops
+
+
+def load_trace_by_user(pattern, usernames=None):
+    """Loads and merges the trace files matching a glob pattern (e.g. one per worker)
+
+    Args:
+        pattern (str): path or glob pattern of the trace files
+        usernames (set): if given, only keep the operations of these users
+
+    Returns:
+        dict: username -> time-ordered list of (seconds since trace start, op, room, payload_size)
+    """
+    traces = [read_trace(path) for path in sorted(glob.glob(pattern))]
+    if len(traces) == 0:
+        raise FileNotFoundError(f"No trace files match {pattern}")
+
+    # Every worker writes its own file, so line them all up on the earliest epoch
+    start = min(epoch for (epoch, _ops) in traces)
+    ops_by_user = {}
+    for epoch, ops in traces:
+        shift = epoch - start
+        for t_ms, username, op, room, payload_size in ops:
+            if usernames is not None and username not in usernames:
+                continue
+            ops_by_user.setdefault(username, []).append((shift + t_ms / 1000, op, room, payload_size))
+
+    for user_ops in ops_by_user.values():
+        user_ops.sort(key=lambda user_op: user_op[0])
+    return ops_by_user